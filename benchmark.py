@@ -0,0 +1,423 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+from processing.io_video_manager import IOVideoManager
+from processing.video_file_stream import VideoFileStream
+from processing.video_preprocessor import VPOptions, VideoPreprocessor
+from utils.logger import logger
+from variables import IS_DOCKER
+
+# Synthetic videos: name -> (width, height, seconds, fps, fourcc, extension)
+VIDEO_SPECS = {
+    "360p_mp4v": (640, 360, 10, 30, "mp4v", ".mp4"),
+    "1080p_mp4v": (1920, 1080, 4, 30, "mp4v", ".mp4"),
+    "720p_mjpg": (1280, 720, 4, 30, "MJPG", ".avi"),
+}
+# Preprocessing options of the transform cases, relative to the source size
+TRANSFORMS = {
+    "gray": {"gray": True},
+    "resize": {"scale": 0.5},
+    "gray_resize_crop": {"gray": True, "scale": 0.5, "crop": 0.25},
+}
+WRITE_FORMATS = ["png", "jpg", "npy"]
+# Number of decoded frames preprocessed or saved by the transform and write cases
+SAMPLE_FRAMES = 60
+
+
+def generate_video(path: str, spec: Tuple) -> bool:
+    """
+    Writes a deterministic synthetic video (moving gradient with a noisy block), so
+    that every run benchmarks the same frames. Returns 'False' if the codec is not
+    available.
+    """
+    w, h, seconds, fps, fourcc, _ = spec
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, (w, h))
+    if not writer.isOpened():
+        return False
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (h // 4, w // 4, 3), dtype=np.uint8)
+    xs = np.arange(w, dtype=np.uint16)
+    ys = np.arange(h, dtype=np.uint16)[:, np.newaxis]
+    for i in range(seconds * fps):
+        frame = np.empty((h, w, 3), dtype=np.uint8)
+        frame[..., 0] = (xs + 4 * i) % 256
+        frame[..., 1] = (ys + 2 * i) % 256
+        frame[..., 2] = (xs // 2 + ys // 2 + i) % 256
+        x = (i * 8) % (w - noise.shape[1])
+        frame[h // 3 : h // 3 + noise.shape[0], x : x + noise.shape[1]] = noise
+        writer.write(frame)
+    writer.release()
+    return True
+
+
+def read_frames(path: str, n: int) -> List[np.array]:
+    """Decodes the first 'n' frames of a video"""
+
+    vfs = VideoFileStream(path, fps=1000, batch_size=1)
+    vfs.start()
+    frames = []
+    try:
+        for _, _, batch in vfs:
+            frames.append(batch[0].copy())
+            if len(frames) >= n:
+                break
+    finally:
+        vfs.close()
+    return frames
+
+
+def bench_decode(path: str) -> dict:
+    """Decodes every frame of a video with 'VideoFileStream'"""
+
+    vfs = VideoFileStream(path, fps=1000, batch_size=1)
+    frames = 0
+    nbytes = 0
+    start = time.perf_counter()
+    vfs.start()
+    for idxs, _, batch in vfs:
+        frames += len(idxs)
+        nbytes += batch.nbytes
+    vfs.close()
+    return {"frames": frames, "bytes": nbytes, "seconds": time.perf_counter() - start}
+
+
+def bench_transform(path: str, transform: str) -> dict:
+    """Preprocesses decoded frames with 'VideoPreprocessor._preprocess_frame'"""
+
+    frames = read_frames(path, SAMPLE_FRAMES)
+    h, w = frames[0].shape[:2]
+    t = TRANSFORMS[transform]
+    width = int(w * t["scale"]) if "scale" in t else None
+    height = int(h * t["scale"]) if "scale" in t else None
+    crop = t.get("crop")
+    opts = VPOptions(
+        fps=1000,
+        width=width,
+        height=height,
+        cxmin=int((width or w) * crop) if crop else None,
+        cxmax=None,
+        cymin=int((height or h) * crop) if crop else None,
+        cymax=None,
+        gray=t.get("gray", False),
+        silent=True,
+    )
+    pp = VideoPreprocessor(
+        vm=IOVideoManager(Path(path).parent, Path(path).parent, silent=True),
+        video_path_obj={"name": os.path.basename(path), "path": Path(path)},
+        dest=Path(path).parent,
+        opts=opts,
+    )
+    metadata = {"w": w, "h": h}
+    start = time.perf_counter()
+    for frame in frames:
+        pp._preprocess_frame(frame, metadata)
+    return {
+        "frames": len(frames),
+        "bytes": sum(f.nbytes for f in frames),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def bench_write(path: str, img_format: str, threads: int, dest: str) -> dict:
+    """Saves decoded frames with 'IOVideoManager.save_img' from 'threads' threads"""
+
+    frames = read_frames(path, SAMPLE_FRAMES)
+    vm = IOVideoManager(Path(dest), Path(dest), silent=True)
+    params = IOVideoManager.get_imwrite_params(img_format, None, None)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(
+            executor.map(
+                lambda i: vm.save_img(
+                    Path(f"frame_{i}.{img_format}"), frames[i], params
+                ),
+                range(len(frames)),
+            )
+        )
+    seconds = time.perf_counter() - start
+    out_bytes = sum(e.stat().st_size for e in os.scandir(dest))
+    return {
+        "frames": len(frames),
+        "bytes": sum(f.nbytes for f in frames),
+        "seconds": seconds,
+        "output_bytes": out_bytes,
+    }
+
+
+def run_child(cmd: List[str]) -> Tuple[str, float, float]:
+    """
+    Helper function that runs a command and returns its stdout, its duration and
+    its peak RSS in MB. Each case runs in its own process so that the peak RSS is
+    the one of the case only.
+    """
+    start = time.perf_counter()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    out = p.stdout.read()
+    # 'wait4' returns the resource usage of this child only
+    _, status, rusage = os.wait4(p.pid, 0)
+    seconds = time.perf_counter() - start
+    p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if p.returncode != 0:
+        raise RuntimeError(f"'{' '.join(cmd)}' exited with code {p.returncode}")
+    # 'ru_maxrss' is in KB on Linux and in bytes on macOS
+    rss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return out.decode(), seconds, rss
+
+
+def run_case(case: dict, work_dir: str) -> dict:
+    """Runs a case in a child process and returns its metrics"""
+
+    if case["kind"] == "pipeline":
+        dest = os.path.join(work_dir, "out", case["id"].replace("/", "_"))
+        shutil.rmtree(dest, ignore_errors=True)
+        main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        cmd = [sys.executable, main_path, "-s", case["src"], "-d", dest, "-ni"]
+        cmd += ["--silent", "-t", str(case["threads"]), "-f", str(case["fps"])]
+        _, seconds, rss = run_child(cmd)
+        # The throughput of the pipeline is the one of the saved frames
+        files = [
+            os.path.join(root, f)
+            for root, _, fs in os.walk(dest)
+            for f in fs
+            if f.endswith(".png")
+        ]
+        metrics = {
+            "frames": len(files),
+            "bytes": sum(os.path.getsize(f) for f in files),
+            "seconds": seconds,
+        }
+    else:
+        cmd = [sys.executable, __file__, "--case", json.dumps(case)]
+        out, _, rss = run_child(cmd)
+        metrics = json.loads(out.splitlines()[-1])
+    metrics["fps"] = metrics["frames"] / metrics["seconds"]
+    metrics["mb_s"] = metrics.pop("bytes") / 1024 / 1024 / metrics["seconds"]
+    metrics["peak_rss_mb"] = rss
+    return metrics
+
+
+def run_case_in_child(case: dict) -> dict:
+    """Entry point of the child process of a case"""
+
+    if case["kind"] == "decode":
+        return bench_decode(case["video"])
+    if case["kind"] == "transform":
+        return bench_transform(case["video"], case["transform"])
+    dest = tempfile.mkdtemp(prefix="bench-write-")
+    try:
+        return bench_write(case["video"], case["format"], case["threads"], dest)
+    finally:
+        shutil.rmtree(dest, ignore_errors=True)
+
+
+def get_cases(videos: dict, threads: List[int], fps: int, src: str) -> List[dict]:
+    """Lists the cases to benchmark"""
+
+    cases = []
+    for name, path in videos.items():
+        cases.append({"id": f"decode/{name}", "kind": "decode", "video": path})
+        for t in TRANSFORMS:
+            cases.append(
+                {
+                    "id": f"transform/{name}/{t}",
+                    "kind": "transform",
+                    "video": path,
+                    "transform": t,
+                }
+            )
+    # Frames are written from the largest video
+    largest = max(videos, key=lambda n: VIDEO_SPECS[n][0] * VIDEO_SPECS[n][1])
+    for f in WRITE_FORMATS:
+        for t in threads:
+            cases.append(
+                {
+                    "id": f"write/{f}/t{t}",
+                    "kind": "write",
+                    "video": videos[largest],
+                    "format": f,
+                    "threads": t,
+                }
+            )
+    for t in threads:
+        cases.append(
+            {
+                "id": f"pipeline/t{t}",
+                "kind": "pipeline",
+                "src": src,
+                "threads": t,
+                "fps": fps,
+            }
+        )
+    return cases
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> dict:
+    """
+    Compares the results with a baseline. A case regresses when its frames/sec
+    drops, or its peak RSS grows, by more than 'tolerance'.
+    """
+    comparison = {}
+    for case_id, r in results.items():
+        b = baseline.get("results", {}).get(case_id)
+        if b is None:
+            continue
+        fps_ratio = r["fps"] / b["fps"]
+        rss_ratio = r["peak_rss_mb"] / b["peak_rss_mb"]
+        comparison[case_id] = {
+            "fps_ratio": fps_ratio,
+            "rss_ratio": rss_ratio,
+            "regression": fps_ratio < 1 - tolerance or rss_ratio > 1 + tolerance,
+        }
+    return comparison
+
+
+def get_environment() -> dict:
+    """Describes the machine and the library versions of the run"""
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmarks the decoding, preprocessing, saving and full pipeline "
+            "throughput on synthetic videos"
+        )
+    )
+    parser.add_argument("--case", default=None, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "-o",
+        "--out",
+        default="benchmark.json",
+        help="Provide the JSON file to save the results to. Defaults to benchmark.json",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help=(
+            "Provide the JSON results of a previous run to compare with. Exits with "
+            "code 1 if a case regressed."
+        ),
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=0.1,
+        type=float,
+        help="Provide the relative slowdown allowed by the comparison. Defaults to 0.1",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        default="1,4",
+        help="Provide the comma separated thread counts to benchmark. Defaults to 1,4",
+    )
+    parser.add_argument(
+        "-f",
+        "--fps",
+        default=10,
+        type=int,
+        help="Provide the fps of the pipeline cases. Defaults to 10",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        default=3,
+        type=int,
+        help="Provide the number of runs of each case (the median is kept). Defaults to 3",
+    )
+    parser.add_argument(
+        "--filter",
+        default=None,
+        help="Provide a prefix of the ids of the cases to run (e.g. 'decode/').",
+    )
+    parser.add_argument(
+        "--work-dir",
+        default=None,
+        help=(
+            "Provide a folder to keep the synthetic videos in between runs. Uses a "
+            "temporary folder by default."
+        ),
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Main function that runs the benchmarks"""
+
+    args = parse_args()
+    if args.case is not None:
+        print(json.dumps(run_case_in_child(json.loads(args.case))))
+        return
+    if IS_DOCKER:
+        logger.error("Set 'IS_DOCKER' to 'False' in variables.py to run benchmarks")
+        exit(1)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench-")
+    src = os.path.join(work_dir, "videos")
+    os.makedirs(src, exist_ok=True)
+    videos = {}
+    for name, spec in VIDEO_SPECS.items():
+        path = os.path.join(src, name + spec[5])
+        if not os.path.isfile(path) and not generate_video(path, spec):
+            logger.warning(f"Skipping video '{name}' (codec '{spec[4]}' not available)")
+            continue
+        videos[name] = path
+
+    threads = [int(t) for t in args.threads.split(",")]
+    results = {}
+    try:
+        for case in get_cases(videos, threads, args.fps, src):
+            if args.filter and not case["id"].startswith(args.filter):
+                continue
+            runs = [run_case(case, work_dir) for _ in range(args.repeat)]
+            # The run with the median frames/sec is kept
+            results[case["id"]] = sorted(runs, key=lambda r: r["fps"])[len(runs) // 2]
+            r = results[case["id"]]
+            logger.info(
+                f"{case['id']:<40} {r['fps']:>9.1f} frames/s {r['mb_s']:>9.1f} MB/s "
+                f"{r['peak_rss_mb']:>7.1f} MB peak RSS"
+            )
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"environment": get_environment(), "results": results}
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(results, json.load(f), args.tolerance)
+        regressions = [k for k, c in report["comparison"].items() if c["regression"]]
+        for k in regressions:
+            c = report["comparison"][k]
+            logger.error(
+                f"Regression of '{k}': {c['fps_ratio']:.2f}x frames/s, "
+                f"{c['rss_ratio']:.2f}x peak RSS"
+            )
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.success(f"Saved the results of {len(results)} case(s) to '{args.out}'")
+    if regressions:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,418 @@
+from argparse import Namespace
 import concurrent.futures
+import cProfile
+import json
+import multiprocessing
+import shutil
+import signal
+import sys
 from pathlib import Path
+from threading import Event, Thread
+import time
+import traceback
+from typing import Callable, Iterable, List, Tuple, Union
+from urllib.parse import quote
 from utils.arg_parser import ArgParser
+from utils.job_client import submit_job
 from utils.logger import logger
+from processing.folder_watcher import FolderWatcher
 from processing.io_video_manager import IOVideoManager
-from processing.video_preprocessor import VPOptions, VideoPreprocessor
+from processing.job_server import JobServer
+from processing.lease import get_lease_manager
+from processing.metrics import (
+    MetricsExporter,
+    QueuedMetrics,
+    RunMetrics,
+    forward_metrics,
+    get_worker_id,
+)
+from processing.run_summary import RunSummary
+from processing.scheduler import VPTask, schedule
+from processing.shard_writer import close_shard_writers, remove_unfinished_shards
+from processing.stage_timings import HISTOGRAM_EDGES_MS
+from processing.video_preprocessor import (
+    VPOptions,
+    VPProfile,
+    VPResult,
+    VideoPreprocessor,
+)
+from variables import (
+    FFMPEG_BIN,
+    IS_DOCKER,
+    LEASE_POLL_INTERVAL,
+    MAX_PENDING_TASKS_PER_WORKER,
+    METRICS_EXPORT_INTERVAL,
+)
 
 
-def main() -> None:
-    """Main function that runs the threaded video processing"""
+def process_video(
+    task: VPTask,
+    vm: IOVideoManager,
+    dest: Path,
+    opts: VPOptions,
+    stop_event: Union[Event, None] = None,
+    metrics: Union[RunMetrics, QueuedMetrics, None] = None,
+) -> VPResult:
+    """
+    Worker function that processes 1 video file (or segment). It is defined at
+    module level so that it can be sent to a process pool.
+    """
+    video_path_obj, segment = task.video_path_obj, task.segment
+    profiler = cProfile.Profile() if opts.profile else None
+    start = time.monotonic()
+    lease = None
+    try:
+        # A lease that cannot be claimed fails the video, not the whole run
+        if opts.lease_ttl is not None:
+            lease = get_lease_manager(vm, opts.lease_ttl).claim(
+                video_path_obj["name"], segment
+            )
+            if lease is None:
+                # Another worker holds the video, the task is submitted again later
+                if metrics is not None:
+                    metrics.end_video(None, "deferred")
+                return VPResult(
+                    name=video_path_obj["name"], segment=segment, claimed=True
+                )
+        pp = VideoPreprocessor(
+            vm=vm,
+            video_path_obj=video_path_obj,
+            dest=dest,
+            opts=opts,
+            stop_event=stop_event,
+            segment=segment,
+            metrics=metrics,
+            lease=lease,
+        )
+        if profiler is None:
+            result = pp.process()
+        else:
+            # Only the thread of the worker is profiled, not its decoder and writers
+            profiler.enable()
+            try:
+                result = pp.process()
+            finally:
+                profiler.disable()
+                save_profile(profiler, vm, video_path_obj["name"], segment)
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        result = VPResult(name=video_path_obj["name"], error=repr(e), segment=segment)
+    finally:
+        if lease is not None:
+            get_lease_manager(vm, opts.lease_ttl).release(lease)
+    result.estimated_cost = task.estimated_cost
+    result.seconds = time.monotonic() - start
+    if metrics is not None:
+        status = "done"
+        if result.skipped:
+            status = "skipped"
+        elif result.error is not None:
+            status = "failed"
+        metrics.end_video(get_worker_id(), status)
+    return result
 
-    args = ArgParser().parse_args()
-    vp_opts = VPOptions(
+
+def save_profile(
+    profiler: cProfile.Profile,
+    vm: IOVideoManager,
+    name: str,
+    segment: Union[Tuple[int, int], None],
+) -> None:
+    """Saves the profile of a video to '.profile/' (readable with 'pstats')"""
+
+    key = quote(name, safe="")
+    if segment is not None:
+        key += f".{segment[0]}-{segment[1]}"
+    path = vm.get_save_path(Path(f".profile/{key}.prof"))
+    vm.makedirs(path)
+    profiler.dump_stats(path)
+
+
+def get_result_name(result: VPResult) -> str:
+    """Returns the name of the task of a result, 'name:start-end' for segments"""
+
+    if result.segment is None:
+        return result.name
+    return f"{result.name}:{result.segment[0]}-{result.segment[1]}"
+
+
+def save_report(vm: IOVideoManager, summary: RunSummary, seconds: float) -> None:
+    """
+    Saves the timings of each stage and the decoding queue stats of every video
+    (unless the results were not kept), and the total timings
+    """
+    videos = {}
+    for r in summary.results or []:
+        if r.timings is None:
+            continue
+        videos[get_result_name(r)] = {
+            "frames": r.frames,
+            "error": r.error,
+            "estimated_cost": r.estimated_cost,
+            "seconds": r.seconds,
+            "stages": r.timings,
+            # A queue that is mostly empty means that the decoding is the
+            # bottleneck, a full one that the preprocessing or the writers are
+            "queue": r.queue_stats,
+        }
+    report = {
+        "seconds": seconds,
+        "frames": summary.frames,
+        "histogram_edges_ms": HISTOGRAM_EDGES_MS,
+        "stages": summary.stages,
+        "videos": videos,
+    }
+    path = vm.get_save_path(Path("report.json"))
+    vm.makedirs(path)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Saved the timings report to '{path}'.")
+
+
+def get_tasks(
+    video_path_obj: dict, vm: IOVideoManager, dest: Path, opts: VPOptions, policy: str
+) -> List[VPTask]:
+    """
+    Probes a video file and splits it into the tasks (whole video or segments) to
+    submit. The video is not probed when it is submitted in order as a single task.
+    """
+    if policy == "order" and not opts.segment_duration:
+        return [VPTask(video_path_obj)]
+    try:
+        pp = VideoPreprocessor(
+            vm=vm, video_path_obj=video_path_obj, dest=dest, opts=opts
+        )
+        return pp.get_tasks()
+    except Exception:
+        logger.error(traceback.format_exc())
+        return [VPTask(video_path_obj)]
+
+
+def start_metrics(
+    args: Namespace, vm: IOVideoManager
+) -> Tuple[Union[RunMetrics, QueuedMetrics], Callable[[], None]]:
+    """
+    Starts exporting the metrics of the run to 'metrics.prom' in the dest folder,
+    and on a port if requested. Returns the metrics to give to the workers and the
+    function that stops the export.
+    """
+    metrics = RunMetrics()
+    exporter = MetricsExporter(
+        metrics,
+        vm.get_save_path(Path("metrics.prom")),
+        METRICS_EXPORT_INTERVAL,
+        port=args.metrics_port,
+        # The port is published by the container
+        host="0.0.0.0" if IS_DOCKER else "127.0.0.1",
+    )
+    vm.makedirs(vm.get_save_path(Path("metrics.prom")))
+    exporter.start()
+    if args.executor == "thread":
+        return metrics, exporter.close
+
+    # Process pool workers send their updates through a managed queue
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    forwarder = Thread(target=forward_metrics, args=(queue, metrics), daemon=True)
+    forwarder.start()
+
+    def close() -> None:
+        queue.put(None)
+        forwarder.join()
+        manager.shutdown()
+        exporter.close()
+
+    return QueuedMetrics(queue), close
+
+
+def init_worker(watch: bool) -> None:
+    """
+    Initializes a process pool worker, which would otherwise inherit the Ctrl+C
+    handler of the main process. In watch mode, the first Ctrl+C is left to the main
+    process and the next one interrupts the videos.
+    """
+
+    def stop(signum: int, frame) -> None:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGINT, stop if watch else signal.default_int_handler)
+
+
+def get_executor(
+    kind: str, max_workers: int, watch=False
+) -> concurrent.futures.Executor:
+    """Creates the pool that runs the workers"""
+
+    if kind == "process":
+        # Each video runs in its own interpreter so the python side of the
+        # processing does not contend for a single GIL
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=init_worker, initargs=(watch,)
+        )
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+
+def run_tasks(
+    executor: concurrent.futures.Executor,
+    tasks: Iterable[VPTask],
+    vm: IOVideoManager,
+    args: Namespace,
+    opts: VPOptions,
+    stop_event: Union[Event, None] = None,
+    metrics: Union[RunMetrics, QueuedMetrics, None] = None,
+    on_result: Union[Callable[[VPResult], None], None] = None,
+) -> RunSummary:
+    """
+    Submits the tasks as they come and returns the summary of their results, which
+    are also given to 'on_result' as they come. Only a few tasks per worker are
+    queued so that a large source tree is not scanned (and held in memory) before
+    the first videos are processed.
+    """
+    max_pending = args.threads * MAX_PENDING_TASKS_PER_WORKER
+    # The results of a watched folder would pile up forever
+    summary = RunSummary(keep_results=not args.watch)
+    pending, deferred = {}, []
+
+    def submit(task: VPTask) -> None:
+        future = executor.submit(
+            process_video, task, vm, args.dest, opts, stop_event, metrics
+        )
+        pending[future] = task
+        if metrics is not None:
+            metrics.add_pending(1)
+
+    def retry(last_retry: float) -> float:
+        # The deferred tasks are submitted again every 'LEASE_POLL_INTERVAL'
+        if not deferred or time.monotonic() - last_retry < LEASE_POLL_INTERVAL:
+            return last_retry
+        for task in deferred:
+            submit(task)
+        deferred.clear()
+        return time.monotonic()
+
+    def collect(timeout: Union[float, None] = None) -> None:
+        done, _ = concurrent.futures.wait(
+            pending, timeout, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            task, result = pending.pop(future), future.result()
+            if result.claimed:
+                deferred.append(task)
+                continue
+            summary.add(result)
+            if on_result is not None:
+                on_result(result)
+
+    # The videos claimed by other workers are tried again until they are done, so
+    # that the videos of dead workers are reclaimed when their lease expires
+    last_retry = time.monotonic()
+    try:
+        for task in tasks:
+            while len(pending) >= max_pending:
+                collect()
+            submit(task)
+            # The tasks never end in watch mode, so the finished ones are
+            # collected as they come
+            collect(0)
+            last_retry = retry(last_retry)
+        while pending or deferred:
+            if pending:
+                collect(LEASE_POLL_INTERVAL if deferred else None)
+            else:
+                time.sleep(LEASE_POLL_INTERVAL)
+            last_retry = retry(last_retry)
+    except KeyboardInterrupt:
+        logger.warning("Interrupted, stopping the running videos...")
+        for future in pending:
+            future.cancel()
+        if stop_event is not None:
+            stop_event.set()
+        raise
+    return summary
+
+
+def get_process_memory(args: Namespace) -> Union[int, None]:
+    """
+    Returns the memory budget (MB) of each process. Threads share the budget of the
+    main process, while each process pool worker gets its share.
+    """
+    if args.max_memory is None or args.executor == "thread":
+        return args.max_memory
+    return max(args.max_memory // args.threads, 1)
+
+
+def log_results(summary: RunSummary) -> None:
+    """Logs a summary of the processed videos"""
+
+    for r in summary.errors:
+        segment = f" (frames {r.segment[0]}-{r.segment[1]})" if r.segment else ""
+        logger.error(f"Failed processing video '{r.name}'{segment}: {r.error}")
+    failed = summary.get_failed()
+    logger.info(
+        f"Processed {summary.videos - failed}/{summary.videos} video(s) "
+        f"({summary.frames} frame(s), {summary.skipped} video(s) already "
+        "processed)."
+    )
+    if summary.dropped:
+        logger.info(f"Dropped {summary.dropped} duplicate frame(s).")
+    if summary.cache_hits or summary.cache_misses:
+        logger.info(
+            f"Frame cache: {summary.cache_hits} hit(s), {summary.cache_misses} "
+            "miss(es)."
+        )
+
+
+def get_video_batches(
+    args: Namespace, vm: IOVideoManager, file_list: Union[Iterable[str], None]
+) -> Iterable[Iterable[dict]]:
+    """
+    Returns the batches of videos to process: all the videos of the src folder (or
+    of the file list), or the new videos found by each scan in watch mode
+    """
+    search = dict(recursive=args.recursive, include=args.include, exclude=args.exclude)
+    if args.watch:
+        stop_watching = Event()
+
+        def stop(signum: int, frame) -> None:
+            logger.warning(
+                "Stopping, waiting for the running videos (press Ctrl+C again to "
+                "stop them)..."
+            )
+            stop_watching.set()
+            # The next signal interrupts the run
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        # Ctrl+C and 'docker stop' end the run once the videos found are processed
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        logger.info(f"Watching '{args.src}' for new videos...")
+        watcher = FolderWatcher(vm, args.watch_interval, **search)
+        return watcher.iter_new_videos(stop_watching)
+    # The confirmation cannot be read from stdin when it holds the list of videos
+    if args.no_input or args.files_from == "-":
+        # The videos are processed while the src folder is scanned
+        return [vm.iter_video_paths(file_list=file_list, **search)]
+    video_paths = vm.get_video_paths(file_list=file_list, **search)
+    input("[INPUT] Press enter to confirm...")
+    return [video_paths]
+
+
+def get_profiles(args: Namespace) -> Union[List[VPProfile], None]:
+    """Returns the output profiles of a run, 'None' without '--output-profile'"""
+
+    if not args.output_profiles:
+        return None
+    return [
+        VPProfile(**ArgParser.parse_output_profile(spec, args))
+        for spec in args.output_profiles
+    ]
+
+
+def get_vp_options(args: Namespace) -> VPOptions:
+    """Returns the options of the videos of a run"""
+
+    return VPOptions(
         fps=args.fps,
         width=args.width,
         height=args.height,
@@ -20,37 +422,177 @@ def main() -> None:
         cymax=args.cymax,
         gray=args.gray,
         silent=args.silent,
+        sampling=args.sampling,
+        segment_duration=args.segment_duration,
+        writers=args.writers,
+        img_format=args.format,
+        png_compression=args.png_compression,
+        quality=args.quality,
+        output=args.output,
+        shard_size=args.shard_size,
+        shard_frames=args.shard_frames,
+        batch_size=args.batch_size,
+        force=args.force,
+        dedup=args.dedup,
+        prefetch=args.prefetch,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        timings=args.report,
+        profile=args.profile,
+        max_memory=get_process_memory(args),
+        decoder=args.decoder,
+        decoder_threads=args.decoder_threads,
+        lease_ttl=args.lease_ttl if args.distributed else None,
+        profiles=get_profiles(args),
     )
 
-    def worker(video_path_obj: Path, vm: IOVideoManager) -> None:
-        """Worker function that processes 1 video file"""
-        try:
-            pp = VideoPreprocessor(
-                vm=vm,
-                video_path_obj=video_path_obj,
-                dest=args.dest,
-                opts=vp_opts,
+
+def run_job(
+    executor: concurrent.futures.Executor,
+    args: Namespace,
+    vm: IOVideoManager,
+    file_list: Union[Iterable[str], None] = None,
+    stop_event: Union[Event, None] = None,
+    metrics: Union[RunMetrics, QueuedMetrics, None] = None,
+    on_result: Union[Callable[[VPResult], None], None] = None,
+) -> RunSummary:
+    """Processes the videos of a run (or of a job of the server) with the workers"""
+
+    vp_opts = get_vp_options(args)
+    video_batches = get_video_batches(args, vm, file_list)
+    start = time.monotonic()
+    # The tasks of each batch of videos are ordered by windows of as many tasks as
+    # the workers queue, so that the first ones are submitted without probing every
+    # video of a large folder
+    window = args.threads * MAX_PENDING_TASKS_PER_WORKER
+    tasks = (
+        t
+        for videos in video_batches
+        for t in schedule(
+            (
+                t
+                for v in videos
+                for t in get_tasks(v, vm, args.dest, vp_opts, args.schedule)
+            ),
+            args.schedule,
+            window,
+        )
+    )
+    summary = run_tasks(
+        executor, tasks, vm, args, vp_opts, stop_event, metrics, on_result
+    )
+    if args.report:
+        save_report(vm, summary, time.monotonic() - start)
+    return summary
+
+
+def serve(args: Namespace) -> None:
+    """Runs the jobs submitted to the server until it is stopped"""
+
+    # The folders are mounted at their own paths so that the jobs can use any of
+    # their sub folders
+    vm = IOVideoManager(
+        src_folder=Path(args.src),
+        dest_folder=Path(args.dest),
+        silent=args.silent,
+        mounted=False,
+    )
+    metrics, stop_metrics = None, None
+    if args.metrics or args.metrics_port is not None:
+        metrics, stop_metrics = start_metrics(args, vm)
+    # 'docker stop' stops the server like Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    with get_executor(args.executor, args.threads) as executor:
+
+        def run(
+            job_args: Namespace,
+            files: Union[List[str], None],
+            stop_event: Union[Event, None],
+            on_result: Callable[[VPResult], None],
+        ) -> RunSummary:
+            job_vm = IOVideoManager(
+                src_folder=Path(job_args.src),
+                dest_folder=Path(job_args.dest),
+                silent=job_args.silent,
+                mounted=False,
+            )
+            return run_job(
+                executor, job_args, job_vm, files, stop_event, metrics, on_result
             )
-            pp.process()
-        except Exception as e:
-            logger.error(e, print_exc=True)
-            raise e
+
+        server = JobServer(
+            args,
+            run,
+            args.server_port,
+            # The port is published by the container
+            host="0.0.0.0" if IS_DOCKER else "127.0.0.1",
+            # Only threads can share an event
+            can_stop=args.executor == "thread",
+        )
+        logger.info(f"Waiting for jobs on port {args.server_port}...")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.warning("Stopping the server...")
+            server.close()
+    if stop_metrics is not None:
+        stop_metrics()
+
+
+def main() -> None:
+    """Main function that runs the parallel video processing"""
+
+    args = ArgParser().parse_args()
+    if args.submit:
+        exit(submit_job(sys.argv[1:], args))
+    if args.decoder == "ffmpeg" and shutil.which(FFMPEG_BIN) is None:
+        logger.error(f"'--decoder ffmpeg' requires '{FFMPEG_BIN}', it was not found")
+        exit(1)
+    if args.serve:
+        serve(args)
+        return
 
     vm = IOVideoManager(
         src_folder=Path(args.src), dest_folder=Path(args.dest), silent=args.silent
     )
-    valid_paths = vm.get_video_paths()
-
-    if not args.no_input:
-        input("[INPUT] Press enter to confirm...")
-
-    # Creating a thread pool to process each file individually and asynchronously
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
-        for p in valid_paths:
-            executor.submit(worker, p, vm)
-            # Delete thead from the queue so when the main thread finishes, all the
-            # created threads are killed
-            del concurrent.futures.thread._threads_queues[list(executor._threads)[0]]
+    if args.files_from is None:
+        file_list = None
+    elif args.files_from == "-":
+        file_list = sys.stdin
+    else:
+        file_list = open(args.files_from)
+
+    # Runs writing shards are never distributed, so no other run writes into them
+    if args.output == "tar":
+        remove_unfinished_shards(vm)
+
+    # Only threads can share an event, processes are interrupted by the SIGINT
+    # they receive from the terminal
+    stop_event = Event() if args.executor == "thread" else None
+    metrics, stop_metrics = None, None
+    if args.metrics or args.metrics_port is not None:
+        metrics, stop_metrics = start_metrics(args, vm)
+    try:
+        # Creating a pool to process each file individually and asynchronously
+        with get_executor(args.executor, args.threads, args.watch) as executor:
+            summary = run_job(executor, args, vm, file_list, stop_event, metrics)
+    finally:
+        if file_list is not None and file_list is not sys.stdin:
+            file_list.close()
+
+        # Finish the shards written by the threads of this process, even when the
+        # run is interrupted. Process pool workers finish theirs when they exit
+        shard_errors = close_shard_writers()
+        for e in shard_errors:
+            logger.error(f"Could not finish shard {e}")
+
+        if stop_metrics is not None:
+            stop_metrics()
+    if not args.silent:
+        log_results(summary)
+    if shard_errors or summary.errors:
+        exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+import subprocess
+import tempfile
+from typing import Iterator, List, Tuple, Union
+import numpy as np
+
+from variables import FFMPEG_BIN
+
+
+class FFmpegDecoder(object):
+    """
+    FFmpegDecoder class that decodes the kept frames of a video with an 'ffmpeg'
+    process. The frames are sampled (and optionally preprocessed by 'filters')
+    inside the decoder and streamed as raw frames over a pipe, so that only the
+    kept frames, at their final size, reach python.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fps: float,
+        start: int,
+        step: int,
+        shape: Tuple[int, ...],
+        filters: Union[List[str], None] = None,
+        threads=0,
+    ) -> None:
+        self._fps = fps
+        self._shape = tuple(shape)
+        self._frame_bytes = int(np.prod(self._shape))
+        args = [FFMPEG_BIN, "-v", "error", "-nostdin", "-threads", str(threads)]
+        if start > 0:
+            # Half a frame early so that the accurate seek keeps the start frame
+            args += ["-ss", f"{(start - 0.5) / fps:.6f}"]
+        # Frames are selected by their number in the whole video, like with
+        # 'cv2.VideoCapture', rather than resampled by time
+        select = f"select='not(mod(n+{start},{step}))'"
+        args += ["-i", path, "-an", "-sn", "-dn", "-map", "0:v:0"]
+        args += ["-vf", ",".join([select] + (filters or []))]
+        # Every selected frame is output once, without duplicating or dropping
+        args += ["-vsync", "passthrough", "-f", "rawvideo"]
+        args += ["-pix_fmt", "gray" if len(self._shape) == 2 else "bgr24", "pipe:1"]
+        # The errors go to a file, a full pipe would block the decoder
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=self._stderr)
+
+    def _read_frame(self, out: np.array) -> bool:
+        """Helper function that reads the next frame into 'out', False at the end"""
+
+        view = memoryview(out).cast("B")
+        n = 0
+        while n < self._frame_bytes:
+            read = self._proc.stdout.readinto(view[n:])
+            if not read:
+                if n > 0:
+                    raise RuntimeError("ffmpeg output a truncated frame")
+                return False
+            n += read
+        return True
+
+    def read_batches(
+        self, indices: Iterator[int], batch_size: int
+    ) -> Iterator[Tuple[List[int], List[float], Union[np.array, None]]]:
+        """
+        Yields the '(indices, timestamps, frames)' batches of the frames kept at
+        'indices' until a batch is shorter than 'batch_size' (or empty)
+        """
+        while True:
+            idxs = []
+            batch = np.empty((batch_size,) + self._shape, dtype=np.uint8)
+            for idx in indices:
+                if not self._read_frame(batch[len(idxs)]):
+                    break
+                idxs.append(idx)
+                if len(idxs) == batch_size:
+                    break
+            # The raw frames carry no timestamps, they are computed from the fps
+            timestamps = [idx * 1000 / self._fps for idx in idxs]
+            if len(idxs) == batch_size:
+                yield idxs, timestamps, batch
+                continue
+            self._check_exit()
+            yield idxs, timestamps, batch[: len(idxs)] if idxs else None
+            return
+
+    def _check_exit(self) -> None:
+        """
+        Helper function that waits for the end of the decoder and raises its error.
+        The decoder is stopped when the kept frames end before the video.
+        """
+        if self._proc.stdout.read(1):
+            self.close()
+            return
+        self._proc.wait()
+        if self._proc.returncode != 0:
+            self._stderr.seek(0)
+            err = self._stderr.read().decode(errors="replace").strip()
+            self.close()
+            raise RuntimeError(f"ffmpeg failed ({self._proc.returncode}): {err}")
+
+    def close(self) -> None:
+        """Stops the decoder"""
+
+        if self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc.stdout.close()
+        self._stderr.close()
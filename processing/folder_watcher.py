@@ -0,0 +1,74 @@
+import os
+from threading import Event
+import time
+from typing import Dict, Iterator, List, Tuple, Union
+
+from utils.logger import logger
+from processing.io_video_manager import IOVideoManager
+
+
+class FolderWatcher(object):
+    """
+    FolderWatcher class that polls the src folder for new (or modified) videos. A
+    video is only returned once its size and modification time did not change
+    between 2 polls, so that the files that are still being copied are skipped.
+    """
+
+    def __init__(self, vm: IOVideoManager, interval: float, **search) -> None:
+        self._vm = vm
+        self._interval = interval
+        # The arguments of 'IOVideoManager.iter_video_paths'
+        self._search = search
+        # Size and modification time of the videos found by the last poll
+        self._last: Dict[str, Tuple[int, float]] = {}
+        # Size and modification time of the videos already returned
+        self._returned: Dict[str, Tuple[int, float]] = {}
+
+    @staticmethod
+    def _get_signature(path: str) -> Union[Tuple[int, float], None]:
+        """
+        Helper function that returns the size and modification time of a file,
+        'None' if it was removed or is still empty
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if stat.st_size == 0:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def poll(self) -> List[dict]:
+        """Scans the src folder once and returns the videos that became stable"""
+
+        found, stable = {}, []
+        for path_obj in self._vm.iter_video_paths(**self._search):
+            name = path_obj["name"]
+            signature = self._get_signature(path_obj["path"])
+            if signature is None:
+                continue
+            found[name] = signature
+            if self._last.get(name) == signature != self._returned.get(name):
+                self._returned[name] = signature
+                stable.append(path_obj)
+        self._last = found
+        # A removed video is processed again if it comes back
+        self._returned = {k: v for k, v in self._returned.items() if k in found}
+        return stable
+
+    def iter_new_videos(
+        self, stop_event: Union[Event, None] = None
+    ) -> Iterator[List[dict]]:
+        """
+        Polls the src folder every 'interval' seconds and yields the videos found by
+        each poll, until 'stop_event' is set
+        """
+        stop_event = stop_event or Event()
+        while not stop_event.is_set():
+            start = time.monotonic()
+            videos = self.poll()
+            for path_obj in videos:
+                logger.info(f"Found new video '{path_obj['name']}'")
+            if videos:
+                yield videos
+            stop_event.wait(max(self._interval - (time.monotonic() - start), 0))
@@ -0,0 +1,196 @@
+from dataclasses import asdict
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterator, List, Sequence, Tuple, Union
+from uuid import uuid4
+import numpy as np
+
+from processing.preprocess_plan import PreprocessPlan
+from processing.video_file_stream import SamplingPlan
+
+
+class CachedVideoStream(object):
+    """
+    CachedVideoStream class that replays the frames of a cache entry with the same
+    interface as 'VideoFileStream'
+    """
+
+    def __init__(self, frames_path: str, entry: dict, batch_size=1) -> None:
+        self._entry = entry
+        self._frames = np.memmap(
+            frames_path,
+            dtype=entry["dtype"],
+            mode="r",
+            shape=(len(entry["indices"]),) + tuple(entry["shape"]),
+        )
+        self._batch_size = max(batch_size, 1)
+
+    def get_metadata(self) -> dict:
+        return self._entry["metadata"]
+
+    def get_sampling_plan(self) -> SamplingPlan:
+        return SamplingPlan(**self._entry["plan"])
+
+    def start(self) -> None:
+        # the frames are read from disk when they are needed
+        pass
+
+    def push_preprocessing(self, plan: PreprocessPlan) -> bool:
+        # the cached frames are preprocessed by the consumer
+        return False
+
+    def __iter__(self) -> Iterator[Tuple[List[int], List[float], np.array]]:
+        for start in range(0, len(self._frames), self._batch_size):
+            end = start + self._batch_size
+            yield (
+                self._entry["indices"][start:end],
+                self._entry["timestamps"][start:end],
+                self._frames[start:end],
+            )
+
+    def get_queue_depth(self) -> int:
+        # there is no decoding queue
+        return 0
+
+    def get_queue_stats(self) -> None:
+        # there is no decoding queue
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+class FrameCacheWriter(object):
+    """FrameCacheWriter class that appends the decoded frames of a video to the cache"""
+
+    def __init__(
+        self, cache: "FrameCache", key: str, metadata: dict, plan: SamplingPlan
+    ):
+        self._cache = cache
+        self._key = key
+        self._entry = {
+            "metadata": metadata,
+            "plan": asdict(plan),
+            "indices": [],
+            "timestamps": [],
+        }
+        # The entry is written under temporary names so that a failed or
+        # concurrent run never exposes a partial entry
+        self._tmp = os.path.join(cache.cache_dir, f".{key}.{uuid4().hex}")
+        self._f = open(self._tmp + ".frames", "wb")
+
+    def write_batch(
+        self, idxs: Sequence[int], timestamps: Sequence[float], frames: np.array
+    ) -> None:
+        """Appends a (N, H, W, C) batch of decoded frames"""
+
+        self._entry["shape"] = frames.shape[1:]
+        self._entry["dtype"] = frames.dtype.str
+        self._entry["indices"] += idxs
+        self._entry["timestamps"] += timestamps
+        self._f.write(np.ascontiguousarray(frames).data)
+
+    def commit(self) -> None:
+        """Makes the entry available once all the frames are written"""
+
+        self._f.close()
+        if not self._entry["indices"]:
+            self.discard()
+            return
+        with open(self._tmp + ".json", "w") as f:
+            json.dump(self._entry, f)
+        frames_path, entry_path = self._cache.get_entry_paths(self._key)
+        os.replace(self._tmp + ".frames", frames_path)
+        os.replace(self._tmp + ".json", entry_path)
+        self._cache.evict()
+
+    def discard(self) -> None:
+        """Drops the frames written so far"""
+
+        self._f.close()
+        for ext in [".frames", ".json"]:
+            if os.path.exists(self._tmp + ext):
+                os.remove(self._tmp + ext)
+
+
+class FrameCache(object):
+    """
+    FrameCache class that stores the sampled and decoded frames of videos in a
+    folder, keyed by source file and sampling plan, so that runs with other
+    preprocessing options do not decode the videos again. The least recently used
+    entries are evicted when the folder grows above 'max_bytes'.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(path: Path, plan: SamplingPlan) -> str:
+        """Returns the key of the sampled frames of a video file"""
+
+        st = os.stat(path)
+        # The sampling mode only changes how the frames are reached
+        ident = [
+            os.path.abspath(path),
+            st.st_size,
+            st.st_mtime_ns,
+            plan.step,
+            plan.start,
+            plan.end,
+        ]
+        return hashlib.sha1(json.dumps(ident).encode()).hexdigest()
+
+    def get_entry_paths(self, key: str) -> Tuple[str, str]:
+        """Returns the paths of the frames and of the description of an entry"""
+
+        base = os.path.join(self.cache_dir, key)
+        return base + ".frames", base + ".json"
+
+    def open(self, key: str, batch_size=1) -> Union[CachedVideoStream, None]:
+        """Opens the frames of an entry, 'None' if the entry is not cached"""
+
+        frames_path, entry_path = self.get_entry_paths(key)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+            stream = CachedVideoStream(frames_path, entry, batch_size)
+        except (OSError, ValueError):
+            return None
+        # The modification time of the description is the last time it was used
+        os.utime(entry_path)
+        return stream
+
+    def create(self, key: str, metadata: dict, plan: SamplingPlan) -> FrameCacheWriter:
+        """Starts a new entry"""
+        return FrameCacheWriter(self, key, metadata, plan)
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits its size"""
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(".") or not name.endswith(".json"):
+                continue
+            frames_path, entry_path = self.get_entry_paths(name[: -len(".json")])
+            try:
+                size = os.path.getsize(frames_path) + os.path.getsize(entry_path)
+                entries.append((os.path.getmtime(entry_path), size, name))
+            except OSError:
+                # Removed by another worker
+                continue
+            total += size
+        for _, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                return
+            # Open entries keep being readable after their files are removed
+            for p in self.get_entry_paths(name[: -len(".json")]):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
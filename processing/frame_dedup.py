@@ -0,0 +1,56 @@
+from typing import Union
+import cv2
+import numpy as np
+
+# Size of the downscaled frames compared by the deduplicator
+SIGNATURE_SIZE = (32, 32)
+
+
+class FrameDeduplicator(object):
+    """
+    FrameDeduplicator class that drops the frames of a video that are nearly
+    identical to the last kept frame. Frames are compared on a small downscaled
+    signature by their mean absolute difference (from 0 to 255), and frames that
+    differ by at most 'threshold' are dropped.
+    """
+
+    def __init__(self, threshold: float) -> None:
+        self._threshold = threshold
+        self._last = None
+
+    @staticmethod
+    def get_signatures(frames: np.array) -> np.array:
+        """Returns the (N, 32, 32) signatures of a (N, H, W[, C]) batch of frames"""
+
+        sigs = np.stack(
+            [
+                cv2.resize(f, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+                for f in frames
+            ]
+        ).astype(np.float32)
+        # Averaging the channels is enough to compare the frames
+        if sigs.ndim == 4:
+            sigs = sigs.mean(axis=3)
+        return sigs
+
+    def filter_batch(self, frames: np.array) -> Union[np.array, None]:
+        """
+        Returns the boolean mask of the frames of the batch to keep, 'None' when
+        all of them are kept
+        """
+        sigs = self.get_signatures(frames)
+        if self._last is None:
+            diffs = np.full(len(sigs), np.inf)
+        else:
+            # Difference of each frame to the last kept frame of the previous batch
+            diffs = np.abs(sigs - self._last).mean(axis=(1, 2))
+        keep = np.zeros(len(sigs), dtype=bool)
+        for i in range(len(sigs)):
+            if diffs[i] > self._threshold:
+                keep[i] = True
+                self._last = sigs[i]
+                # The next frames are compared to the new kept frame
+                diffs[i + 1 :] = np.abs(sigs[i + 1 :] - self._last).mean(axis=(1, 2))
+        if keep.all():
+            return None
+        return keep
@@ -0,0 +1,207 @@
+from pathlib import Path
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+import numpy as np
+
+from processing.io_video_manager import IOVideoManager
+from processing.video_preprocessor import FrameBatch, VPOptions, VideoPreprocessor
+
+# Marks the end of the videos of a worker in the queue
+_END_OF_WORKER = object()
+
+
+def _create_preprocessor(
+    path: Union[str, Path],
+    opts: Union[VPOptions, None] = None,
+    stop_event: Union[Event, None] = None,
+) -> VideoPreprocessor:
+    """Helper function that creates the preprocessor of a video file"""
+
+    path = Path(path)
+    return VideoPreprocessor(
+        vm=IOVideoManager(src_folder=path.parent, dest_folder=Path(".")),
+        video_path_obj={"name": path.name, "path": path},
+        dest=Path("."),
+        opts=opts or VPOptions(),
+        stop_event=stop_event,
+    )
+
+
+def iter_frames(
+    path: Union[str, Path], opts: Union[VPOptions, None] = None
+) -> Iterator[Tuple[np.array, dict]]:
+    """
+    Yields the preprocessed frames of a video file, without saving them, with their
+    metadata: the video, the number of the frame and the index and timestamp (ms)
+    of its source frame
+    """
+    for batch in _create_preprocessor(path, opts).iter_batches():
+        for i, frame in enumerate(batch.frames):
+            yield frame, {
+                "video": batch.videos[i],
+                "number": batch.numbers[i],
+                "source_frame": batch.source_frames[i],
+                "timestamp": batch.timestamps[i],
+            }
+
+
+def _concat(parts: List[FrameBatch]) -> FrameBatch:
+    """Helper function that joins batches of frames of the same shape"""
+
+    if len(parts) == 1:
+        return parts[0]
+    return FrameBatch(
+        videos=[v for p in parts for v in p.videos],
+        numbers=[n for p in parts for n in p.numbers],
+        source_frames=[s for p in parts for s in p.source_frames],
+        timestamps=[t for p in parts for t in p.timestamps],
+        frames=np.concatenate([p.frames for p in parts]),
+    )
+
+
+def _split(batch: FrameBatch, n: int) -> Tuple[FrameBatch, FrameBatch]:
+    """Helper function that splits a batch of frames after its 'n' first frames"""
+
+    return (
+        FrameBatch(
+            batch.videos[:n],
+            batch.numbers[:n],
+            batch.source_frames[:n],
+            batch.timestamps[:n],
+            batch.frames[:n],
+        ),
+        FrameBatch(
+            batch.videos[n:],
+            batch.numbers[n:],
+            batch.source_frames[n:],
+            batch.timestamps[n:],
+            batch.frames[n:],
+        ),
+    )
+
+
+class _BatchWorkers(object):
+    """
+    Helper class of 'iter_batches' whose threads preprocess the videos and queue
+    their batches
+    """
+
+    def __init__(
+        self,
+        paths: Iterable[Union[str, Path]],
+        opts: Union[VPOptions, None],
+        workers: int,
+        prefetch: int,
+    ) -> None:
+        self._paths = iter(paths)
+        self._paths_lock = Lock()
+        self._opts = opts
+        self._stop_event = Event()
+        self._Q = Queue(maxsize=max(prefetch, 1))
+        self._running = max(workers, 1)
+        for _ in range(self._running):
+            Thread(target=self._run, daemon=True).start()
+
+    def _next_path(self) -> Union[str, Path, None]:
+        """Helper function that takes the next video, 'None' when there is none"""
+
+        with self._paths_lock:
+            return next(self._paths, None)
+
+    def _put(self, item) -> bool:
+        """
+        Helper function that waits for room in the queue to add an item. Returns
+        False if the workers were stopped while waiting.
+        """
+        while not self._stop_event.is_set():
+            try:
+                self._Q.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _run(self) -> None:
+        try:
+            path = self._next_path()
+            while path is not None and not self._stop_event.is_set():
+                pp = _create_preprocessor(path, self._opts, self._stop_event)
+                batches = pp.iter_batches()
+                try:
+                    for batch in batches:
+                        if not self._put(batch):
+                            return
+                finally:
+                    # stops the decoding of a video that is not fully read
+                    batches.close()
+                path = self._next_path()
+        except Exception as e:
+            # the error is raised to the consumer
+            self._put(e)
+        finally:
+            self._put(_END_OF_WORKER)
+
+    def get(self) -> Union[FrameBatch, None]:
+        """
+        Returns the next queued batch, 'None' once every worker is done. Raises the
+        errors of the workers.
+        """
+        while True:
+            item = self._Q.get()
+            if item is _END_OF_WORKER:
+                self._running -= 1
+                if self._running == 0:
+                    return None
+                continue
+            if isinstance(item, BaseException):
+                raise item
+            return item
+
+    def close(self) -> None:
+        """Stops the workers"""
+
+        self._stop_event.set()
+        # the workers may be blocked on a full queue
+        try:
+            while True:
+                self._Q.get_nowait()
+        except Empty:
+            pass
+
+
+def iter_batches(
+    paths: Iterable[Union[str, Path]],
+    opts: Union[VPOptions, None] = None,
+    batch_size=32,
+    workers=2,
+    prefetch=4,
+) -> Iterator[FrameBatch]:
+    """
+    Yields the preprocessed frames of video files by batches of 'batch_size'
+    frames, without saving them, so that they can be fed to a data loader. The
+    videos are preprocessed by 'workers' threads that keep up to 'prefetch'
+    decoded batches ahead. Each video yields its frames in order but the videos
+    are interleaved when there are several workers. A batch only holds frames of
+    the same shape, and the last batch of each shape can be shorter.
+    """
+    bw = _BatchWorkers(paths, opts, workers, prefetch)
+    # Frames waiting for a full batch, by shape
+    pending: Dict[tuple, Tuple[List[FrameBatch], int]] = {}
+    try:
+        while True:
+            batch = bw.get()
+            if batch is None:
+                break
+            shape = batch.frames.shape[1:]
+            parts, size = pending.pop(shape, ([], 0))
+            while size + len(batch.numbers) >= batch_size:
+                head, batch = _split(batch, batch_size - size)
+                yield _concat(parts + [head])
+                parts, size = [], 0
+            if batch.numbers:
+                pending[shape] = (parts + [batch], size + len(batch.numbers))
+        for parts, _ in pending.values():
+            yield _concat(parts)
+    finally:
+        bw.close()
@@ -0,0 +1,145 @@
+from pathlib import Path
+from threading import Lock, Thread
+import time
+from queue import Queue
+from typing import List, Sequence, Union
+import numpy as np
+
+from processing.io_video_manager import IOVideoManager
+from processing.memory_budget import MemoryBudget
+from processing.shard_writer import ShardWriter
+from processing.stage_timings import StageTimings
+
+
+class FrameWriter(object):
+    """
+    FrameWriter class that encodes and saves frames as 'name/frame_{number}.{format}'
+    (files or shard members) with a pool of threads so that writing overlaps with
+    decoding
+    """
+
+    def __init__(
+        self,
+        vm: IOVideoManager,
+        name: str,
+        img_format="png",
+        workers=2,
+        params: Union[List[int], None] = None,
+        sink: Union[ShardWriter, None] = None,
+        max_queue_size=32,
+        timings: Union[StageTimings, None] = None,
+        memory_budget: Union[MemoryBudget, None] = None,
+    ) -> None:
+        # The frames are saved as files unless a shard sink is given
+        self._sink = sink or vm
+        self._name = name
+        self._img_format = img_format
+        self._params = params
+        self._timings = timings
+        # the queued frames take from the memory budget
+        self._memory_budget = memory_budget
+        self._queued_bytes = 0
+        self._errors = []
+        self._lock = Lock()
+        # initialize the bounded queue of frames waiting to be saved, 'write' blocks
+        # when the writers cannot keep up
+        self._Q = Queue(maxsize=max_queue_size)
+        self._threads = [
+            Thread(target=self._run, daemon=True) for _ in range(max(workers, 0))
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _save(self, dest_path: Path, image: np.array) -> None:
+        """Helper function that saves a frame and keeps track of the errors"""
+
+        try:
+            self._sink.save_img(dest_path, image, self._params, self._timings)
+        except Exception as e:
+            with self._lock:
+                self._errors.append(f"'{dest_path.as_posix()}': {e}")
+
+    def _run(self) -> None:
+        while True:
+            item = self._Q.get()
+            try:
+                # 'None' is the signal to stop the thread
+                if item is None:
+                    return
+                self._save(*item)
+                self._release(item[1].nbytes)
+            finally:
+                self._Q.task_done()
+
+    def write(
+        self, number: int, image: np.array, source_frame: int, timestamp: float
+    ) -> None:
+        """Queues a frame to be saved with its number"""
+
+        dest_path = Path(f"{self._name}/frame_{number}.{self._img_format}")
+        # Without workers, frames are saved inline
+        if not self._threads:
+            self._save(dest_path, image)
+            return
+        t = time.monotonic()
+        self._reserve(image.nbytes)
+        self._Q.put((dest_path, image))
+        # Waiting for room in the queue means that the writers cannot keep up
+        if self._timings is not None:
+            self._timings.add("write_queue_wait", time.monotonic() - t)
+
+    def _reserve(self, nbytes: int) -> None:
+        """Helper function that waits for room in the memory budget to queue a frame"""
+
+        if self._memory_budget is None:
+            return
+        # A writer with an empty queue does not wait so that it cannot be blocked by
+        # decoded frames that wait for it
+        self._memory_budget.acquire(nbytes, is_idle=lambda: self._queued_bytes == 0)
+        with self._lock:
+            self._queued_bytes += nbytes
+
+    def _release(self, nbytes: int) -> None:
+        """Helper function that gives back the memory of a saved frame"""
+
+        if self._memory_budget is None:
+            return
+        with self._lock:
+            self._queued_bytes -= nbytes
+        self._memory_budget.release(nbytes)
+
+    def write_batch(
+        self,
+        numbers: Sequence[int],
+        images: np.array,
+        source_frames: Sequence[int],
+        timestamps: Sequence[float],
+    ) -> None:
+        """
+        Queues a batch of frames to be saved. The frames are queued one by one so
+        that all the workers encode the batch in parallel.
+        """
+        for n, image, s, t in zip(numbers, images, source_frames, timestamps):
+            self.write(n, image, s, t)
+
+    def get_queue_depth(self) -> int:
+        """Returns the number of frames waiting to be saved"""
+        return self._Q.qsize()
+
+    def flush(self) -> List[str]:
+        """Waits for all the queued frames to be saved and returns the errors"""
+
+        self._Q.join()
+        with self._lock:
+            return self._errors.copy()
+
+    def close(self) -> List[str]:
+        """Flushes the queued frames, stops the workers and returns the errors"""
+
+        errors = self.flush()
+        for _ in self._threads:
+            self._Q.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        return errors
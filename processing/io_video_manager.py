@@ -1,6 +1,8 @@
+from fnmatch import fnmatch
 import os
 from pathlib import Path
-from typing import List
+import time
+from typing import Iterable, Iterator, List, Union
 
 import cv2
 import numpy as np
@@ -12,17 +14,29 @@ from variables import (
     VIDEO_FILE_EXTENSIONS,
 )
 from utils.logger import logger
+from processing.stage_timings import StageTimings
 
 
 class IOVideoManager(object):
     """IOVideoManager class to work with IO"""
 
-    def __init__(self, src_folder: Path, dest_folder: Path, silent=False) -> None:
+    def __init__(
+        self,
+        src_folder: Path,
+        dest_folder: Path,
+        silent=False,
+        mounted: Union[bool, None] = None,
+    ) -> None:
         self._src_folder = src_folder
         self._dest_folder = dest_folder
+        # In Docker the folders are mounted at fixed paths, unless they are mounted
+        # at their own paths (server)
+        self._mounted = IS_DOCKER if mounted is None else mounted
         # The '_silent' variable is currently not used but it could be useful for logging
         # purposes
         self._silent = silent
+        # Folders already created, so that 'os.makedirs' is called once per folder
+        self._created_dirs = set()
 
     def _log_found_files(self, file_names: List[str]) -> None:
         """Helper function to log all the valid files found in the src folder"""
@@ -31,35 +45,189 @@ class IOVideoManager(object):
         for f in file_names:
             logger.info(f"   - {f}")
 
-    def get_video_paths(self) -> List[dict]:
-        """Gets the paths of the videos in the src folder"""
-
-        path_objs = []
-        abs_src_folder = self._src_folder.absolute()
-        for p in os.listdir(abs_src_folder.as_posix()):
-            if p.lower().endswith(tuple(VIDEO_FILE_EXTENSIONS)):
-                full_path = ""
-                if IS_DOCKER:
-                    full_path = Path(os.path.join(MOUNT_IMAGE_SRC, p))
-                else:
-                    full_path = Path(os.path.join(abs_src_folder.as_posix(), p))
-
-                tmp = {"name": p, "path": full_path}
-                path_objs.append(tmp)
-
+    def get_video_paths(self, **kwargs) -> List[dict]:
+        """
+        Gets the paths of the videos in the src folder and logs them, see
+        'iter_video_paths' for the arguments
+        """
+        path_objs = list(self.iter_video_paths(**kwargs))
         self._log_found_files([p_obj["name"] for p_obj in path_objs])
         return path_objs
 
-    def save_img(self, dest_path: Path, image: np.array) -> None:
-        """Saves a np.array with cv2 to dest folder"""
-        full_save_path = ""
-        if IS_DOCKER:
-            full_save_path = os.path.join(MOUNT_IMAGE_DEST, dest_path.as_posix())
+    def _get_path_obj(self, rel_path: str) -> dict:
+        """
+        Helper function that returns the path object of a video from its path
+        relative to the src folder, which is also its name
+        """
+        if self._mounted:
+            full_path = Path(os.path.join(MOUNT_IMAGE_SRC, rel_path))
         else:
-            full_save_path = os.path.join(
-                self._dest_folder.as_posix(), dest_path.as_posix()
-            )
+            full_path = Path(os.path.join(self._src_folder.absolute(), rel_path))
+        return {"name": rel_path, "path": full_path}
+
+    @staticmethod
+    def _is_video(
+        rel_path: str,
+        include: Union[List[str], None] = None,
+        exclude: Union[List[str], None] = None,
+    ) -> bool:
+        """Helper function that filters a path relative to the src folder"""
+
+        if include:
+            if not any(fnmatch(rel_path, p) for p in include):
+                return False
+        elif not rel_path.lower().endswith(tuple(VIDEO_FILE_EXTENSIONS)):
+            return False
+        return not any(fnmatch(rel_path, p) for p in exclude or [])
+
+    def iter_video_paths(
+        self,
+        recursive=False,
+        include: Union[List[str], None] = None,
+        exclude: Union[List[str], None] = None,
+        file_list: Union[Iterable[str], None] = None,
+    ) -> Iterator[dict]:
+        """
+        Yields the paths of the videos in the src folder (and its subfolders if
+        'recursive') as they are found, or the ones of 'file_list' if given. The
+        videos are the files with a video extension, or matching one of the
+        'include' globs, and not matching any of the 'exclude' globs. Globs match
+        the paths relative to the src folder.
+        """
+        if file_list is not None:
+            yield from self._iter_listed_video_paths(file_list, include, exclude)
+            return
+        root = self._src_folder.absolute().as_posix()
+        # Folders left to scan, relative to the src folder
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                with os.scandir(os.path.join(root, rel_dir)) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                logger.warning(f"Could not scan folder '{rel_dir or root}': {e}")
+                continue
+            sub_dirs = []
+            for entry in entries:
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                # Symbolic links to folders are not followed to avoid cycles
+                if entry.is_dir(follow_symlinks=False):
+                    # Excluded folders are not scanned at all
+                    if recursive and not any(
+                        fnmatch(rel_path, p) for p in exclude or []
+                    ):
+                        sub_dirs.append(rel_path)
+                elif entry.is_file() and self._is_video(rel_path, include, exclude):
+                    yield self._get_path_obj(rel_path)
+            # The subfolders are scanned in order, after the files of the folder
+            stack += reversed(sub_dirs)
+
+    def _iter_listed_video_paths(
+        self,
+        lines: Iterable[str],
+        include: Union[List[str], None] = None,
+        exclude: Union[List[str], None] = None,
+    ) -> Iterator[dict]:
+        """
+        Helper function that yields the paths of the videos listed one per line
+        (relative to the src folder, or absolute in it)
+        """
+        root = Path(os.path.normpath(self._src_folder.absolute()))
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            # The '..' are resolved so that the listed videos (and their frames in
+            # the dest folder) cannot be outside of the folders
+            rel_path = self.get_relative_path(line, root)
+            if rel_path is None:
+                logger.warning(f"Skipping '{line}' (not in the src folder)")
+                continue
+            if self._is_video(rel_path, include, exclude):
+                yield self._get_path_obj(rel_path)
+
+    @staticmethod
+    def get_relative_path(path: str, root: Path) -> Union[str, None]:
+        """
+        Returns a path (relative to the 'root' folder, or absolute) relative to the
+        'root' folder once its '..' are resolved, 'None' if it is not in the folder
+        """
+        full_path = Path(os.path.normpath(root / path))
+        try:
+            rel_path = full_path.relative_to(os.path.normpath(root)).as_posix()
+        except ValueError:
+            return None
+        return None if rel_path == "." else rel_path
+
+    @staticmethod
+    def get_output_name(name: str) -> str:
+        """
+        Returns the path (relative to the dest folder, without extension) of the
+        frames of a video from its name, which mirrors the src folder tree
+        """
+        folder, _, file_name = name.rpartition("/")
+        file_name = file_name.replace(".", "_")
+        return f"{folder}/{file_name}" if folder else file_name
+
+    @staticmethod
+    def get_imwrite_params(
+        img_format: str, png_compression: Union[int, None], quality: Union[int, None]
+    ) -> List[int]:
+        """Returns the cv2.imwrite parameters of an image format"""
+
+        params = []
+        if img_format == "png" and png_compression is not None:
+            params += [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        if img_format == "jpg" and quality is not None:
+            params += [cv2.IMWRITE_JPEG_QUALITY, quality]
+        if img_format == "webp" and quality is not None:
+            params += [cv2.IMWRITE_WEBP_QUALITY, quality]
+        return params
+
+    def get_save_path(self, dest_path: Path) -> str:
+        """Returns the full path of a path relative to the dest folder"""
+
+        if self._mounted:
+            return os.path.join(MOUNT_IMAGE_DEST, dest_path.as_posix())
+        return os.path.join(self._dest_folder.as_posix(), dest_path.as_posix())
+
+    def makedirs(self, full_path: str) -> None:
+        """Creates the parent folders of a full path if they do not exist already"""
+
+        dir_name = os.path.dirname(full_path)
+        if dir_name not in self._created_dirs:
+            os.makedirs(dir_name, exist_ok=True)
+            self._created_dirs.add(dir_name)
 
-        # Create dirs if they do not exist already
-        os.makedirs(os.path.dirname(full_save_path), exist_ok=True)
-        cv2.imwrite(full_save_path, image)
+    def save_img(
+        self,
+        dest_path: Path,
+        image: np.array,
+        params: Union[List[int], None] = None,
+        timings: Union[StageTimings, None] = None,
+    ) -> None:
+        """
+        Saves a np.array with cv2 to dest folder, with the image format given by the
+        dest path extension ('.npy' saves the raw array)
+        """
+        full_save_path = self.get_save_path(dest_path)
+        self.makedirs(full_save_path)
+        t = time.monotonic()
+        if dest_path.suffix == ".npy":
+            np.save(full_save_path, image)
+            if timings is not None:
+                timings.add("write", time.monotonic() - t, 1, image.nbytes)
+            return
+        # Encoding and writing separately is what 'cv2.imwrite' does, and tells
+        # which one is slow
+        success, data = cv2.imencode(dest_path.suffix, image, params or [])
+        if not success:
+            raise IOError(f"Could not encode '{full_save_path}'")
+        if timings is not None:
+            t_encoded = time.monotonic()
+            timings.add("encode", t_encoded - t, 1, data.nbytes)
+        with open(full_save_path, "wb") as f:
+            f.write(data)
+        if timings is not None:
+            timings.add("write", time.monotonic() - t_encoded, 1, data.nbytes)
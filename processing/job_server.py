@@ -0,0 +1,208 @@
+from argparse import Namespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+from threading import Event, Lock
+import traceback
+from typing import BinaryIO, Callable, List, Set, Union
+
+from utils.arg_parser import ArgParser
+from utils.logger import logger
+from processing.io_video_manager import IOVideoManager
+from processing.run_summary import RunSummary
+from processing.video_preprocessor import VPResult
+from variables import SERVER_OPTIONS
+
+# Function that runs a job: its arguments, list of videos, stop event and the
+# callback of its results. It returns the summary of the results
+JobRunner = Callable[
+    [
+        Namespace,
+        Union[List[str], None],
+        Union[Event, None],
+        Callable[[VPResult], None],
+    ],
+    RunSummary,
+]
+
+
+class JobServer(object):
+    """
+    JobServer class that keeps the workers up and runs the jobs submitted to
+    'http://host:port/jobs', so that a job does not pay for starting a container,
+    the interpreters and opencv. A job is the command line of a run, in sub folders
+    of the src and dest folders of the server, and its progress is sent back as
+    JSON lines.
+    """
+
+    def __init__(
+        self,
+        args: Namespace,
+        run_job: JobRunner,
+        port: int,
+        host="127.0.0.1",
+        can_stop=True,
+    ) -> None:
+        self._args = args
+        self._run_job = run_job
+        # Only the jobs run by threads can be stopped
+        self._can_stop = can_stop
+        self._jobs: Set[Event] = set()
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer((host, port), self._create_handler())
+        self._server.daemon_threads = True
+
+    @staticmethod
+    def _check_folder(path: str, root: str, name: str) -> None:
+        """Helper function that ensures that the folder of a job is in the server's"""
+
+        try:
+            Path(path).resolve().relative_to(Path(root).resolve())
+        except ValueError:
+            raise ValueError(
+                f"The {name} folder '{path}' is not in the {name} folder of the "
+                f"server ('{root}')"
+            )
+
+    @staticmethod
+    def _check_files(files: List[str], src: str) -> None:
+        """Helper function that ensures that the videos of a job are in its src folder"""
+
+        if not isinstance(files, list) or not all(isinstance(f, str) for f in files):
+            raise ValueError("The files of a job must be a list of paths")
+        root = Path(src).absolute()
+        for f in files:
+            if f.strip() and IOVideoManager.get_relative_path(f.strip(), root) is None:
+                raise ValueError(f"The video '{f}' is not in the src folder '{src}'")
+
+    def _parse_job(self, job: dict) -> Namespace:
+        """
+        Helper function that parses the command line of a job. Raises a ValueError
+        when it is invalid.
+        """
+        try:
+            args = ArgParser().parse_args(job["args"])
+        except SystemExit:
+            raise ValueError("Invalid arguments, see the logs of the server")
+        if args.serve or args.watch:
+            raise ValueError("'--serve' and '--watch' cannot be used in a job")
+        if args.output == "tar":
+            raise ValueError("'--output tar' cannot be used in a job")
+        args.src, args.dest = job["src"], job["dest"]
+        self._check_folder(args.src, self._args.src, "src")
+        self._check_folder(args.dest, self._args.dest, "dest")
+        if job.get("files") is not None:
+            self._check_files(job["files"], args.src)
+        for name in SERVER_OPTIONS:
+            setattr(args, name, getattr(self._args, name))
+        # The list of videos is sent with the job
+        args.files_from = None
+        args.no_input = True
+        return args
+
+    @staticmethod
+    def _get_summary(summary: RunSummary) -> dict:
+        """Helper function that returns the event that ends a job"""
+
+        return {
+            "event": "done",
+            "videos": summary.videos,
+            "failed": summary.get_failed(),
+            "skipped": summary.skipped,
+            "frames": summary.frames,
+            "dropped": summary.dropped,
+        }
+
+    def _run(
+        self, args: Namespace, files: Union[List[str], None], out: BinaryIO
+    ) -> None:
+        """Helper function that runs a job and sends its progress to 'out'"""
+
+        stop_event = Event() if self._can_stop else None
+
+        def send(event: dict) -> None:
+            try:
+                out.write(json.dumps(event).encode() + b"\n")
+                out.flush()
+            except OSError:
+                # The client is gone, its videos are stopped
+                if stop_event is not None:
+                    stop_event.set()
+
+        def on_result(r: VPResult) -> None:
+            send(
+                {
+                    "event": "video",
+                    "name": r.name,
+                    "segment": r.segment,
+                    "frames": r.frames,
+                    "skipped": r.skipped,
+                    "error": r.error,
+                }
+            )
+
+        logger.info(f"Running the job of '{args.src}'...")
+        if stop_event is not None:
+            with self._lock:
+                self._jobs.add(stop_event)
+        try:
+            summary = self._run_job(args, files, stop_event, on_result)
+            send(self._get_summary(summary))
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            send({"event": "error", "error": repr(e)})
+        finally:
+            with self._lock:
+                self._jobs.discard(stop_event)
+        logger.info(f"Finished the job of '{args.src}'")
+
+    def _create_handler(self) -> type:
+        """Helper function that creates the request handler of the server"""
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send_json(self, code: int, body: dict) -> None:
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self) -> None:
+                if self.path.split("?")[0] != "/jobs":
+                    self._send_json(404, {"error": f"Unknown path '{self.path}'"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    job = json.loads(self.rfile.read(length))
+                    args = server._parse_job(job)
+                except (ValueError, KeyError, TypeError) as e:
+                    self._send_json(400, {"error": str(e)})
+                    return
+                # The events are streamed until the end of the job closes the
+                # connection
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                server._run(args, job.get("files"), self.wfile)
+
+            def log_message(self, *args) -> None:
+                # the jobs are logged by the server
+                pass
+
+        return Handler
+
+    def serve_forever(self) -> None:
+        """Runs the jobs until the server is interrupted"""
+
+        self._server.serve_forever()
+
+    def close(self) -> None:
+        """Stops the running jobs and the server"""
+
+        with self._lock:
+            for stop_event in self._jobs:
+                stop_event.set()
+        self._server.server_close()
@@ -0,0 +1,179 @@
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import socket
+from threading import Lock, Thread
+import time
+from typing import Dict, Tuple, Union
+from uuid import uuid4
+
+from variables import LEASE_RENEWALS_PER_TTL
+from processing.io_video_manager import IOVideoManager
+from processing.manifest import ProcessingManifest
+
+
+@dataclass
+class Lease(object):
+    """Dataclass for the lease of a video (or segment) held by this process"""
+
+    path: str
+    token: str
+    # Set when another worker reclaimed the lease
+    lost: bool = False
+
+
+class LeaseManager(object):
+    """
+    LeaseManager class that lets the workers of any number of nodes claim the videos
+    (or segments) of a shared dest folder, with a lease file per video in its
+    '.leases' folder. A lease is created atomically, renewed by touching the file
+    while the video is processed, and can be reclaimed by another worker once it
+    has not been renewed for 'ttl' seconds (its worker died).
+    """
+
+    def __init__(self, vm: IOVideoManager, ttl: float) -> None:
+        self._vm = vm
+        self._ttl = ttl
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._leases: Dict[str, Lease] = {}
+        self._lock = Lock()
+        self._renewer = None
+
+    def _get_path(self, name: str, segment: Union[Tuple[int, int], None]) -> str:
+        """Helper function that returns the path of the lease file of a video"""
+
+        key = ProcessingManifest.get_key(name, segment)
+        return self._vm.get_save_path(Path(f".leases/{key}.lease"))
+
+    @staticmethod
+    def _read_token(path: str) -> str:
+        """Helper function that reads the token of a lease file"""
+
+        try:
+            with open(path) as f:
+                return json.load(f)["token"]
+        except (ValueError, KeyError):
+            # the file is being written
+            return ""
+
+    def _create(self, path: str) -> Union[Lease, None]:
+        """Helper function that creates a lease file, 'None' if it already exists"""
+
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        lease = Lease(path=path, token=uuid4().hex)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"token": lease.token, "owner": self._owner}, f)
+        return lease
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        """Helper function that removes a file unless another worker already did"""
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _is_expired(self, path: str) -> bool:
+        """Helper function that checks if a file was not touched for 'ttl' seconds"""
+        return time.time() - os.stat(path).st_mtime > self._ttl
+
+    def _reclaim(self, path: str) -> Union[Lease, None]:
+        """
+        Helper function that replaces an expired lease file by a new lease. The
+        workers that find the same expired lease race to create its reclaim marker,
+        and only the winner replaces it.
+        """
+        try:
+            if not self._is_expired(path):
+                return None
+            stale = self._read_token(path)
+        except FileNotFoundError:
+            # released in the meantime
+            return self._create(path)
+        marker = f"{path}.{stale}.reclaim"
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            # the worker that created it may have died as well
+            try:
+                if self._is_expired(marker):
+                    os.remove(marker)
+            except FileNotFoundError:
+                # removed by the worker that won the race
+                pass
+            return None
+        try:
+            if self._read_token(path) == stale:
+                os.remove(path)
+            return self._create(path)
+        except FileNotFoundError:
+            return self._create(path)
+        finally:
+            # a slow winner's marker may have been removed as expired
+            self._remove(marker)
+
+    def claim(
+        self, name: str, segment: Union[Tuple[int, int], None] = None
+    ) -> Union[Lease, None]:
+        """
+        Claims a video (or segment), 'None' if another worker holds its lease. The
+        lease is renewed until it is released.
+        """
+        path = self._get_path(name, segment)
+        self._vm.makedirs(path)
+        lease = self._create(path) or self._reclaim(path)
+        if lease is None:
+            return None
+        with self._lock:
+            self._leases[path] = lease
+            if self._renewer is None:
+                self._renewer = Thread(target=self._renew, daemon=True)
+                self._renewer.start()
+        return lease
+
+    def release(self, lease: Lease) -> None:
+        """Releases a lease so that the video can be claimed again"""
+
+        with self._lock:
+            self._leases.pop(lease.path, None)
+        try:
+            if not lease.lost and self._read_token(lease.path) == lease.token:
+                os.remove(lease.path)
+        except FileNotFoundError:
+            pass
+
+    def _renew(self) -> None:
+        """Touches the lease files held by the process, and detects the lost ones"""
+
+        while True:
+            time.sleep(self._ttl / LEASE_RENEWALS_PER_TTL)
+            with self._lock:
+                leases = list(self._leases.values())
+            for lease in leases:
+                try:
+                    if self._read_token(lease.path) == lease.token:
+                        os.utime(lease.path)
+                        continue
+                except FileNotFoundError:
+                    pass
+                lease.lost = True
+
+
+# Lease managers of the current process, by dest folder
+_lease_managers: Dict[str, LeaseManager] = {}
+_lease_managers_lock = Lock()
+
+
+def get_lease_manager(vm: IOVideoManager, ttl: float) -> LeaseManager:
+    """Returns the lease manager shared by the workers of the current process"""
+
+    key = vm.get_save_path(Path(".leases"))
+    with _lease_managers_lock:
+        if key not in _lease_managers:
+            _lease_managers[key] = LeaseManager(vm, ttl)
+        return _lease_managers[key]
@@ -0,0 +1,66 @@
+import json
+import os
+from pathlib import Path
+from typing import Tuple, Union
+from urllib.parse import quote
+
+from processing.io_video_manager import IOVideoManager
+
+
+class ProcessingManifest(object):
+    """
+    ProcessingManifest class that records the progress of every video (or segment)
+    in the '.manifest' folder of the dest folder, so that runs can be resumed. Each
+    video has its own entry file, so workers never write to the same file.
+    """
+
+    def __init__(self, vm: IOVideoManager) -> None:
+        self._vm = vm
+
+    @staticmethod
+    def get_source_identity(path: Path) -> dict:
+        """Returns what identifies the content of a source video file"""
+
+        st = os.stat(path)
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    @staticmethod
+    def get_key(name: str, segment: Union[Tuple[int, int], None] = None) -> str:
+        """Returns the key of a video (or segment) usable as a file name"""
+
+        key = quote(name, safe="")
+        if segment is not None:
+            key += f".{segment[0]}-{segment[1]}"
+        return key
+
+    def _get_entry_path(
+        self, name: str, segment: Union[Tuple[int, int], None] = None
+    ) -> str:
+        """Helper function that returns the path of the entry of a video"""
+
+        key = self.get_key(name, segment)
+        return self._vm.get_save_path(Path(f".manifest/{key}.json"))
+
+    def load(
+        self, name: str, segment: Union[Tuple[int, int], None] = None
+    ) -> Union[dict, None]:
+        """Loads the entry of a video, 'None' if the video was never processed"""
+
+        try:
+            with open(self._get_entry_path(name, segment)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(
+        self, entry: dict, name: str, segment: Union[Tuple[int, int], None] = None
+    ) -> None:
+        """Saves the entry of a video"""
+
+        path = self._get_entry_path(name, segment)
+        self._vm.makedirs(path)
+        # The entry is replaced atomically so that a killed run never leaves a
+        # truncated entry behind
+        with open(path + ".tmp", "w") as f:
+            json.dump(entry, f)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,72 @@
+from threading import Condition, Lock
+from typing import Callable, Dict, Union
+
+
+class MemoryBudget(object):
+    """
+    MemoryBudget class that bounds the bytes of the frames held in memory by all the
+    videos of a process (decoded batches waiting to be preprocessed and frames
+    waiting to be saved). Holders wait for room before taking more frames, which
+    throttles the decoders when the writers cannot keep up.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._peak = 0
+        self._cond = Condition(Lock())
+
+    def acquire(
+        self,
+        nbytes: int,
+        is_idle: Union[Callable[[], bool], None] = None,
+        is_stopped: Union[Callable[[], bool], None] = None,
+    ) -> bool:
+        """
+        Waits until 'nbytes' fit in the budget and takes them. A holder that holds
+        nothing ('is_idle') does not wait so that every video keeps progressing,
+        even with frames larger than the budget. Returns False if the holder was
+        stopped ('is_stopped') while waiting.
+        """
+        with self._cond:
+            while self._used > 0 and self._used + nbytes > self.max_bytes:
+                if is_idle is not None and is_idle():
+                    break
+                if is_stopped is not None and is_stopped():
+                    return False
+                # the conditions of the holder are checked again periodically
+                self._cond.wait(0.1)
+            self._used += nbytes
+            self._peak = max(self._peak, self._used)
+            return True
+
+    def release(self, nbytes: int) -> None:
+        """Gives back bytes taken with 'acquire'"""
+
+        with self._cond:
+            self._used -= nbytes
+            self._cond.notify_all()
+
+    def get_usage(self) -> dict:
+        """Returns the bytes currently held and the most held at once"""
+
+        with self._cond:
+            return {"used": self._used, "peak": self._peak, "max": self.max_bytes}
+
+
+# Memory budgets of the current process, by size
+_memory_budgets: Dict[int, MemoryBudget] = {}
+_memory_budgets_lock = Lock()
+
+
+def get_memory_budget(max_mb: Union[int, None]) -> Union[MemoryBudget, None]:
+    """
+    Returns the memory budget of 'max_mb' MB shared by the workers of the current
+    process, None if the memory is not bounded
+    """
+    if max_mb is None:
+        return None
+    with _memory_budgets_lock:
+        if max_mb not in _memory_budgets:
+            _memory_budgets[max_mb] = MemoryBudget(max_mb * 1024 * 1024)
+        return _memory_budgets[max_mb]
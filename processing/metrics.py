@@ -0,0 +1,303 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+from queue import Queue
+from threading import Event, Lock, Thread, current_thread
+import time
+from typing import List, Union
+
+# Counters of the run, with their help text
+COUNTERS = {
+    "frames_decoded": "Frames decoded from the videos",
+    "frames_written": "Frames handed to the writers",
+    "frames_dropped": "Frames dropped as duplicates",
+    "errors": "Videos (or segments) that failed",
+}
+
+
+def get_worker_id() -> str:
+    """Returns the id of the current worker (process and thread)"""
+    return f"{os.getpid()}-{current_thread().name}"
+
+
+class RunMetrics(object):
+    """
+    RunMetrics class that tracks the progress of a run: counters of the frames and
+    errors, and the current video, progress and queue depths of every worker. It
+    renders them in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._counters = {k: 0 for k in COUNTERS}
+        self._videos = {"done": 0, "failed": 0, "skipped": 0, "deferred": 0}
+        self._pending = 0
+        self._workers = {}
+        # Counters at the previous render, to compute the rates
+        self._last_render = (time.monotonic(), dict(self._counters))
+        self._rates = {k: 0.0 for k in COUNTERS}
+
+    def add_pending(self, n: int) -> None:
+        """Records tasks submitted to the workers"""
+
+        with self._lock:
+            self._pending += n
+
+    def start_video(self, worker: str, video: str, expected_frames: int) -> None:
+        """Records that a worker started a video"""
+
+        with self._lock:
+            self._workers[worker] = {
+                "video": video,
+                "frames": 0,
+                "expected_frames": expected_frames,
+                "decode_queue": 0,
+                "write_queue": 0,
+                "updated": time.time(),
+            }
+
+    def update_video(
+        self,
+        worker: str,
+        decoded=0,
+        written=0,
+        dropped=0,
+        decode_queue=0,
+        write_queue=0,
+    ) -> None:
+        """Adds the frames processed by a worker since its last update"""
+
+        with self._lock:
+            self._counters["frames_decoded"] += decoded
+            self._counters["frames_written"] += written
+            self._counters["frames_dropped"] += dropped
+            w = self._workers.get(worker)
+            if w is None:
+                return
+            w["frames"] += decoded
+            w["decode_queue"] = decode_queue
+            w["write_queue"] = write_queue
+            w["updated"] = time.time()
+
+    def end_video(self, worker: Union[str, None], status: str) -> None:
+        """
+        Records that a task ended as 'done', 'failed', 'skipped' or 'deferred'
+        (claimed by another worker)
+        """
+
+        with self._lock:
+            self._workers.pop(worker, None)
+            self._videos[status] += 1
+            self._pending = max(self._pending - 1, 0)
+            if status == "failed":
+                self._counters["errors"] += 1
+
+    def render(self) -> str:
+        """Returns the metrics in the Prometheus text format"""
+
+        now = time.monotonic()
+        with self._lock:
+            last_time, last_counters = self._last_render
+            if now - last_time > 0:
+                self._rates = {
+                    k: (v - last_counters[k]) / (now - last_time)
+                    for k, v in self._counters.items()
+                }
+            self._last_render = (now, dict(self._counters))
+            counters = dict(self._counters)
+            videos = dict(self._videos)
+            pending = self._pending
+            workers = {k: dict(v) for k, v in self._workers.items()}
+            rates = dict(self._rates)
+
+        lines = []
+        for k, help_text in COUNTERS.items():
+            lines += _render_metric(f"{k}_total", "counter", help_text, counters[k])
+        for k in ["frames_decoded", "frames_written"]:
+            lines += _render_metric(
+                f"{k}_per_second",
+                "gauge",
+                f"{COUNTERS[k]} per second since the previous update",
+                rates[k],
+            )
+        lines += _render_metric(
+            "videos_total",
+            "counter",
+            "Videos (or segments) processed by status",
+            [({"status": s}, n) for s, n in videos.items()],
+        )
+        lines += _render_metric(
+            "videos_pending",
+            "gauge",
+            "Videos (or segments) waiting or being processed",
+            pending,
+        )
+        # The ETA of the running videos, the pending videos are not probed
+        remaining = sum(
+            max(w["expected_frames"] - w["frames"], 0) for w in workers.values()
+        )
+        rate = rates["frames_decoded"]
+        lines += _render_metric(
+            "running_eta_seconds",
+            "gauge",
+            "Estimated time to finish the running videos at the current rate",
+            remaining / rate if rate > 0 else float("nan"),
+        )
+        per_worker = {
+            "frames": "Frames decoded by the worker from its current video",
+            "expected_frames": "Frames to decode from the current video (0 if unknown)",
+            "decode_queue": "Batches decoded and waiting to be preprocessed",
+            "write_queue": "Frames waiting to be saved",
+        }
+        for k, help_text in per_worker.items():
+            lines += _render_metric(
+                f"worker_{k}",
+                "gauge",
+                help_text,
+                [
+                    ({"worker": worker, "video": w["video"]}, w[k])
+                    for worker, w in workers.items()
+                ],
+            )
+        lines += _render_metric(
+            "worker_last_update_timestamp_seconds",
+            "gauge",
+            "Last time the worker made progress, to detect stuck workers",
+            [
+                ({"worker": worker, "video": w["video"]}, w["updated"])
+                for worker, w in workers.items()
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+
+def _render_metric(name: str, kind: str, help_text: str, values) -> List[str]:
+    """
+    Helper function that renders a metric, 'values' is either a number or a list
+    of '(labels, number)'
+    """
+    name = f"waldo_{name}"
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    if not isinstance(values, list):
+        values = [({}, values)]
+    for labels, value in values:
+        # Prometheus spells the missing values 'NaN'
+        value = "NaN" if value != value else value
+        label_str = ",".join(
+            f'{k}="{_escape_label(str(v))}"' for k, v in labels.items()
+        )
+        lines.append(
+            f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}"
+        )
+    return lines
+
+
+def _escape_label(value: str) -> str:
+    """Helper function that escapes a Prometheus label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class QueuedMetrics(object):
+    """
+    QueuedMetrics class with the same update methods as 'RunMetrics', that sends
+    the updates of process pool workers to the main process through a queue
+    """
+
+    def __init__(self, queue: Queue) -> None:
+        self._queue = queue
+
+    def add_pending(self, *args, **kwargs) -> None:
+        self._queue.put(("add_pending", args, kwargs))
+
+    def start_video(self, *args, **kwargs) -> None:
+        self._queue.put(("start_video", args, kwargs))
+
+    def update_video(self, *args, **kwargs) -> None:
+        self._queue.put(("update_video", args, kwargs))
+
+    def end_video(self, *args, **kwargs) -> None:
+        self._queue.put(("end_video", args, kwargs))
+
+
+def forward_metrics(queue: Queue, metrics: RunMetrics) -> None:
+    """Applies the updates sent by 'QueuedMetrics' until it gets 'None'"""
+
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        method, args, kwargs = item
+        getattr(metrics, method)(*args, **kwargs)
+
+
+class MetricsExporter(Thread):
+    """
+    MetricsExporter Thread class that periodically writes the metrics to a file and
+    optionally serves them on 'http://host:port/metrics'
+    """
+
+    def __init__(
+        self,
+        metrics: RunMetrics,
+        path: str,
+        interval: float,
+        port: Union[int, None] = None,
+        host="127.0.0.1",
+    ) -> None:
+        Thread.__init__(self, daemon=True)
+        self._metrics = metrics
+        self._path = path
+        self._interval = interval
+        self._stop_event = Event()
+        self._text = metrics.render()
+        self._server = None
+        if port is not None:
+            self._server = ThreadingHTTPServer((host, port), self._create_handler())
+            self._server.daemon_threads = True
+            Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def _create_handler(self) -> type:
+        """Helper function that creates the request handler of the server"""
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+                body = exporter._text.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                # scrapes are not logged
+                pass
+
+        return Handler
+
+    def _export(self) -> None:
+        """Helper function that renders the metrics and writes them to the file"""
+
+        self._text = self._metrics.render()
+        # The file is replaced atomically so that readers never see a partial file
+        with open(self._path + ".tmp", "w") as f:
+            f.write(self._text)
+        os.replace(self._path + ".tmp", self._path)
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self._interval):
+            self._export()
+
+    def close(self) -> None:
+        """Writes the final metrics and stops the exporter"""
+
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self._export()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,128 @@
+import csv
+from pathlib import Path
+import struct
+import time
+from typing import List, Sequence, Tuple, Union
+import numpy as np
+
+from processing.io_video_manager import IOVideoManager
+from processing.stage_timings import StageTimings
+
+# Size of the .npy header. It is fixed (and large enough for any shape) so that the
+# shape can be rewritten in place when the array is resized
+NPY_HEADER_SIZE = 128
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+
+def _write_npy_header(f, shape: Tuple[int, ...], dtype: np.dtype) -> None:
+    """Helper function that writes a version 1.0 .npy header of 'NPY_HEADER_SIZE'"""
+
+    header = repr({"descr": dtype.str, "fortran_order": False, "shape": shape})
+    # The header is padded with spaces and ends with a new line
+    header_len = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+    header = header.ljust(header_len - 1) + "\n"
+    f.seek(0)
+    f.write(NPY_MAGIC + struct.pack("<H", header_len) + header.encode("latin1"))
+
+
+class MmapWriter(object):
+    """
+    MmapWriter class that packs the frames of a video into a single preallocated
+    and memory-mapped 'name.npy' file of shape (N, H, W[, C]), with a
+    'name.index.csv' sidecar that maps each row to its source frame and timestamp
+    """
+
+    def __init__(
+        self,
+        vm: IOVideoManager,
+        name: str,
+        capacity: int,
+        timings: Union[StageTimings, None] = None,
+    ) -> None:
+        self._path = vm.get_save_path(Path(f"{name}.npy"))
+        self._index_path = vm.get_save_path(Path(f"{name}.index.csv"))
+        vm.makedirs(self._path)
+        # Number of preallocated frames, it grows when the estimate is too small
+        self._capacity = max(capacity, 1)
+        self._frame_shape = None
+        self._dtype = None
+        self._arr = None
+        self._index = []
+        self._timings = timings
+
+    def _frame_size(self) -> int:
+        """Helper function that returns the size of a frame in bytes"""
+        return int(np.prod(self._frame_shape)) * self._dtype.itemsize
+
+    def _create(self, image: np.array) -> None:
+        """Helper function that preallocates the file from the first frame"""
+
+        # The frame shape is only known once the first frame is preprocessed
+        self._frame_shape = image.shape
+        self._dtype = image.dtype
+        with open(self._path, "w+b") as f:
+            _write_npy_header(f, (self._capacity,) + self._frame_shape, self._dtype)
+            f.truncate(NPY_HEADER_SIZE + self._capacity * self._frame_size())
+        self._map()
+
+    def _map(self) -> None:
+        """Helper function that maps the file with the current capacity"""
+
+        self._arr = np.memmap(
+            self._path,
+            dtype=self._dtype,
+            mode="r+",
+            offset=NPY_HEADER_SIZE,
+            shape=(self._capacity,) + self._frame_shape,
+        )
+
+    def _resize(self, capacity: int) -> None:
+        """Helper function that grows or truncates the file to 'capacity' frames"""
+
+        if self._arr is not None:
+            self._arr.flush()
+            # Drop the mapping before changing the file size
+            self._arr = None
+        with open(self._path, "r+b") as f:
+            _write_npy_header(f, (capacity,) + self._frame_shape, self._dtype)
+            f.truncate(NPY_HEADER_SIZE + capacity * self._frame_size())
+        self._capacity = capacity
+
+    def write_batch(
+        self,
+        numbers: Sequence[int],
+        images: np.array,
+        source_frames: Sequence[int],
+        timestamps: Sequence[float],
+    ) -> None:
+        """Copies a (N, H, W[, C]) batch of frames into the next rows of the array"""
+
+        t = time.monotonic()
+        if self._frame_shape is None:
+            self._create(images[0])
+        start = len(self._index)
+        if start + len(images) > self._capacity:
+            self._resize(max(self._capacity * 2, start + len(images)))
+            self._map()
+        self._arr[start : start + len(images)] = images
+        self._index += zip(numbers, source_frames, timestamps)
+        if self._timings is not None:
+            self._timings.add("write", time.monotonic() - t, len(images), images.nbytes)
+
+    def get_queue_depth(self) -> int:
+        # the frames are copied inline
+        return 0
+
+    def close(self) -> List[str]:
+        """Truncates the array to the written frames and saves the index"""
+
+        try:
+            if self._frame_shape is not None:
+                self._resize(len(self._index))
+            with open(self._index_path, "w", newline="") as f:
+                w = csv.writer(f)
+                w.writerow(["frame", "source_frame", "timestamp_ms"])
+                w.writerows(self._index)
+        except Exception as e:
+            return [f"'{self._path}': {e}"]
+        return []
@@ -0,0 +1,115 @@
+from typing import List, Tuple, Union
+import cv2
+import numpy as np
+
+from utils.arg_parser import ArgParser
+
+
+class PreprocessPlan(object):
+    """
+    PreprocessPlan class that compiles the gray/resize/crop options for the frames
+    of a video once, so that each frame only runs the operations it needs
+    """
+
+    def __init__(
+        self,
+        src_w: int,
+        src_h: int,
+        gray=False,
+        width: Union[int, None] = None,
+        height: Union[int, None] = None,
+        cxmin: Union[int, None] = None,
+        cxmax: Union[int, None] = None,
+        cymin: Union[int, None] = None,
+        cymax: Union[int, None] = None,
+    ) -> None:
+        self._gray = gray
+        self._size = (width or src_w, height or src_h)
+        # Resizing to the source size is a copy
+        self._resize = self._size != (src_w, src_h)
+
+        # The crop is relative to the resized frame
+        w, h = self._size
+        self._crop = None
+        if any(c is not None for c in [cxmin, cxmax, cymin, cymax]):
+            vx, mx = ArgParser.validate_crop_axis(cxmin, cxmax, w, "x")
+            vy, my = ArgParser.validate_crop_axis(cymin, cymax, h, "y")
+            if not all([vx, vy]):
+                raise ValueError(", ".join(m for m in [mx, my] if m))
+            x0, x1, y0, y1 = cxmin or 0, cxmax or w, cymin or 0, cymax or h
+            if (x0, x1, y0, y1) != (0, w, 0, h):
+                self._crop = (slice(y0, y1), slice(x0, x1))
+
+        # Intermediate buffer reused by every frame
+        self._gray_buf = None
+
+    def get_output_shape(self) -> Tuple[int, ...]:
+        """Returns the shape of the preprocessed frames"""
+
+        w, h = self._size
+        if self._crop is not None:
+            h = self._crop[0].stop - self._crop[0].start
+            w = self._crop[1].stop - self._crop[1].start
+        return (h, w) if self._gray else (h, w, 3)
+
+    def get_ffmpeg_filters(self) -> List[str]:
+        """Returns the ffmpeg filters that apply the plan to the decoded frames"""
+
+        filters = []
+        if self._resize:
+            # 'accurate_rnd' and 'full_chroma_int' get closer to 'cv2.resize'
+            filters.append(
+                f"scale={self._size[0]}:{self._size[1]}"
+                ":flags=bilinear+accurate_rnd+full_chroma_int"
+            )
+        if self._crop is not None:
+            ys, xs = self._crop
+            filters.append(
+                f"crop={xs.stop - xs.start}:{ys.stop - ys.start}:{xs.start}:{ys.start}"
+            )
+        return filters
+
+    def apply(self, frame: np.array) -> np.array:
+        """
+        Preprocesses a frame. The returned array is never one of the plan's buffers
+        so it can be handed over to the writers.
+        """
+        return self.apply_batch(frame[np.newaxis])[0]
+
+    def apply_batch(self, frames: np.array) -> np.array:
+        """
+        Preprocesses a contiguous (N, H, W, C) batch of frames into a (N, h, w[, c])
+        array. The frames are resized one by one, so a batch is not faster than its
+        frames.
+        """
+        n, h, w = frames.shape[:3]
+        if not self._resize:
+            # Cropping is a view and the grayscale conversion is per pixel, so
+            # cropping first only converts the kept pixels
+            if self._crop is not None:
+                frames = frames[(slice(None),) + self._crop]
+            if not self._gray:
+                return frames
+            if self._crop is None:
+                # A contiguous batch is converted as one tall image
+                gray = cv2.cvtColor(frames.reshape(n * h, w, -1), cv2.COLOR_BGR2GRAY)
+                return gray.reshape(n, h, w)
+            out = np.empty(frames.shape[:3], dtype=frames.dtype)
+            for i in range(n):
+                cv2.cvtColor(frames[i], cv2.COLOR_BGR2GRAY, out[i])
+            return out
+
+        if self._gray:
+            if self._gray_buf is None or len(self._gray_buf) < n * h:
+                self._gray_buf = np.empty((n * h, w), dtype=frames.dtype)
+            gray = self._gray_buf[: n * h]
+            cv2.cvtColor(frames.reshape(n * h, w, -1), cv2.COLOR_BGR2GRAY, gray)
+            frames = gray.reshape(n, h, w)
+        out = np.empty(
+            (n, self._size[1], self._size[0]) + frames.shape[3:], frames.dtype
+        )
+        for i in range(n):
+            cv2.resize(frames[i], self._size, out[i])
+        if self._crop is not None:
+            out = out[(slice(None),) + self._crop]
+        return out
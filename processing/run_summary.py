@@ -0,0 +1,48 @@
+from typing import List, Union
+
+from processing.stage_timings import StageTimings
+from processing.video_preprocessor import VPResult
+
+
+class RunSummary(object):
+    """
+    RunSummary class that sums up the results of a run as they come. It only keeps
+    the failed results, and every result if 'keep_results', so that a run that never
+    ends (watch mode) does not hold all of them in memory.
+    """
+
+    def __init__(self, keep_results=True) -> None:
+        self.videos = 0
+        self.skipped = 0
+        self.frames = 0
+        self.dropped = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Timings of every stage of the videos, summed
+        self.stages = {}
+        self.errors: List[VPResult] = []
+        self.results: Union[List[VPResult], None] = [] if keep_results else None
+
+    def add(self, result: VPResult) -> None:
+        """Adds the result of a task"""
+
+        # A video split into segments is counted with its first segment
+        if result.segment is None or result.segment[0] == 0:
+            self.videos += 1
+            self.skipped += result.skipped
+        self.frames += result.frames
+        self.dropped += result.dropped
+        if result.cache_hit is not None:
+            self.cache_hits += result.cache_hit
+            self.cache_misses += not result.cache_hit
+        if result.timings is not None:
+            self.stages = StageTimings.merge([self.stages, result.timings])
+        if result.error is not None:
+            self.errors.append(result)
+        if self.results is not None:
+            self.results.append(result)
+
+    def get_failed(self) -> int:
+        """Returns the number of videos with a failed task"""
+
+        return len({r.name for r in self.errors})
@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+import heapq
+from typing import Iterable, Iterator, Tuple, Union
+
+from variables import SEEK_COST_FRAMES, WRITE_COST_FRAMES
+from processing.video_file_stream import SamplingPlan
+
+
+@dataclass
+class VPTask(object):
+    """Dataclass for a task submitted to the workers: a video or a segment of it"""
+
+    video_path_obj: dict
+    segment: Union[Tuple[int, int], None] = None
+    # None when the video could not be probed
+    estimated_cost: Union[float, None] = None
+
+
+def estimate_cost(metadata: dict, plan: SamplingPlan, outputs=1) -> Union[float, None]:
+    """
+    Estimates the work of decoding the frames of a sampling plan and saving them
+    for 'outputs' profiles, in megapixels. Returns None when the video does not
+    report its frame count.
+    """
+    if plan.frame_count <= 0:
+        return None
+    end = plan.end if plan.end is not None else plan.frame_count
+    mpx = metadata["w"] * metadata["h"] / 1e6
+    kept = plan.expected_frames()
+    # Grabbing decodes every frame, seeking decodes a few frames from the previous
+    # keyframe for each kept frame
+    decoded = end - plan.start
+    if plan.mode == "seek":
+        decoded = min(kept * SEEK_COST_FRAMES, decoded)
+    return mpx * (decoded + kept * WRITE_COST_FRAMES * outputs)
+
+
+def _get_cost(task: VPTask) -> float:
+    """
+    Helper function that returns the estimated cost of a task, the tasks that
+    could not be probed are assumed to be the longest
+    """
+    if task.estimated_cost is None:
+        return float("inf")
+    return task.estimated_cost
+
+
+# Sort keys of the scheduling policies (see 'SCHEDULING_POLICIES'), 'order' submits
+# the tasks in the order the videos are found without waiting for the end of the scan
+SORT_KEYS = {
+    "order": None,
+    "longest": lambda task: -_get_cost(task),
+    "shortest": _get_cost,
+}
+
+
+def _schedule_window(tasks: Iterable[VPTask], key, window: int) -> Iterator[VPTask]:
+    """
+    Helper function that holds up to 'window' tasks and submits the first one of
+    them by 'key' whenever a new task comes, like 'sorted' for fewer tasks
+    """
+    heap = []
+    for i, task in enumerate(tasks):
+        # The index keeps the order of the tasks with the same key
+        heapq.heappush(heap, (key(task), i, task))
+        if len(heap) > window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def schedule(
+    tasks: Iterable[VPTask], policy: str, window: Union[int, None] = None
+) -> Iterable[VPTask]:
+    """
+    Orders the tasks to submit according to a scheduling policy. With a 'window',
+    only the next 'window' tasks are ordered so that the tasks are submitted while
+    they are found, instead of once every video was probed.
+    """
+    key = SORT_KEYS[policy]
+    if key is None:
+        return tasks
+    if window is None:
+        return sorted(tasks, key=key)
+    return _schedule_window(tasks, key, window)
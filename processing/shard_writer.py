@@ -0,0 +1,187 @@
+import io
+import json
+from multiprocessing.util import Finalize
+import os
+from pathlib import Path
+import socket
+import tarfile
+from threading import Lock
+import time
+from typing import Callable, Dict, List, Union
+from uuid import uuid4
+
+import cv2
+import numpy as np
+
+from processing.io_video_manager import IOVideoManager
+from processing.stage_timings import StageTimings
+
+# Size of a tar member header, members are also padded to a multiple of it
+TAR_BLOCK_SIZE = 512
+
+
+class ShardWriter(object):
+    """
+    ShardWriter class that streams encoded frames into rolling 'shards/*.tar' files
+    of bounded size and frame count, each with a '.json' manifest of its members.
+    It can be shared by the threads of a process, and the shards of different
+    processes (or nodes) never collide as their names are prefixed with an unique id.
+    """
+
+    def __init__(self, vm: IOVideoManager, max_bytes: int, max_frames: int) -> None:
+        self._vm = vm
+        self._max_bytes = max_bytes
+        self._max_frames = max_frames
+        self._prefix = f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:8]}"
+        self._lock = Lock()
+        self._count = 0
+        self._path = None
+        self._tar = None
+        self._size = 0
+        self._members = []
+        # Callbacks to run once the current shard is finished
+        self._on_close: List[Callable[[], None]] = []
+
+    def _open_shard(self) -> None:
+        """Helper function that starts a new shard"""
+
+        self._path = self._vm.get_save_path(
+            Path(f"shards/{self._prefix}-{self._count:06d}.tar")
+        )
+        self._vm.makedirs(self._path)
+        # Shards are written under a temporary name so that readers only ever see
+        # complete shards
+        self._tar = tarfile.open(self._path + ".part", "w")
+        self._size = 0
+        self._members = []
+        self._count += 1
+
+    def _close_shard(self) -> None:
+        """Helper function that finishes the current shard and its manifest"""
+
+        if self._tar is None:
+            return
+        self._tar.close()
+        self._tar = None
+        os.replace(self._path + ".part", self._path)
+        with open(f"{self._path}.json", "w") as f:
+            json.dump(
+                {"shard": os.path.basename(self._path), "members": self._members}, f
+            )
+        callbacks, self._on_close = self._on_close, []
+        for callback in callbacks:
+            callback()
+
+    def _encode(
+        self, dest_path: Path, image: np.array, params: Union[List[int], None]
+    ) -> bytes:
+        """Helper function that encodes a frame with the dest path extension"""
+
+        if dest_path.suffix == ".npy":
+            buf = io.BytesIO()
+            np.save(buf, image)
+            return buf.getvalue()
+        success, data = cv2.imencode(dest_path.suffix, image, params or [])
+        if not success:
+            raise IOError(f"Could not encode '{dest_path.as_posix()}'")
+        return data.tobytes()
+
+    def save_img(
+        self,
+        dest_path: Path,
+        image: np.array,
+        params: Union[List[int], None] = None,
+        timings: Union[StageTimings, None] = None,
+    ) -> None:
+        """Encodes a frame and appends it to the current shard as 'dest_path'"""
+
+        t = time.monotonic()
+        # Encoding happens outside of the lock so that threads encode concurrently
+        data = self._encode(dest_path, image, params)
+        if timings is not None:
+            t_encoded = time.monotonic()
+            timings.add("encode", t_encoded - t, 1, len(data))
+        member_size = TAR_BLOCK_SIZE + -(-len(data) // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE
+        with self._lock:
+            if self._tar is not None and (
+                len(self._members) >= self._max_frames
+                or self._size + member_size > self._max_bytes
+            ):
+                self._close_shard()
+            if self._tar is None:
+                self._open_shard()
+            info = tarfile.TarInfo(dest_path.as_posix())
+            info.size = len(data)
+            info.mtime = time.time()
+            self._tar.addfile(info, io.BytesIO(data))
+            self._size += member_size
+            self._members.append({"name": info.name, "size": info.size})
+        if timings is not None:
+            # Includes the time waiting for the other threads to write
+            timings.add("write", time.monotonic() - t_encoded, 1, len(data))
+
+    def on_shard_closed(self, callback: Callable[[], None]) -> None:
+        """
+        Calls 'callback' once every frame written so far is in a finished shard,
+        right away if no shard is open
+        """
+        with self._lock:
+            if self._tar is None:
+                callback()
+            else:
+                self._on_close.append(callback)
+
+    def close(self) -> None:
+        """Finishes the current shard"""
+
+        with self._lock:
+            self._close_shard()
+
+
+# Shard writers of the current process, by dest folder
+_shard_writers: Dict[str, ShardWriter] = {}
+_shard_writers_lock = Lock()
+
+
+def get_shard_writer(
+    vm: IOVideoManager, max_bytes: int, max_frames: int
+) -> ShardWriter:
+    """Returns the shard writer shared by the workers of the current process"""
+
+    key = vm.get_save_path(Path("shards"))
+    with _shard_writers_lock:
+        if not _shard_writers:
+            # Process pool workers do not run 'atexit' callbacks, but they do run
+            # the multiprocessing finalizers when they exit
+            Finalize(None, close_shard_writers, exitpriority=10)
+        if key not in _shard_writers:
+            _shard_writers[key] = ShardWriter(vm, max_bytes, max_frames)
+        return _shard_writers[key]
+
+
+def close_shard_writers() -> List[str]:
+    """Finishes the shards of the current process and returns the errors"""
+
+    errors = []
+    with _shard_writers_lock:
+        for key, sw in _shard_writers.items():
+            try:
+                sw.close()
+            except Exception as e:
+                errors.append(f"'{key}': {e}")
+        _shard_writers.clear()
+    return errors
+
+
+def remove_unfinished_shards(vm: IOVideoManager) -> None:
+    """
+    Removes the shards left unfinished by interrupted runs. Their frames were never
+    recorded as stored in the manifest, so they are written again. It must not run
+    while other runs write into the same dest folder.
+    """
+    shards_dir = vm.get_save_path(Path("shards"))
+    if not os.path.isdir(shards_dir):
+        return
+    for name in os.listdir(shards_dir):
+        if name.endswith(".tar.part"):
+            os.remove(os.path.join(shards_dir, name))
@@ -0,0 +1,65 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import List
+
+# Upper bounds (ms) of the buckets of the timing histograms, the last bucket holds
+# the slower calls
+HISTOGRAM_EDGES_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+
+class StageTimings(object):
+    """
+    StageTimings class that collects the time spent in each stage of the processing
+    (call count, total, histogram), and the frames and bytes that went through it.
+    It can be shared by the threads of a video.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._stages = {}
+
+    def add(self, stage: str, seconds: float, frames=0, nbytes=0) -> None:
+        """Records a call of a stage"""
+
+        bucket = bisect_left(HISTOGRAM_EDGES_MS, seconds * 1000)
+        with self._lock:
+            s = self._stages.get(stage)
+            if s is None:
+                s = self._stages[stage] = {
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "frames": 0,
+                    "bytes": 0,
+                    "histogram": [0] * (len(HISTOGRAM_EDGES_MS) + 1),
+                }
+            s["calls"] += 1
+            s["seconds"] += seconds
+            s["frames"] += frames
+            s["bytes"] += nbytes
+            s["histogram"][bucket] += 1
+
+    def to_dict(self) -> dict:
+        """Returns the timings of every stage"""
+
+        with self._lock:
+            return {
+                k: dict(v, histogram=v["histogram"].copy())
+                for k, v in self._stages.items()
+            }
+
+    @staticmethod
+    def merge(timings: List[dict]) -> dict:
+        """Sums the timings of several videos"""
+
+        total = {}
+        for t in timings:
+            for k, v in t.items():
+                if k not in total:
+                    total[k] = dict(v, histogram=v["histogram"].copy())
+                    continue
+                for f in ["calls", "seconds", "frames", "bytes"]:
+                    total[k][f] += v[f]
+                total[k]["histogram"] = [
+                    a + b for a, b in zip(total[k]["histogram"], v["histogram"])
+                ]
+        return total
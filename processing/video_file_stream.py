@@ -1,46 +1,134 @@
+from dataclasses import dataclass
+from itertools import count
 from threading import Thread
-from queue import Queue
+import time
+from queue import Empty, Queue
+from typing import Iterator, List, Tuple, Union
 import cv2
 import numpy as np
 
+from processing.ffmpeg_decoder import FFmpegDecoder
+from processing.memory_budget import MemoryBudget
+from processing.preprocess_plan import PreprocessPlan
+from processing.stage_timings import StageTimings
+from variables import SEEK_MIN_GAP
+
+# Marks the end of the frames in the queue
+_END_OF_STREAM = object()
+
 # Stolen and modified from:
 # https://www.pyimagesearch.com/2017/02/06/faster-video-file-fps-with-cv2-videocapture-and-opencv/
 
 
+@dataclass
+class SamplingPlan(object):
+    """Dataclass describing which frames of a video are decoded and kept"""
+
+    step: int
+    frame_count: int
+    mode: str
+    # Segment of the video '[start, end)' to sample from
+    start: int = 0
+    end: Union[int, None] = None
+
+    def first_number(self) -> int:
+        """Returns the number of the first kept frame in the whole video"""
+        return -(-self.start // self.step)
+
+    def expected_frames(self) -> int:
+        """Returns the number of frames the plan keeps, 0 if it is unknown"""
+
+        end = self.end if self.end is not None else self.frame_count
+        if end <= 0:
+            return 0
+        return len(range(self.first_number() * self.step, end, self.step))
+
+    def indices(self) -> Iterator[int]:
+        """Returns the indices of the frames to keep"""
+
+        # Kept frames are multiples of 'step' in the whole video so that segments
+        # sample the same frames as a sequential run
+        first = self.first_number() * self.step
+        end = self.end if self.end is not None else self.frame_count
+        # Some containers do not report their frame count, in which case we sample
+        # until the decoder runs out of frames
+        if end <= 0:
+            return count(first, self.step)
+        return iter(range(first, end, self.step))
+
+
 class VideoFileStream(Thread):
-    """VideoFileStream Thread class that reads a video and puts it into a queue"""
+    """
+    VideoFileStream Thread class that reads a video and puts its frames into a
+    bounded queue by batches of contiguous (N, H, W, C) arrays. It is consumed by
+    iterating over it, which yields '(indices, timestamps, frames)' batches until the
+    end of the video and raises the errors of the decoding thread.
+    """
 
-    def __init__(self, path, fps, max_queue_size=128) -> None:
+    def __init__(
+        self,
+        path,
+        fps,
+        sampling="auto",
+        start_frame=0,
+        end_frame=None,
+        batch_size=1,
+        prefetch=128,
+        timings: Union[StageTimings, None] = None,
+        memory_budget: Union[MemoryBudget, None] = None,
+        decoder="opencv",
+        decoder_threads=0,
+    ) -> None:
         Thread.__init__(self, daemon=True)
         # initialize the file video stream along with the boolean
-        # used to indicate if the thread should be stopped or not
-        self._stream = cv2.VideoCapture(path)
+        # used to indicate if the thread should be stopped or not. The capture also
+        # provides the metadata when the frames are decoded by ffmpeg.
+        params = []
+        if decoder_threads > 0:
+            params = [cv2.CAP_PROP_N_THREADS, decoder_threads]
+        self._stream = cv2.VideoCapture(path, cv2.CAP_ANY, params)
+        # A file that is not a video would otherwise read as an empty video
+        if not self._stream.isOpened():
+            raise IOError(f"Could not open video '{path}'")
+        self._path = path
+        self._decoder = decoder
+        self._decoder_threads = decoder_threads
+        # ffmpeg filters preprocessing the frames, and the shape of their output
+        self._filters = None
+        self._frame_shape = None
         self._stopped = False
         self._fps = fps
+        self._sampling = sampling
+        self._start_frame = start_frame
+        self._end_frame = end_frame
+        self._batch_size = max(batch_size, 1)
         # initialize the queue used to store frames read from
-        # the video file
-        self._Q = Queue(maxsize=max_queue_size)
+        # the video file, it holds up to 'prefetch' frames
+        self._Q = Queue(maxsize=max(prefetch // self._batch_size, 1))
+        # Occupancy of the queue sampled at each read, and the time each side
+        # spent blocked on the other
+        self._stats = {
+            "reads": 0,
+            "occupancy": 0,
+            "put_wait": 0.0,
+            "get_wait": 0.0,
+            "memory_wait": 0.0,
+        }
+        self._timings = timings
+        # the decoded batches in the queue take from the memory budget
+        self._memory_budget = memory_budget
 
     def get_metadata(self) -> dict:
         return {
             "fps": self._stream.get(cv2.CAP_PROP_FPS),
             "w": int(self._stream.get(cv2.CAP_PROP_FRAME_WIDTH)),
             "h": int(self._stream.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "frame_count": int(self._stream.get(cv2.CAP_PROP_FRAME_COUNT)),
         }
 
-    def read(self) -> np.array:
-        # return next frame in the queue
-        return self._Q.get()
+    def get_sampling_plan(self) -> SamplingPlan:
+        """Plans the frames to keep from the video and how to reach them"""
 
-    def more(self) -> bool:
-        # return True if there are still frames in the queue
-        return not self._stopped or not self._Q.empty()
-
-    def _stop(self) -> None:
-        # indicate that the thread should be stopped
-        self._stopped = True
-
-    def run(self) -> None:
         meta = self.get_metadata()
         # Get video fps
         curr_fps = meta["fps"]
@@ -48,25 +136,250 @@ class VideoFileStream(Thread):
         # Make sure that the requested fps is valid
         target_fps = min(self._fps, curr_fps)
         target_fps = max(target_fps, 1)
-        fps_count_to_save = round(curr_fps / target_fps)
+        step = max(round(curr_fps / target_fps), 1)
+
+        mode = self._sampling
+        if mode == "auto":
+            mode = "seek" if step >= SEEK_MIN_GAP else "grab"
+        # Seeking requires to know where the video ends
+        if meta["frame_count"] <= 0:
+            mode = "grab"
+        return SamplingPlan(
+            step=step,
+            frame_count=meta["frame_count"],
+            mode=mode,
+            start=self._start_frame,
+            end=self._end_frame,
+        )
+
+    def push_preprocessing(self, plan: PreprocessPlan) -> bool:
+        """
+        Hands the preprocessing of the frames over to the decoder when it can do it
+        (ffmpeg filters), in which case the frames it yields are preprocessed.
+        Returns whether it does.
+        """
+        if self._decoder != "ffmpeg":
+            return False
+        self._filters = plan.get_ffmpeg_filters()
+        self._frame_shape = plan.get_output_shape()
+        return True
 
-        count = 0
-        # keep looping infinitely
+    def __iter__(self) -> Iterator[Tuple[List[int], List[float], np.array]]:
+        # yield the batches of frames in the queue with their indices and
+        # timestamps (ms) until the end of stream marker
         while True:
-            # if the thread indicator variable is set, stop the
-            # thread
-            if self._stopped:
+            occupancy = self._Q.qsize()
+            t = time.monotonic()
+            item = self._Q.get()
+            t = time.monotonic() - t
+            self._stats["get_wait"] += t
+            if self._timings is not None:
+                self._timings.add("queue_get_wait", t)
+            if item is _END_OF_STREAM:
                 return
-            # otherwise, ensure the queue has room in it
-            if not self._Q.full():
-                # read the next frame from the file
-                (grabbed, frame) = self._stream.read()
-                # if the `grabbed` boolean is `False`, then we have
-                # reached the end of the video file
-                if not grabbed:
-                    self._stop()
+            if isinstance(item, BaseException):
+                raise item
+            self._release(item)
+            self._stats["reads"] += 1
+            self._stats["occupancy"] += occupancy
+            yield item
+
+    def get_queue_depth(self) -> int:
+        """Returns the number of decoded batches waiting in the queue"""
+        return self._Q.qsize()
+
+    def get_queue_stats(self) -> dict:
+        """
+        Returns the mean occupancy of the queue (in batches) when the consumer reads
+        it, its capacity, and the time (s) the decoder waited for room in the queue
+        (or in the memory budget) and the consumer waited for frames
+        """
+        reads = max(self._stats["reads"], 1)
+        return {
+            "capacity": self._Q.maxsize,
+            "mean_occupancy": self._stats["occupancy"] / reads,
+            "decoder_wait": self._stats["put_wait"],
+            "memory_wait": self._stats["memory_wait"],
+            "consumer_wait": self._stats["get_wait"],
+        }
+
+    def close(self) -> None:
+        """Stops the decoding thread and releases the video file"""
+
+        self._stopped = True
+        if not self.is_alive():
+            self._stream.release()
+        # The decoding thread may be blocked on a full queue, so the queue is
+        # drained until the thread notices that it was stopped, and once more for
+        # the batches it queued before (which give back their memory)
+        while True:
+            alive = self.is_alive()
+            try:
+                while True:
+                    self._release(self._Q.get_nowait())
+            except Empty:
+                pass
+            if not alive:
+                return
+            self.join(0.01)
+
+    def _put(self, item) -> None:
+        """Helper function that waits for room in the queue to add an item"""
+
+        t = time.monotonic()
+        self._Q.put(item)
+        t = time.monotonic() - t
+        self._stats["put_wait"] += t
+        if self._timings is not None:
+            self._timings.add("queue_put_wait", t)
+
+    def _reserve(self, batch: np.array) -> bool:
+        """
+        Helper function that waits for room in the memory budget to queue a batch.
+        Returns False if the stream was stopped while waiting.
+        """
+        if self._memory_budget is None:
+            return True
+        t = time.monotonic()
+        reserved = self._memory_budget.acquire(
+            batch.nbytes, is_stopped=lambda: self._stopped
+        )
+        t = time.monotonic() - t
+        self._stats["memory_wait"] += t
+        if self._timings is not None:
+            self._timings.add("memory_wait", t)
+        return reserved
+
+    def _release(self, item) -> None:
+        """Helper function that gives back the memory of a batch taken from the queue"""
+
+        if self._memory_budget is not None and isinstance(item, tuple):
+            self._memory_budget.release(item[2].nbytes)
+
+    def _grab_until(self, idx: int, pos: int, mode: str) -> bool:
+        """
+        Helper function that moves the stream from frame 'pos' to frame 'idx' and
+        grabs it without decoding the skipped frames into images
+        """
+        if mode == "seek" and idx > pos:
+            self._stream.set(cv2.CAP_PROP_POS_FRAMES, idx)
+        else:
+            for _ in range(idx - pos):
+                if not self._stream.grab():
+                    return False
+        return self._stream.grab()
+
+    def _read_batch(
+        self, indices: Iterator[int], pos: int, mode: str
+    ) -> Tuple[List[int], List[float], Union[np.array, None], int]:
+        """
+        Helper function that reads the next batch of kept frames, starting from frame
+        'pos'. Returns the indices, timestamps and frames of the batch and the new
+        position of the stream.
+        """
+        idxs = []
+        timestamps = []
+        batch = None
+        for idx in indices:
+            # skip to the next frame to keep and only convert that one
+            grabbed = self._grab_until(idx, pos, mode)
+            if grabbed:
+                timestamp = self._stream.get(cv2.CAP_PROP_POS_MSEC)
+                if batch is None:
+                    grabbed, frame = self._stream.retrieve()
+                else:
+                    # the frame is decoded straight into the batch
+                    grabbed, frame = self._stream.retrieve(batch[len(idxs)])
+            # if the `grabbed` boolean is `False`, then we have
+            # reached the end of the video file
+            if not grabbed:
+                break
+            if batch is None:
+                batch = np.empty((self._batch_size,) + frame.shape, dtype=frame.dtype)
+            if not np.shares_memory(frame, batch):
+                batch[len(idxs)] = frame
+            idxs.append(idx)
+            timestamps.append(timestamp)
+            pos = idx + 1
+            if len(idxs) == self._batch_size:
+                break
+        if batch is not None:
+            batch = batch[: len(idxs)]
+        return idxs, timestamps, batch, pos
+
+    def run(self) -> None:
+        end = _END_OF_STREAM
+        try:
+            self._decode()
+        except Exception as e:
+            # the error is raised to the consumer instead of ending the stream
+            end = e
+        finally:
+            self._stream.release()
+        # the consumer is not reading the queue anymore when it stopped the thread
+        if not self._stopped:
+            self._put(end)
+
+    def _read_opencv(
+        self, plan: SamplingPlan
+    ) -> Iterator[Tuple[List[int], List[float], Union[np.array, None]]]:
+        """Helper function that yields the batches decoded with 'cv2.VideoCapture'"""
+
+        indices = plan.indices()
+        # index of the next frame the stream will return
+        pos = 0
+        # segments always seek to their start whatever the sampling mode
+        if plan.start > 0:
+            self._stream.set(cv2.CAP_PROP_POS_FRAMES, plan.start)
+            pos = plan.start
+        while True:
+            idxs, timestamps, batch, pos = self._read_batch(indices, pos, plan.mode)
+            yield idxs, timestamps, batch
+
+    def _read_ffmpeg(
+        self, plan: SamplingPlan
+    ) -> Iterator[Tuple[List[int], List[float], Union[np.array, None]]]:
+        """Helper function that yields the batches decoded by an 'ffmpeg' process"""
+
+        meta = self.get_metadata()
+        decoder = FFmpegDecoder(
+            path=self._path,
+            fps=meta["fps"],
+            start=plan.first_number() * plan.step,
+            step=plan.step,
+            shape=self._frame_shape or (meta["h"], meta["w"], 3),
+            filters=self._filters,
+            threads=self._decoder_threads,
+        )
+        try:
+            yield from decoder.read_batches(plan.indices(), self._batch_size)
+        finally:
+            decoder.close()
+
+    def _decode(self) -> None:
+        """Helper function that decodes the kept frames of the plan into the queue"""
+
+        plan = self.get_sampling_plan()
+        if self._decoder == "ffmpeg":
+            batches = self._read_ffmpeg(plan)
+        else:
+            batches = self._read_opencv(plan)
+        try:
+            while not self._stopped:
+                t = time.monotonic()
+                idxs, timestamps, batch = next(batches)
+                if self._timings is not None and idxs:
+                    self._timings.add(
+                        "decode", time.monotonic() - t, len(idxs), batch.nbytes
+                    )
+                if idxs:
+                    if not self._reserve(batch):
+                        return
+                    # add the batch to the queue, waiting for the consumer when the
+                    # queue is full
+                    self._put((idxs, timestamps, batch))
+                # the video file (or the plan) has no frames left
+                if len(idxs) < self._batch_size:
                     return
-                if count % fps_count_to_save == 0:
-                    # add the frame to the queue
-                    self._Q.put(frame)
-                count += 1
+        finally:
+            batches.close()
@@ -1,120 +1,787 @@
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, replace
+import csv
+import hashlib
+import json
 from pathlib import Path
+from threading import Event
 import time
-from typing import Union
-import cv2
+from typing import Iterator, List, Sequence, Tuple, Union
 import numpy as np
-from utils.arg_parser import ArgParser
 
 from utils.logger import logger
+from variables import MANIFEST_CHECKPOINT_INTERVAL, METRICS_UPDATE_INTERVAL
+from processing.frame_cache import CachedVideoStream, FrameCache, FrameCacheWriter
+from processing.frame_dedup import FrameDeduplicator
+from processing.frame_writer import FrameWriter
 from processing.io_video_manager import IOVideoManager
-from processing.video_file_stream import VideoFileStream
+from processing.lease import Lease
+from processing.manifest import ProcessingManifest
+from processing.memory_budget import get_memory_budget
+from processing.metrics import QueuedMetrics, RunMetrics, get_worker_id
+from processing.mmap_writer import MmapWriter
+from processing.preprocess_plan import PreprocessPlan
+from processing.scheduler import VPTask, estimate_cost
+from processing.shard_writer import ShardWriter, get_shard_writer
+from processing.stage_timings import StageTimings
+from processing.video_file_stream import SamplingPlan, VideoFileStream
+
+
+@dataclass
+class VPProfile(object):
+    """
+    Dataclass for an output profile: how the sampled frames are preprocessed and
+    saved, in the 'name' subfolder of the dest folder
+    """
+
+    name: str
+    width: Union[int, None] = None
+    height: Union[int, None] = None
+    cxmin: Union[int, None] = None
+    cxmax: Union[int, None] = None
+    cymin: Union[int, None] = None
+    cymax: Union[int, None] = None
+    gray: bool = False
+    img_format: str = "png"
+    png_compression: Union[int, None] = None
+    quality: Union[int, None] = None
 
 
 @dataclass
 class VPOptions(object):
     """Dataclass for 'VideoPreprocessor' options"""
 
-    fps: int
-    width: Union[int, None]
-    height: Union[int, None]
-    cxmin: Union[int, None]
-    cxmax: Union[int, None]
-    cymin: Union[int, None]
-    cymax: Union[int, None]
-    gray: bool
-    silent: bool
+    fps: int = 10
+    width: Union[int, None] = None
+    height: Union[int, None] = None
+    cxmin: Union[int, None] = None
+    cxmax: Union[int, None] = None
+    cymin: Union[int, None] = None
+    cymax: Union[int, None] = None
+    gray: bool = False
+    silent: bool = False
+    sampling: str = "auto"
+    segment_duration: Union[int, None] = None
+    writers: int = 2
+    img_format: str = "png"
+    png_compression: Union[int, None] = None
+    quality: Union[int, None] = None
+    output: str = "files"
+    shard_size: int = 1024
+    shard_frames: int = 10000
+    batch_size: int = 1
+    force: bool = False
+    dedup: Union[float, None] = None
+    prefetch: int = 128
+    cache_dir: Union[str, None] = None
+    cache_size: int = 10240
+    timings: bool = False
+    profile: bool = False
+    max_memory: Union[int, None] = None
+    decoder: str = "opencv"
+    decoder_threads: int = 0
+    lease_ttl: Union[float, None] = None
+    # Output profiles that share the decoded frames, they replace the size, crop,
+    # gray and image options
+    profiles: Union[List[VPProfile], None] = None
+
+    def get_profiles(self) -> List[VPProfile]:
+        """
+        Returns the output profiles, or the profile of the options saved in the dest
+        folder itself
+        """
+        if self.profiles:
+            return self.profiles
+        return [
+            VPProfile(
+                name="",
+                width=self.width,
+                height=self.height,
+                cxmin=self.cxmin,
+                cxmax=self.cxmax,
+                cymin=self.cymin,
+                cymax=self.cymax,
+                gray=self.gray,
+                img_format=self.img_format,
+                png_compression=self.png_compression,
+                quality=self.quality,
+            )
+        ]
+
+    def fingerprint(self) -> str:
+        """Returns a hash of the options that change the saved frames"""
+
+        opts = {k: v for k, v in asdict(self).items() if k not in RUNTIME_OPTIONS}
+        # Left out without profiles and with the default decoder so that the
+        # manifests of older runs still match
+        if opts["profiles"] is None:
+            del opts["profiles"]
+        if opts["decoder"] == "opencv":
+            del opts["decoder"]
+        return hashlib.sha1(json.dumps(opts, sort_keys=True).encode()).hexdigest()
+
+
+# Options that change how a video is processed but not the frames that are saved,
+# they are left out of the fingerprint of the options
+RUNTIME_OPTIONS = [
+    "silent",
+    "sampling",
+    "segment_duration",
+    "writers",
+    "shard_size",
+    "shard_frames",
+    "batch_size",
+    "force",
+    "prefetch",
+    "cache_dir",
+    "cache_size",
+    "timings",
+    "profile",
+    "max_memory",
+    "decoder_threads",
+    "lease_ttl",
+]
+
+
+@dataclass
+class VPResult(object):
+    """Dataclass for the result of a 'VideoPreprocessor' run"""
+
+    name: str
+    frames: int = 0
+    error: Union[str, None] = None
+    segment: Union[Tuple[int, int], None] = None
+    skipped: bool = False
+    cache_hit: Union[bool, None] = None
+    dropped: int = 0
+    timings: Union[dict, None] = None
+    # How full the decoding queue was, with the timings
+    queue_stats: Union[dict, None] = None
+    # Set when another worker holds the lease of the video
+    claimed: bool = False
+    estimated_cost: Union[float, None] = None
+    seconds: float = 0.0
+
+
+@dataclass
+class FrameBatch(object):
+    """
+    Dataclass for a batch of preprocessed frames with, for each frame, its video,
+    its number in the video, the index and timestamp (ms) of its source frame
+    """
+
+    videos: List[str]
+    numbers: List[int]
+    source_frames: List[int]
+    timestamps: List[float]
+    frames: np.array
 
 
 class VideoPreprocessor(object):
     """VideoPreprocessor class that processes a video file"""
 
     def __init__(
-        self, vm: IOVideoManager, video_path_obj: Path, dest: Path, opts: VPOptions
+        self,
+        vm: IOVideoManager,
+        video_path_obj: Path,
+        dest: Path,
+        opts: VPOptions,
+        stop_event: Union[Event, None] = None,
+        segment: Union[Tuple[int, int], None] = None,
+        metrics: Union[RunMetrics, QueuedMetrics, None] = None,
+        lease: Union[Lease, None] = None,
     ) -> None:
         self._vm = vm
         self._video_path_obj = video_path_obj
         self._dest = dest
         self._opts = opts
+        self._stop_event = stop_event
+        self._segment = segment
+        self._lease = lease
+        # Preprocessing plan of each output profile
+        self._plans: List[PreprocessPlan] = []
+        # Whether the decoder preprocesses the frames
+        self._preprocessed = False
+        self._manifest = ProcessingManifest(vm)
+        self._timings = StageTimings() if opts.timings else None
+        self._dedup = None
+        self._dropped_file = None
+        self._dropped_csv = None
+        self._dropped = 0
+        self._cache = None
+        if opts.cache_dir:
+            self._cache = FrameCache(opts.cache_dir, opts.cache_size * 1024 * 1024)
+        self._metrics = metrics
+        self._memory_budget = get_memory_budget(opts.max_memory)
+        # Frames processed since the last update of the metrics
+        self._unreported = {"decoded": 0, "written": 0, "dropped": 0}
+        self._last_metrics_update = time.monotonic()
+
+    def _create_stream(self, start: Union[int, None] = None) -> VideoFileStream:
+        """
+        Helper function that opens the video (or its segment) as a stream, from
+        frame 'start' if given
+        """
+        seg_start, end = self._segment or (0, None)
+        if start is None:
+            start = seg_start
+        return VideoFileStream(
+            path=self._video_path_obj["path"].as_posix(),
+            fps=self._opts.fps,
+            sampling=self._opts.sampling,
+            start_frame=start,
+            end_frame=end,
+            batch_size=self._opts.batch_size,
+            prefetch=self._opts.prefetch,
+            timings=self._timings,
+            memory_budget=self._memory_budget,
+            decoder=self._opts.decoder,
+            decoder_threads=self._opts.decoder_threads,
+        )
+
+    def get_tasks(self) -> List[VPTask]:
+        """
+        Probes the video and splits it into the tasks to submit with their
+        estimated cost: the whole video, or '[start, end)' frame segments of
+        'segment_duration' seconds that can be processed concurrently
+        """
+        vfs = self._create_stream()
+        meta = vfs.get_metadata()
+        plan = vfs.get_sampling_plan()
+        vfs.close()
+        outputs = len(self._opts.get_profiles())
+        seg_frames = 0
+        if self._opts.segment_duration:
+            seg_frames = round(self._opts.segment_duration * meta["fps"])
+        # Without a frame count we cannot know where to seek
+        if seg_frames <= 0 or meta["frame_count"] <= seg_frames:
+            return [
+                VPTask(self._video_path_obj, None, estimate_cost(meta, plan, outputs))
+            ]
+        tasks = []
+        for start in range(0, meta["frame_count"], seg_frames):
+            end = min(start + seg_frames, meta["frame_count"])
+            cost = estimate_cost(meta, replace(plan, start=start, end=end), outputs)
+            tasks.append(VPTask(self._video_path_obj, (start, end), cost))
+        return tasks
+
+    def _get_shard_writer(self) -> ShardWriter:
+        """Helper function that returns the shard writer of the dest folder"""
+
+        return get_shard_writer(
+            vm=self._vm,
+            max_bytes=self._opts.shard_size * 1024 * 1024,
+            max_frames=self._opts.shard_frames,
+        )
+
+    def _create_writer(
+        self, plan: SamplingPlan, profile: VPProfile
+    ) -> Union[FrameWriter, MmapWriter]:
+        """
+        Helper function that creates the writer of the frames preprocessed for an
+        output profile
+        """
+        name = IOVideoManager.get_output_name(self._video_path_obj["name"])
+        if profile.name:
+            name = f"{profile.name}/{name}"
+        if self._opts.output == "mmap":
+            return MmapWriter(
+                vm=self._vm,
+                name=name,
+                capacity=plan.expected_frames(),
+                timings=self._timings,
+            )
+        sink = None
+        if self._opts.output == "tar":
+            sink = self._get_shard_writer()
+        return FrameWriter(
+            vm=self._vm,
+            name=name,
+            img_format=profile.img_format,
+            workers=self._opts.writers,
+            params=IOVideoManager.get_imwrite_params(
+                profile.img_format, profile.png_compression, profile.quality
+            ),
+            sink=sink,
+            timings=self._timings,
+            memory_budget=self._memory_budget,
+        )
+
+    def _get_task_name(self) -> str:
+        """Helper function that returns the name of the video and of its segment"""
+
+        if self._segment is None:
+            return self._video_path_obj["name"]
+        return f"{self._video_path_obj['name']}:{self._segment[0]}-{self._segment[1]}"
+
+    def _get_display_name(self) -> str:
+        """Helper function that returns the name of the video for logging"""
+
+        if self._segment is None:
+            return f"'{self._video_path_obj['name']}'"
+        start, end = self._segment
+        return f"'{self._video_path_obj['name']}' (frames {start}-{end})"
+
+    def _load_progress(self, source: dict) -> Union[dict, None]:
+        """
+        Helper function that loads the manifest entry of the video if it was
+        processed from the same source file with the same options
+        """
+        if self._opts.force:
+            return None
+        entry = self._manifest.load(self._video_path_obj["name"], self._segment)
+        if (
+            entry is None
+            or entry["source"] != source
+            or entry["options"] != self._opts.fingerprint()
+        ):
+            return None
+        return entry
+
+    def _save_progress(
+        self, source: dict, next_frame: Union[int, None], frames: int, done: bool
+    ) -> None:
+        """Helper function that records the progress of the video in the manifest"""
+
+        entry = {
+            "name": self._video_path_obj["name"],
+            "segment": self._segment,
+            "source": source,
+            "options": self._opts.fingerprint(),
+            "next_frame": next_frame,
+            "frames": frames,
+            "done": done,
+        }
+        self._manifest.save(entry, self._video_path_obj["name"], self._segment)
+
+    def _save_stored_progress(
+        self, source: dict, next_frame: Union[int, None], frames: int, done: bool
+    ) -> None:
+        """
+        Helper function that records the progress of the video once the frames
+        written so far are stored: right away for files, once they are in finished
+        shards for tar
+        """
+        if self._opts.output != "tar":
+            self._save_progress(source, next_frame, frames, done)
+            return
+        # The frames in the open shard are lost if the run is killed
+        self._get_shard_writer().on_shard_closed(
+            lambda: self._save_progress(source, next_frame, frames, done)
+        )
+
+    def _open_cache(
+        self, vfs: VideoFileStream, meta: dict, plan: SamplingPlan, cacheable: bool
+    ) -> Tuple[
+        Union[VideoFileStream, CachedVideoStream],
+        Union[FrameCacheWriter, None],
+        Union[bool, None],
+    ]:
+        """
+        Helper function that replaces the stream with the cached frames of the video
+        when they are cached, or otherwise returns a writer caching the decoded
+        frames if 'cacheable'. The last value tells if the cache was hit, 'None'
+        without cache.
+        """
+        if self._cache is None:
+            return vfs, None, None
+        key = FrameCache.get_key(self._video_path_obj["path"], plan)
+        cached = self._cache.open(key, self._opts.batch_size)
+        if cached is not None:
+            # Replays the decoded frames instead of decoding the video
+            vfs.close()
+            return cached, None, True
+        if not cacheable:
+            return vfs, None, False
+        return vfs, self._cache.create(key, meta, plan), False
 
-    def _to_grayscale(self, img: np.array) -> np.array:
-        """Converts an image to grayscale"""
-        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    def _open_stream(self, start: Union[int, None], cacheable: bool) -> Tuple[
+        Union[VideoFileStream, CachedVideoStream],
+        SamplingPlan,
+        Union[FrameCacheWriter, None],
+        Union[bool, None],
+    ]:
+        """
+        Helper function that opens the video (or its cached frames) and compiles
+        the preprocessing plans of the output profiles, see '_open_cache'. The video
+        is released if it fails.
+        """
+        vfs = self._create_stream(start)
+        try:
+            meta = vfs.get_metadata()
+            plan = vfs.get_sampling_plan()
+            # Fails before decoding anything if the options do not fit the video
+            self._plans = [
+                self._compile_plan(meta, p) for p in self._opts.get_profiles()
+            ]
+            stream, cache_writer, cache_hit = self._open_cache(
+                vfs, meta, plan, cacheable
+            )
+        except BaseException:
+            vfs.close()
+            raise
+        return stream, plan, cache_writer, cache_hit
+
+    def _close_cache_writer(self, cache_writer: FrameCacheWriter, commit: bool) -> None:
+        """
+        Helper function that commits (or discards) the cached frames of the video. A
+        failing cache never fails the video.
+        """
+        try:
+            if commit:
+                cache_writer.commit()
+            else:
+                cache_writer.discard()
+        except Exception as e:
+            logger.warning(
+                f"Could not cache the frames of video {self._get_display_name()}: {e}"
+            )
+
+    def _start_dedup(self, append: bool) -> None:
+        """
+        Helper function that starts dropping the duplicate frames when requested, and
+        opens the 'name.dropped.csv' sidecar listing them (appending to it when the
+        video is resumed)
+        """
+        if self._opts.dedup is None:
+            return
+        name = IOVideoManager.get_output_name(self._video_path_obj["name"])
+        if self._segment is not None:
+            name += f".{self._segment[0]}-{self._segment[1]}"
+        path = self._vm.get_save_path(Path(f"{name}.dropped.csv"))
+        self._vm.makedirs(path)
+        # Line buffered so that the rows are on disk when the progress is saved
+        self._dropped_file = open(path, "a" if append else "w", newline="", buffering=1)
+        self._dropped_csv = csv.writer(self._dropped_file)
+        if self._dropped_file.tell() == 0:
+            self._dropped_csv.writerow(["frame", "source_frame", "timestamp_ms"])
+        # Only set once the sidecar is open, which is then closed with the video
+        self._dedup = FrameDeduplicator(self._opts.dedup)
 
-    def _resize(self, img: np.array, w: int, h: int) -> np.array:
-        """Resizes an image"""
-        return cv2.resize(img, (w, h))
+    def _drop_duplicates(
+        self,
+        numbers: Sequence[int],
+        idxs: List[int],
+        timestamps: List[float],
+        frames: np.array,
+    ) -> Union[Tuple[Sequence[int], List[int], List[float], np.array], None]:
+        """
+        Helper function that drops the duplicate frames of a batch. Returns 'None'
+        when every frame is dropped.
+        """
+        if self._dedup is None:
+            return numbers, idxs, timestamps, frames
+        t = time.monotonic()
+        keep = self._dedup.filter_batch(frames)
+        self._add_timing("dedup", t, len(frames), frames.nbytes)
+        if keep is None:
+            return numbers, idxs, timestamps, frames
+        batch = list(zip(numbers, idxs, timestamps))
+        dropped = [b for b, k in zip(batch, keep) if not k]
+        if self._dropped_csv is not None:
+            self._dropped_csv.writerows(dropped)
+        self._dropped += len(dropped)
+        self._unreported["dropped"] += len(dropped)
+        if not keep.any():
+            return None
+        numbers, idxs, timestamps = zip(*(b for b, k in zip(batch, keep) if k))
+        # Duplicates are dropped before the preprocessing and the encoding
+        return numbers, list(idxs), list(timestamps), frames[keep]
+
+    def _apply_plan(self, plan: PreprocessPlan, frames: np.array) -> np.array:
+        """Helper function that preprocesses a batch of frames with a plan"""
+
+        if self._preprocessed:
+            return frames
+        t = time.monotonic()
+        images = plan.apply_batch(frames)
+        self._add_timing("preprocess", t, len(images), images.nbytes)
+        return images
+
+    def _preprocess_batch(
+        self,
+        numbers: Sequence[int],
+        idxs: List[int],
+        timestamps: List[float],
+        frames: np.array,
+    ) -> Union[FrameBatch, None]:
+        """
+        Helper function that drops the duplicate frames of a batch and preprocesses
+        the others. Returns 'None' when every frame is dropped.
+        """
+        kept = self._drop_duplicates(numbers, idxs, timestamps, frames)
+        if kept is None:
+            return None
+        numbers, idxs, timestamps, frames = kept
+        return FrameBatch(
+            videos=[self._video_path_obj["name"]] * len(idxs),
+            numbers=list(numbers),
+            source_frames=list(idxs),
+            timestamps=list(timestamps),
+            frames=self._apply_plan(self._plans[0], frames),
+        )
 
-    def _crop(
+    def _write_batch(
         self,
-        img: np.array,
-        cxmin: int,
-        cxmax: int,
-        cymin: int,
-        cymax: int,
-    ) -> np.array:
-        """Crops an image"""
-        return img[cymin:cymax, cxmin:cxmax]
+        writers: List[Union[FrameWriter, MmapWriter]],
+        numbers: Sequence[int],
+        idxs: List[int],
+        timestamps: List[float],
+        frames: np.array,
+    ) -> int:
+        """
+        Helper function that drops the duplicate frames of a batch, then preprocesses
+        and saves the others for each output profile. Returns the number of saved
+        frames.
+        """
+        kept = self._drop_duplicates(numbers, idxs, timestamps, frames)
+        if kept is None:
+            return 0
+        numbers, idxs, timestamps, frames = kept
+        # The frames are decoded once and preprocessed for each profile
+        for plan, writer in zip(self._plans, writers):
+            images = self._apply_plan(plan, frames)
+            writer.write_batch(numbers, images, idxs, timestamps)
+        return len(idxs) * len(writers)
+
+    def _start_metrics(self, plan: SamplingPlan) -> None:
+        """Helper function that tells the metrics that the video started"""
+
+        if self._metrics is not None:
+            self._metrics.start_video(
+                get_worker_id(), self._get_task_name(), plan.expected_frames()
+            )
+
+    def _update_metrics(
+        self,
+        vfs: Union[VideoFileStream, CachedVideoStream],
+        writers: List[Union[FrameWriter, MmapWriter]],
+        decoded: int,
+        written: int,
+        force=False,
+    ) -> None:
+        """
+        Helper function that sends the progress of the video to the metrics, at most
+        every 'METRICS_UPDATE_INTERVAL' seconds unless 'force'
+        """
+        if self._metrics is None:
+            return
+        self._unreported["decoded"] += decoded
+        self._unreported["written"] += written
+        now = time.monotonic()
+        if not force and now - self._last_metrics_update < METRICS_UPDATE_INTERVAL:
+            return
+        self._metrics.update_video(
+            get_worker_id(),
+            decode_queue=vfs.get_queue_depth(),
+            write_queue=sum(w.get_queue_depth() for w in writers),
+            **self._unreported,
+        )
+        self._unreported = {"decoded": 0, "written": 0, "dropped": 0}
+        self._last_metrics_update = now
+
+    def _add_timing(self, stage: str, start: float, frames=0, nbytes=0) -> None:
+        """Helper function that records a stage started at 'start' when timing"""
+
+        if self._timings is not None:
+            self._timings.add(stage, time.monotonic() - start, frames, nbytes)
+
+    def _get_stop_reason(self) -> Union[str, None]:
+        """
+        Helper function that checks if the processing was asked to stop, or lost
+        its lease, and returns why
+        """
+        if self._stop_event is not None and self._stop_event.is_set():
+            return "Stopped"
+        if self._lease is not None and self._lease.lost:
+            return "Lost the lease of the video to another worker"
+        return None
+
+    def _compile_plan(
+        self, metadata: dict, profile: Union[VPProfile, None] = None
+    ) -> PreprocessPlan:
+        """
+        Compiles the preprocessing options of an output profile (the first one by
+        default) for the video metadata. Raises a 'ValueError' if the options are
+        not valid for the video.
+        """
+        profile = profile or self._opts.get_profiles()[0]
+        return PreprocessPlan(
+            src_w=metadata["w"],
+            src_h=metadata["h"],
+            gray=profile.gray,
+            width=profile.width,
+            height=profile.height,
+            cxmin=profile.cxmin,
+            cxmax=profile.cxmax,
+            cymin=profile.cymin,
+            cymax=profile.cymax,
+        )
 
     def _preprocess_frame(self, frame: np.array, metadata: dict) -> np.array:
         """Preprocess a frame with the given argument options"""
 
-        new_frame = frame.copy()
-        w = metadata["w"]
-        h = metadata["h"]
-        if self._opts.gray:
-            new_frame = self._to_grayscale(new_frame)
-        if self._opts.width or self._opts.height:
-            w = self._opts.width or w
-            h = self._opts.height or h
-            new_frame = self._resize(new_frame, w, h)
-        if self._opts.cxmin or self._opts.cxmax or self._opts.cymin or self._opts.cymax:
-            cxmn = self._opts.cxmin
-            cxmx = self._opts.cxmax
-            cymn = self._opts.cymin
-            cymx = self._opts.cymax
-
-            vx, mx = ArgParser.validate_crop_axis(cxmn, cxmx, w, "x")
-            vy, my = ArgParser.validate_crop_axis(cymn, cymx, h, "y")
-
-            if all([vx, vy]):
-                new_frame = self._crop(
-                    new_frame,
-                    cxmn or 0,
-                    cxmx or w,
-                    cymn or 0,
-                    cymx or h,
-                )
-            else:
-                for m in [mx, my]:
-                    logger.error(m)
-                exit(1)
+        if not self._plans:
+            self._plans = [self._compile_plan(metadata)]
+        t = time.monotonic()
+        image = self._plans[0].apply(frame)
+        self._add_timing("preprocess", t, 1, image.nbytes)
+        return image
+
+    def _start(
+        self,
+        vfs: Union[VideoFileStream, CachedVideoStream],
+        plan: SamplingPlan,
+        cache_writer: Union[FrameCacheWriter, None],
+        writers: List[Union[FrameWriter, MmapWriter]],
+        append: bool,
+    ) -> None:
+        """
+        Helper function that creates the writers of the profiles and starts the
+        decoding. The writers are added to 'writers' as they are created, so that
+        the ones created before a failing one are closed with the video.
+        """
+        # The decoder preprocesses the frames if it can, unless they are cached or
+        # shared by several profiles
+        self._preprocessed = (
+            cache_writer is None
+            and len(self._plans) == 1
+            and vfs.push_preprocessing(self._plans[0])
+        )
+        for p in self._opts.get_profiles():
+            writers.append(self._create_writer(plan, p))
+        self._start_dedup(append)
+
+        vfs.start()
+        self._start_metrics(plan)
 
-        return new_frame
+    def iter_batches(self) -> Iterator[FrameBatch]:
+        """
+        Yields the preprocessed frames of the video (or segment) by the batches of
+        'batch_size' frames it decodes, without saving them. The duplicates are
+        dropped and the frame cache is used like when processing the video. Raises
+        a 'ValueError' with several output profiles.
+        """
+        if len(self._opts.get_profiles()) > 1:
+            raise ValueError("The frames can only be iterated for 1 output profile")
+        vfs, plan, cache_writer, _ = self._open_stream(None, True)
+        count = plan.first_number()
+        complete = False
+        try:
+            self._preprocessed = cache_writer is None and vfs.push_preprocessing(
+                self._plans[0]
+            )
+            if self._opts.dedup is not None:
+                self._dedup = FrameDeduplicator(self._opts.dedup)
+
+            vfs.start()
+            for idxs, timestamps, frames in vfs:
+                if self._get_stop_reason() is not None:
+                    return
+                if cache_writer is not None:
+                    cache_writer.write_batch(idxs, timestamps, frames)
+                numbers = range(count, count + len(idxs))
+                count += len(idxs)
+                batch = self._preprocess_batch(numbers, idxs, timestamps, frames)
+                if batch is not None:
+                    yield batch
+            complete = True
+        finally:
+            vfs.close()
+            # The frames are only cached when the whole video was read
+            if cache_writer is not None:
+                self._close_cache_writer(cache_writer, complete)
 
-    def process(self) -> None:
+    def process(self) -> VPResult:
         """Processes the video file path"""
 
-        if not self._opts.silent:
-            logger.info(f"Processing video '{self._video_path_obj['name']}'...")
-        vfs = VideoFileStream(
-            path=self._video_path_obj["path"].as_posix(), fps=self._opts.fps
-        )
-        meta = vfs.get_metadata()
+        source = ProcessingManifest.get_source_identity(self._video_path_obj["path"])
+        progress = self._load_progress(source)
+        if progress is not None and progress["done"]:
+            if not self._opts.silent:
+                logger.info(
+                    f"Skipping video {self._get_display_name()} (already processed)"
+                )
+            return VPResult(
+                name=self._video_path_obj["name"], segment=self._segment, skipped=True
+            )
 
-        vfs.start()
-        # Allow the buffer to start to fill
-        time.sleep(1.0)
-
-        count = 0
-        while vfs.more():
-            frame = vfs.read()
-            # Saves the frames with frame-count
-            folder_name = self._video_path_obj["name"].replace(".", "_")
-            save_path = Path(f"{folder_name}/frame_{count}.png")
-            self._vm.save_img(save_path, self._preprocess_frame(frame, meta))
-            count += 1
-        if not self._opts.silent:
-            logger.success(
-                f"Finished processing video '{self._video_path_obj['name']}'"
+        # Only frames saved as files or into shards can be resumed, the arrays of
+        # mmap are rewritten
+        resumable = self._opts.output != "mmap"
+        start = None
+        done_frames = 0
+        if progress is not None and resumable:
+            start = progress["next_frame"]
+            done_frames = progress["frames"]
+            if not self._opts.silent:
+                logger.info(
+                    f"Resuming video {self._get_display_name()} from frame {start}..."
+                )
+        elif not self._opts.silent:
+            logger.info(f"Processing video {self._get_display_name()}...")
+        vfs, plan, cache_writer, cache_hit = self._open_stream(start, start is None)
+        # Frames are numbered in the whole video so that segments do not overlap
+        count = plan.first_number()
+        written = 0
+        error = None
+        writers = []
+        try:
+            self._start(vfs, plan, cache_writer, writers, append=start is not None)
+            last_checkpoint = time.monotonic()
+            for idxs, timestamps, frames in vfs:
+                error = self._get_stop_reason()
+                if error is not None:
+                    break
+                if cache_writer is not None:
+                    cache_writer.write_batch(idxs, timestamps, frames)
+                # Saves the frames with frame-count
+                numbers = range(count, count + len(idxs))
+                n = self._write_batch(writers, numbers, idxs, timestamps, frames)
+                self._update_metrics(vfs, writers, len(idxs), n)
+                written += n
+                count += len(idxs)
+                if (
+                    resumable
+                    and time.monotonic() - last_checkpoint
+                    >= MANIFEST_CHECKPOINT_INTERVAL
+                ):
+                    # The progress is only recorded once the frames are on disk
+                    if not any([w.flush() for w in writers]):
+                        self._save_stored_progress(
+                            source, idxs[-1] + 1, done_frames + written, False
+                        )
+                    last_checkpoint = time.monotonic()
+        except BaseException:
+            if cache_writer is not None:
+                self._close_cache_writer(cache_writer, False)
+                cache_writer = None
+            raise
+        finally:
+            vfs.close()
+            # Wait for the queued frames to be saved
+            write_errors = [e for w in writers for e in w.close()]
+            if self._dedup is not None:
+                self._dropped_file.close()
+        self._update_metrics(vfs, writers, 0, 0, force=True)
+
+        if write_errors:
+            written -= len(write_errors)
+            error = (
+                f"{len(write_errors)} frame(s) could not be saved: {write_errors[0]}"
             )
+        if cache_writer is not None:
+            self._close_cache_writer(cache_writer, error is None)
+        if error is None:
+            self._save_stored_progress(source, None, done_frames + written, True)
+            if not self._opts.silent:
+                logger.success(f"Finished processing video {self._get_display_name()}")
+        return VPResult(
+            name=self._video_path_obj["name"],
+            frames=written,
+            error=error,
+            segment=self._segment,
+            cache_hit=cache_hit,
+            dropped=self._dropped,
+            timings=self._timings.to_dict() if self._timings is not None else None,
+            queue_stats=vfs.get_queue_stats() if self._timings is not None else None,
+        )
@@ -1,29 +1,73 @@
 from pathlib import Path
 import sys
 
-from variables import IMAGE_NAME, MOUNT_IMAGE_DEST, MOUNT_IMAGE_SRC
+from variables import (
+    IMAGE_NAME,
+    MOUNT_IMAGE_CACHE,
+    MOUNT_IMAGE_DEST,
+    MOUNT_IMAGE_FILES_FROM,
+    MOUNT_IMAGE_SRC,
+    SERVER_CONTAINER_NAME,
+)
 from utils.arg_parser import ArgParser
 from utils.command_utils import check_docker_installed, run_cmd
+from utils.job_client import submit_job
 
 
 def main() -> None:
     """Main function to run the docker container with the arguments"""
 
-    check_docker_installed()
     args = ArgParser().parse_args()
-    # Remove the file name arg and replace it with the image src mount
+    # The job is run by the container of the server
+    if args.submit:
+        exit(submit_job(sys.argv[1:], args))
+    check_docker_installed()
     new_args = sys.argv[1:].copy()
-    new_args[new_args.index("-s") + 1] = MOUNT_IMAGE_SRC
+    src = Path(args.src).absolute().as_posix()
+    dest = Path(args.dest).absolute().as_posix()
+    if args.serve:
+        # The folders are mounted at their own paths so that the jobs can give the
+        # paths of their sub folders
+        new_args[new_args.index("-s") + 1] = src
+        if "-d" in new_args:
+            new_args[new_args.index("-d") + 1] = dest
+        else:
+            new_args += ["-d", dest]
+        docker_args = f"-v {src}:{src} -v {dest}:{dest}"
+        # Only the jobs of this host can be submitted
+        docker_args += f" -p 127.0.0.1:{args.server_port}:{args.server_port}"
+    else:
+        # Remove the file name arg and replace it with the image src mount
+        new_args[new_args.index("-s") + 1] = MOUNT_IMAGE_SRC
 
-    # Run docker docker (image='IMAGE_NAME') and mount 2 volumes
-    # The first volume allows the container to read the src folder
-    # The second volume allows the container to write the dest folder
-    vol1_mount = f"{Path(args.src).absolute().as_posix()}:{MOUNT_IMAGE_SRC}"
-    vol2_mount = f"{Path(args.dest).absolute().as_posix()}:{MOUNT_IMAGE_DEST}"
-    full_cmd = (
-        f"docker run {'-it' if not args.no_input else ''} --rm "
-        f"-v {vol1_mount} -v {vol2_mount} {IMAGE_NAME} "
-    ) + " ".join(new_args)
+        # Run docker docker (image='IMAGE_NAME') and mount 2 volumes
+        # The first volume allows the container to read the src folder
+        # The second volume allows the container to write the dest folder
+        docker_args = f"-v {src}:{MOUNT_IMAGE_SRC} -v {dest}:{MOUNT_IMAGE_DEST}"
+    # The frame cache outlives the container, so it is mounted as well
+    if args.cache_dir is not None:
+        Path(args.cache_dir).mkdir(parents=True, exist_ok=True)
+        new_args[new_args.index("--cache-dir") + 1] = MOUNT_IMAGE_CACHE
+        docker_args += (
+            f" -v {Path(args.cache_dir).absolute().as_posix()}:{MOUNT_IMAGE_CACHE}"
+        )
+    # The metrics are served from the container, to this host only
+    if args.metrics_port is not None:
+        docker_args += f" -p 127.0.0.1:{args.metrics_port}:{args.metrics_port}"
+    # The list of videos is mounted, or piped to the container when read from stdin
+    tty = "-it" if not args.no_input else ""
+    if args.serve:
+        # The server runs in the background until 'docker stop'
+        tty = f"-d --name {SERVER_CONTAINER_NAME}"
+    elif args.files_from == "-":
+        tty = "-i"
+    elif args.files_from is not None:
+        new_args[new_args.index("--files-from") + 1] = MOUNT_IMAGE_FILES_FROM
+        docker_args += (
+            f" -v {Path(args.files_from).absolute().as_posix()}"
+            f":{MOUNT_IMAGE_FILES_FROM}:ro"
+        )
+    full_cmd = f"docker run {tty} --rm {docker_args} {IMAGE_NAME} {' '.join(new_args)}"
     run_cmd(full_cmd)
 
 
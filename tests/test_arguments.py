@@ -58,9 +58,45 @@ class TestArguments(unittest.TestCase):
         self.assertEqual(args.cxmax, None)
         self.assertEqual(args.cymin, None)
         self.assertEqual(args.cymax, None)
+        self.assertEqual(args.sampling, "auto")
+        self.assertEqual(args.segment_duration, None)
+        self.assertEqual(args.batch_size, 1)
         self.assertEqual(args.gray, False)
+        self.assertEqual(args.output, "files")
+        self.assertEqual(args.shard_size, 1024)
+        self.assertEqual(args.shard_frames, 10000)
+        self.assertEqual(args.format, "png")
+        self.assertEqual(args.png_compression, None)
+        self.assertEqual(args.quality, None)
+        self.assertEqual(args.dedup, None)
+        self.assertEqual(args.output_profiles, None)
         self.assertEqual(args.silent, False)
         self.assertEqual(args.threads, 4)
+        self.assertEqual(args.executor, "thread")
+        self.assertEqual(args.writers, 2)
+        self.assertEqual(args.prefetch, 128)
+        self.assertEqual(args.cache_dir, None)
+        self.assertEqual(args.cache_size, 10240)
+        self.assertEqual(args.report, False)
+        self.assertEqual(args.profile, False)
+        self.assertEqual(args.metrics, False)
+        self.assertEqual(args.metrics_port, None)
+        self.assertEqual(args.recursive, False)
+        self.assertEqual(args.include, None)
+        self.assertEqual(args.exclude, None)
+        self.assertEqual(args.files_from, None)
+        self.assertEqual(args.watch, False)
+        self.assertEqual(args.watch_interval, 2.0)
+        self.assertEqual(args.schedule, "longest")
+        self.assertEqual(args.max_memory, None)
+        self.assertEqual(args.decoder, "opencv")
+        self.assertEqual(args.decoder_threads, 0)
+        self.assertEqual(args.distributed, False)
+        self.assertEqual(args.lease_ttl, 60.0)
+        self.assertEqual(args.serve, False)
+        self.assertEqual(args.submit, False)
+        self.assertEqual(args.server_port, 8765)
+        self.assertEqual(args.force, False)
         self.assertEqual(args.no_input, False)
 
     def test_types(self) -> None:
@@ -77,9 +113,45 @@ class TestArguments(unittest.TestCase):
         self.assertTypeEqual(args.cxmax, type(None))
         self.assertTypeEqual(args.cymin, type(None))
         self.assertTypeEqual(args.cymax, type(None))
+        self.assertTypeEqual(args.sampling, str)
+        self.assertTypeEqual(args.segment_duration, type(None))
+        self.assertTypeEqual(args.batch_size, int)
         self.assertTypeEqual(args.gray, bool)
+        self.assertTypeEqual(args.output, str)
+        self.assertTypeEqual(args.shard_size, int)
+        self.assertTypeEqual(args.shard_frames, int)
+        self.assertTypeEqual(args.format, str)
+        self.assertTypeEqual(args.png_compression, type(None))
+        self.assertTypeEqual(args.quality, type(None))
+        self.assertTypeEqual(args.dedup, type(None))
+        self.assertTypeEqual(args.output_profiles, type(None))
         self.assertTypeEqual(args.silent, bool)
         self.assertTypeEqual(args.threads, int)
+        self.assertTypeEqual(args.executor, str)
+        self.assertTypeEqual(args.writers, int)
+        self.assertTypeEqual(args.prefetch, int)
+        self.assertTypeEqual(args.cache_dir, type(None))
+        self.assertTypeEqual(args.cache_size, int)
+        self.assertTypeEqual(args.report, bool)
+        self.assertTypeEqual(args.profile, bool)
+        self.assertTypeEqual(args.metrics, bool)
+        self.assertTypeEqual(args.metrics_port, type(None))
+        self.assertTypeEqual(args.recursive, bool)
+        self.assertTypeEqual(args.include, type(None))
+        self.assertTypeEqual(args.exclude, type(None))
+        self.assertTypeEqual(args.files_from, type(None))
+        self.assertTypeEqual(args.watch, bool)
+        self.assertTypeEqual(args.watch_interval, float)
+        self.assertTypeEqual(args.schedule, str)
+        self.assertTypeEqual(args.max_memory, type(None))
+        self.assertTypeEqual(args.decoder, str)
+        self.assertTypeEqual(args.decoder_threads, int)
+        self.assertTypeEqual(args.distributed, bool)
+        self.assertTypeEqual(args.lease_ttl, float)
+        self.assertTypeEqual(args.serve, bool)
+        self.assertTypeEqual(args.submit, bool)
+        self.assertTypeEqual(args.server_port, int)
+        self.assertTypeEqual(args.force, bool)
         self.assertTypeEqual(args.no_input, bool)
 
     def test_size_types(self) -> None:
@@ -116,6 +188,12 @@ class TestArguments(unittest.TestCase):
             "width",
             "height",
             "threads",
+            "segment-duration",
+            "shard-size",
+            "shard-frames",
+            "batch-size",
+            "cache-size",
+            "prefetch",
         ]
 
         for n in arg_names:
@@ -136,6 +214,7 @@ class TestArguments(unittest.TestCase):
             "cxmax",
             "cymin",
             "cymax",
+            "writers",
         ]
 
         for n in arg_names:
@@ -152,6 +231,124 @@ class TestArguments(unittest.TestCase):
             except SystemExit:
                 self.assertEqual("", f"FAILED TEST with args: {args}")
 
+    def test_sampling_validation(self) -> None:
+        """Test that only the known sampling modes are accepted"""
+
+        for mode in ["auto", "grab", "seek"]:
+            args = self.parse_args(self.default_args + ["--sampling", mode])
+            self.assertEqual(args.sampling, mode)
+
+        self.assertRaisesSysExit(
+            lambda: self.parse_args(self.default_args + ["--sampling", "skip"]), 2
+        )
+
+    def test_encoding_validation(self) -> None:
+        """Test that the encoding arguments must be in their range"""
+
+        valid_args = [
+            ["--format", "jpg", "--quality", "0"],
+            ["--format", "webp", "--quality", "100"],
+            ["--png-compression", "0"],
+            ["--png-compression", "9"],
+        ]
+        invalid_args = [
+            ["--quality", "-1"],
+            ["--quality", "101"],
+            ["--png-compression", "-1"],
+            ["--png-compression", "10"],
+        ]
+
+        for a in valid_args:
+            self.parse_args(self.default_args + a)
+        for a in invalid_args:
+            self.assertRaisesSysExit(lambda: self.parse_args(self.default_args + a), 1)
+        self.assertRaisesSysExit(
+            lambda: self.parse_args(self.default_args + ["--format", "gif"]), 2
+        )
+
+    def test_dedup_validation(self) -> None:
+        """Test that the dedup threshold must be between 0 and 255"""
+
+        for t in ["0", "2.5", "255"]:
+            args = self.parse_args(self.default_args + ["--dedup", t])
+            self.assertEqual(args.dedup, float(t))
+        for t in ["-1", "256"]:
+            self.assertRaisesSysExit(
+                lambda: self.parse_args(self.default_args + ["--dedup", t]), 1
+            )
+
+    def test_mmap_output_validation(self) -> None:
+        """Test that the mmap output cannot be split into segments"""
+
+        self.parse_args(self.default_args + ["--output", "mmap"])
+        self.assertRaisesSysExit(
+            lambda: self.parse_args(
+                self.default_args + ["--output", "mmap", "--segment-duration", "10"]
+            ),
+            1,
+        )
+
+    def test_distributed_validation(self) -> None:
+        """Test that distributed runs can neither force the videos nor write shards"""
+
+        self.parse_args(self.default_args + ["--distributed"])
+        for a in [["--force"], ["--output", "tar"]]:
+            self.assertRaisesSysExit(
+                lambda: self.parse_args(self.default_args + ["--distributed"] + a), 1
+            )
+
+    def test_watch_validation(self) -> None:
+        """Test that a watched source folder cannot be replaced by a list of videos"""
+
+        self.parse_args(self.default_args + ["--watch", "--watch-interval", "0.5"])
+        self.assertRaisesSysExit(
+            lambda: self.parse_args(
+                self.default_args + ["--watch", "--files-from", "videos.txt"]
+            ),
+            1,
+        )
+        self.assertRaisesSysExit(
+            lambda: self.parse_args(self.default_args + ["--watch-interval", "0"]), 1
+        )
+
+    def test_server_validation(self) -> None:
+        """Test that a run cannot both start the server and submit a job to it"""
+
+        self.parse_args(self.default_args + ["--serve", "--server-port", "9000"])
+        invalid_args = [
+            ["--serve", "--submit"],
+            ["--serve", "--watch"],
+            ["--submit", "--output", "tar"],
+            ["--submit", "--server-port", "0"],
+        ]
+        for a in invalid_args:
+            self.assertRaisesSysExit(lambda: self.parse_args(self.default_args + a), 1)
+
+    def test_output_profile_validation(self) -> None:
+        """Test that the output profiles are parsed and validated"""
+
+        args = self.parse_args(
+            self.default_args
+            + ["-g", "--output-profile", "small:width=224,height=224,gray=false"]
+            + ["--output-profile", "thumb:width=64,height=64,format=jpg"]
+        )
+        small = ArgParser.parse_output_profile(args.output_profiles[0], args)
+        thumb = ArgParser.parse_output_profile(args.output_profiles[1], args)
+        self.assertEqual((small["width"], small["gray"]), (224, False))
+        self.assertEqual((thumb["img_format"], thumb["gray"]), ("jpg", True))
+
+        invalid_args = [
+            ["--output-profile", "a", "--output-profile", "a"],
+            ["--output-profile", "a/b"],
+            ["--output-profile", "a:size=10"],
+            ["--output-profile", "a:width=ten"],
+            ["--output-profile", "a:width=0"],
+            ["--output-profile", "a:format=gif"],
+            ["--output-profile", "a:width=100,cxmax=150"],
+        ]
+        for a in invalid_args:
+            self.assertRaisesSysExit(lambda: self.parse_args(self.default_args + a), 1)
+
     def get_crop_args(self, axis_repr: str) -> Tuple[List[str], List[str]]:
         """Helper function for getting all the cases for the the crop arguments"""
 
@@ -1,8 +1,26 @@
 import unittest
+from unittest import mock
+import json
 import os
+from pathlib import Path
 import shutil
+import signal
+import subprocess
+import tarfile
+import threading
+import time
 import cv2
+import numpy as np
 
+from processing.folder_watcher import FolderWatcher
+from processing.frame_iterator import iter_batches, iter_frames
+from processing.io_video_manager import IOVideoManager
+from processing.lease import LeaseManager
+from processing.memory_budget import MemoryBudget
+from processing.scheduler import VPTask, schedule
+from processing.shard_writer import ShardWriter
+from processing.video_file_stream import VideoFileStream
+from processing.video_preprocessor import VPOptions, VideoPreprocessor
 from utils.command_utils import run_cmd
 from variables import IS_DOCKER
 
@@ -57,6 +75,555 @@ class TestProcessing(unittest.TestCase):
             run_cmd(self.default_cmd + " -f 100")
             self.assertEqual(len(os.listdir(self.blank_2s_save_path)), 60)
 
+    def test_seek_sampling(self):
+        """Test that seeking to the kept frames keeps the same frames as grabbing"""
+
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 1 --sampling seek")
+            self.assertEqual(len(os.listdir(self.blank_2s_save_path)), 2)
+
+    def test_process_executor(self):
+        """Test that the process pool produces the same frames as the thread pool"""
+
+        if not self.ON_GITHUB_CI:
+            code = run_cmd(self.default_cmd + " -f 10 --executor process")
+            self.assertEqual(code, 0)
+            self.assertEqual(len(os.listdir(self.blank_2s_save_path)), 20)
+
+    def test_segments(self):
+        """
+        Test that splitting the video into segments produces the same frames as a
+        sequential run
+        """
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 10 --segment-duration 1")
+            self.assertEqual(
+                sorted(os.listdir(self.blank_2s_save_path)),
+                sorted(f"frame_{i}.png" for i in range(20)),
+            )
+
+    def test_inline_writers(self):
+        """Test that saving the frames inline saves the same frames"""
+
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 10 --writers 0")
+            self.assertEqual(len(os.listdir(self.blank_2s_save_path)), 20)
+
+    def test_jpg_format(self):
+        """Test that the frames are saved with the requested format"""
+
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 1 --format jpg --quality 95")
+            self.assertEqual(
+                sorted(os.listdir(self.blank_2s_save_path)),
+                ["frame_0.jpg", "frame_1.jpg"],
+            )
+
+    def test_npy_format(self):
+        """Test that the raw frames are saved when requesting npy"""
+
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 1 --format npy -g")
+            for p in os.listdir(self.blank_2s_save_path):
+                frame = np.load(os.path.join(self.blank_2s_save_path, p))
+                self.assertEqual(frame.shape, (self.blank_2s_h, self.blank_2s_w))
+
+    def test_mmap_output(self):
+        """Test that the frames are packed into a single array with an index"""
+
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 10 --output mmap --width 64 --height 32")
+            frames = np.load(self.blank_2s_save_path + ".npy", mmap_mode="r")
+            self.assertEqual(frames.shape, (20, 32, 64, 3))
+            with open(self.blank_2s_save_path + ".index.csv") as f:
+                rows = f.read().splitlines()
+            self.assertEqual(rows[0], "frame,source_frame,timestamp_ms")
+            self.assertEqual(
+                [r.split(",")[1] for r in rows[1:]], [str(i * 3) for i in range(20)]
+            )
+
+    def test_tar_output(self):
+        """Test that the frames are streamed into shards of bounded frame count"""
+
+        if not self.ON_GITHUB_CI:
+            # Left unfinished by an interrupted run
+            shards_dir = os.path.join(self.out_dir, "shards")
+            os.makedirs(shards_dir)
+            with open(os.path.join(shards_dir, "old-000000.tar.part"), "wb") as f:
+                f.write(b"partial")
+            run_cmd(self.default_cmd + " -f 10 --output tar --shard-frames 8")
+            self.assertFalse(any(p.endswith(".part") for p in os.listdir(shards_dir)))
+            shards = sorted(p for p in os.listdir(shards_dir) if p.endswith(".tar"))
+            self.assertEqual(len(shards), 3)
+            names = []
+            for s in shards:
+                with tarfile.open(os.path.join(shards_dir, s)) as tar:
+                    names += tar.getnames()
+                self.assertTrue(os.path.isfile(os.path.join(shards_dir, s + ".json")))
+            self.assertEqual(
+                sorted(names),
+                sorted(f"blank_2s_30fps_mp4/frame_{i}.png" for i in range(20)),
+            )
+
+        if not self.ON_GITHUB_CI and not IS_DOCKER:
+            # A video is only done once the shard holding its frames is finished
+            vm = IOVideoManager(Path(self.src_dir), Path(self.out_dir))
+            sw = ShardWriter(vm, max_bytes=1 << 20, max_frames=8)
+            done = []
+            sw.on_shard_closed(lambda: done.append("empty"))
+            self.assertEqual(done, ["empty"])
+            sw.save_img(Path("a/frame_0.npy"), np.zeros((2, 2), np.uint8))
+            sw.on_shard_closed(lambda: done.append("a"))
+            self.assertEqual(done, ["empty"])
+            sw.close()
+            self.assertEqual(done, ["empty", "a"])
+
+    def test_crop_outside_video(self):
+        """
+        Test that a crop that does not fit the video fails the video before any
+        frame is saved
+        """
+        if not self.ON_GITHUB_CI:
+            code = run_cmd(self.default_cmd + " -f 1 --cxmax 5000")
+            self.assertEqual(code, 1)
+            self.assertFalse(os.path.isdir(self.blank_2s_save_path))
+
+    def test_invalid_video(self):
+        """Test that a file that cannot be opened fails and is not recorded as done"""
+
+        if not self.ON_GITHUB_CI:
+            src_dir = os.path.join(self.out_dir, "src")
+            dest_dir = os.path.join(self.out_dir, "frames")
+            os.makedirs(src_dir)
+            with open(os.path.join(src_dir, "bad.mp4"), "wb") as f:
+                f.write(b"junk!")
+            cmd = self.default_cmd.replace(f"-d '{self.out_dir}'", f"-d '{dest_dir}'")
+            cmd = cmd.replace(f"-s '{self.src_dir}'", f"-s '{src_dir}'")
+            self.assertEqual(run_cmd(cmd + " -f 1"), 1)
+            self.assertFalse(os.path.isdir(os.path.join(dest_dir, "bad_mp4")))
+            self.assertFalse(os.path.exists(os.path.join(dest_dir, ".manifest")))
+
+    def test_setup_error(self):
+        """
+        Test that a video failing before its first frame stops the writers already
+        created
+        """
+        if not self.ON_GITHUB_CI and not IS_DOCKER:
+            vm = IOVideoManager(Path(self.src_dir), Path(self.out_dir))
+            video = vm.get_video_paths()[0]
+            # The sidecar of the dropped frames cannot be opened
+            os.makedirs(self.blank_2s_save_path + ".dropped.csv")
+            threads = threading.active_count()
+            pp = VideoPreprocessor(
+                vm, video, Path(self.out_dir), VPOptions(fps=1, dedup=1, silent=True)
+            )
+            self.assertRaises(IsADirectoryError, pp.process)
+            self.assertEqual(threading.active_count(), threads)
+
+    def test_batches(self):
+        """
+        Test that batches that do not divide the number of frames save the same
+        frames
+        """
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 10 -g --width 64 --batch-size 8")
+            self.assertEqual(
+                sorted(os.listdir(self.blank_2s_save_path)),
+                sorted(f"frame_{i}.png" for i in range(20)),
+            )
+
+    def test_skip_processed(self):
+        """
+        Test that a second run skips the processed videos unless the options
+        changed or it is forced
+        """
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 1")
+            os.remove(os.path.join(self.blank_2s_save_path, "frame_0.png"))
+            run_cmd(self.default_cmd + " -f 1")
+            self.assertEqual(os.listdir(self.blank_2s_save_path), ["frame_1.png"])
+            run_cmd(self.default_cmd + " -f 1 --force")
+            self.assertEqual(len(os.listdir(self.blank_2s_save_path)), 2)
+            run_cmd(self.default_cmd + " -f 10")
+            self.assertEqual(len(os.listdir(self.blank_2s_save_path)), 20)
+
+    def test_frame_cache(self):
+        """
+        Test that a run with other preprocessing options replays the cached frames
+        """
+        if not self.ON_GITHUB_CI:
+            cache_dir = os.path.join(self.out_dir, ".cache")
+            run_cmd(self.default_cmd + f" -f 1 --cache-dir '{cache_dir}'")
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            run_cmd(
+                self.default_cmd
+                + f" -f 1 --width 192 --height 108 --cache-dir '{cache_dir}'"
+            )
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            img = cv2.imread(os.path.join(self.blank_2s_save_path, "frame_1.png"))
+            self.assertEqual(img.shape, (108, 192, 3))
+            self.assertEqual(len(os.listdir(self.blank_2s_save_path)), 2)
+
+    def test_dedup(self):
+        """Test that the duplicates of the blank video are dropped and listed"""
+
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 10 --dedup 1")
+            self.assertEqual(os.listdir(self.blank_2s_save_path), ["frame_0.png"])
+            with open(self.blank_2s_save_path + ".dropped.csv") as f:
+                rows = f.read().splitlines()
+            self.assertEqual(rows[0], "frame,source_frame,timestamp_ms")
+            self.assertEqual(
+                [r.split(",")[0] for r in rows[1:]], [str(i) for i in range(1, 20)]
+            )
+
+    def test_report(self):
+        """Test that the timings report counts the frames of every stage"""
+
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 10 --report --profile")
+            with open(os.path.join(self.out_dir, "report.json")) as f:
+                report = json.load(f)
+            self.assertEqual(report["frames"], 20)
+            for stage in ["decode", "preprocess", "encode", "write"]:
+                self.assertEqual(report["stages"][stage]["frames"], 20)
+            self.assertEqual(list(report["videos"]), ["blank_2s_30fps.mp4"])
+            queue = report["videos"]["blank_2s_30fps.mp4"]["queue"]
+            self.assertGreater(queue["capacity"], 0)
+            self.assertTrue(
+                os.path.isfile(
+                    os.path.join(self.out_dir, ".profile/blank_2s_30fps.mp4.prof")
+                )
+            )
+
+    def test_metrics(self):
+        """Test that the final metrics count the frames and videos of the run"""
+
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 10 --metrics")
+            with open(os.path.join(self.out_dir, "metrics.prom")) as f:
+                lines = f.read().splitlines()
+            self.assertIn("waldo_frames_decoded_total 20", lines)
+            self.assertIn("waldo_frames_written_total 20", lines)
+            self.assertIn('waldo_videos_total{status="done"} 1', lines)
+            self.assertIn("waldo_videos_pending 0", lines)
+
+    def test_recursive(self):
+        """
+        Test that the videos of the subfolders are processed into the same tree, and
+        that the excluded folders are skipped
+        """
+        if not self.ON_GITHUB_CI:
+            src_dir = os.path.join(self.out_dir, "src")
+            dest_dir = os.path.join(self.out_dir, "frames")
+            for sub in ["a/b", "skip"]:
+                os.makedirs(os.path.join(src_dir, sub))
+                shutil.copy(
+                    os.path.join(self.src_dir, "blank_2s_30fps.mp4"),
+                    os.path.join(src_dir, sub),
+                )
+            cmd = self.default_cmd.replace(f"-d '{self.out_dir}'", f"-d '{dest_dir}'")
+            cmd = cmd.replace(f"-s '{self.src_dir}'", f"-s '{src_dir}'")
+            run_cmd(cmd + " -f 1 --recursive --exclude 'skip'")
+            save_path = os.path.join(dest_dir, "a/b/blank_2s_30fps_mp4")
+            self.assertEqual(len(os.listdir(save_path)), 2)
+            self.assertFalse(os.path.exists(os.path.join(dest_dir, "skip")))
+
+        if not self.ON_GITHUB_CI and not IS_DOCKER:
+            # The listed videos cannot be outside of the src folder
+            vm = IOVideoManager(Path(self.src_dir), Path(self.out_dir))
+            lines = [
+                "blank_2s_30fps.mp4",
+                "../videos/a.mp4",
+                "../outside/x.mp4",
+                os.path.join(self.src_dir, "b.mp4"),
+                "/tmp/c.mp4",
+            ]
+            names = [p["name"] for p in vm.iter_video_paths(file_list=lines)]
+            self.assertEqual(names, ["blank_2s_30fps.mp4", "a.mp4", "b.mp4"])
+
+    def test_schedule(self):
+        """
+        Test that the most costly tasks are submitted first, starting with the ones
+        that could not be probed
+        """
+        tasks = [VPTask({"name": n}, None, c) for n, c in [("a", 1), ("b", None)]]
+        tasks += [VPTask({"name": "c"}, None, 3)]
+        names = [t.video_path_obj["name"] for t in schedule(tasks, "longest")]
+        self.assertEqual(names, ["b", "c", "a"])
+        names = [t.video_path_obj["name"] for t in schedule(tasks, "order")]
+        self.assertEqual(names, ["a", "b", "c"])
+        # Only the next 2 tasks are ordered, so the first one is submitted before
+        # the last one is found
+        pulled = []
+        ordered = schedule((pulled.append(t) or t for t in tasks), "shortest", 1)
+        self.assertEqual(next(ordered).video_path_obj["name"], "a")
+        self.assertEqual(len(pulled), 2)
+        names = [t.video_path_obj["name"] for t in ordered]
+        self.assertEqual(names, ["c", "b"])
+
+    def test_max_memory(self):
+        """
+        Test that the videos are processed with a memory budget smaller than 2
+        frames, and that the budget is given back when the stream is closed
+        """
+        if not self.ON_GITHUB_CI:
+            run_cmd(self.default_cmd + " -f 10 --max-memory 10")
+            self.assertEqual(len(os.listdir(self.blank_2s_save_path)), 20)
+
+            budget = MemoryBudget(10 * 1024 * 1024)
+            path = os.path.join(self.src_dir, "blank_2s_30fps.mp4")
+            vfs = VideoFileStream(path, 30, memory_budget=budget)
+            vfs.start()
+            next(iter(vfs))
+            vfs.close()
+            self.assertEqual(budget.get_usage()["used"], 0)
+            self.assertLessEqual(budget.get_usage()["peak"], 10 * 1024 * 1024)
+
+    def test_ffmpeg_decoder(self):
+        """
+        Test that the ffmpeg decoder samples, resizes, crops and converts the frames
+        to grayscale, and that it decodes the same frames as opencv otherwise
+        """
+        if not self.ON_GITHUB_CI and shutil.which("ffmpeg"):
+            run_cmd(
+                self.default_cmd
+                + " -f 1 --decoder ffmpeg -g --width 640 --height 360 --cxmax 320"
+            )
+            frames = os.listdir(self.blank_2s_save_path)
+            self.assertEqual(len(frames), 2)
+            for p in frames:
+                frame = cv2.imread(
+                    os.path.join(self.blank_2s_save_path, p), cv2.IMREAD_UNCHANGED
+                )
+                self.assertEqual(frame.shape, (360, 320))
+
+            path = os.path.join(self.src_dir, "blank_2s_30fps.mp4")
+            batches = []
+            for decoder in ["opencv", "ffmpeg"]:
+                vfs = VideoFileStream(path, 10, batch_size=4, decoder=decoder)
+                vfs.start()
+                batches.append(list(vfs))
+            self.assertEqual(
+                [idxs for idxs, _, _ in batches[0]], [idxs for idxs, _, _ in batches[1]]
+            )
+            for (_, _, a), (_, _, b) in zip(*batches):
+                self.assertTrue(np.array_equal(a, b))
+
+        # The ffmpeg scaler does not give the same pixels, so the frames saved with
+        # opencv are not reused
+        self.assertNotEqual(
+            VPOptions(decoder="opencv").fingerprint(),
+            VPOptions(decoder="ffmpeg").fingerprint(),
+        )
+
+    def test_distributed(self):
+        """
+        Test that concurrent distributed runs on the same folders process each video
+        once, and that an expired lease is reclaimed
+        """
+        if not self.ON_GITHUB_CI:
+            src_dir = os.path.join(self.out_dir, "src")
+            dest_dir = os.path.join(self.out_dir, "frames")
+            os.makedirs(src_dir)
+            for i in range(4):
+                shutil.copy(
+                    os.path.join(self.src_dir, "blank_2s_30fps.mp4"),
+                    os.path.join(src_dir, f"blank_{i}.mp4"),
+                )
+            cmd = self.default_cmd.replace(f"-d '{self.out_dir}'", f"-d '{dest_dir}'")
+            cmd = cmd.replace(f"-s '{self.src_dir}'", f"-s '{src_dir}'")
+            runs = [
+                subprocess.Popen(
+                    cmd + " -f 1 -t 1 --distributed",
+                    shell=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                )
+                for _ in range(2)
+            ]
+            logs = "".join(r.communicate()[0].decode() for r in runs)
+            self.assertEqual(logs.count("[SUCCESS] Finished processing video"), 4)
+            for i in range(4):
+                frames = os.listdir(os.path.join(dest_dir, f"blank_{i}_mp4"))
+                self.assertEqual(len(frames), 2)
+            self.assertEqual(os.listdir(os.path.join(dest_dir, ".leases")), [])
+
+        if not self.ON_GITHUB_CI and not IS_DOCKER:
+            vm = IOVideoManager(Path(self.src_dir), Path(self.out_dir))
+            a, b = LeaseManager(vm, 0.3), LeaseManager(vm, 0.3)
+            lease = a.claim("video.mp4")
+            self.assertIsNotNone(lease)
+            self.assertIsNone(b.claim("video.mp4"))
+            # The lease is not renewed as if its worker died
+            t = time.time() - 1
+            os.utime(lease.path, (t, t))
+            reclaimed = b.claim("video.mp4")
+            self.assertIsNotNone(reclaimed)
+            time.sleep(0.3)
+            self.assertTrue(lease.lost)
+            # The reclaim marker of another worker is removed while it is checked
+            b.release(reclaimed)
+            lease = a.claim("video.mp4")
+            open(f"{lease.path}.{lease.token}.reclaim", "w").close()
+            with mock.patch.object(
+                LeaseManager, "_is_expired", side_effect=[True, FileNotFoundError]
+            ):
+                self.assertIsNone(b.claim("video.mp4"))
+            a.release(lease)
+
+    def test_watch(self):
+        """
+        Test that the videos added to a watched folder are processed once their copy
+        is finished, and that stopping the run waits for them
+        """
+        if not self.ON_GITHUB_CI and not IS_DOCKER:
+            src_dir = os.path.join(self.out_dir, "src")
+            dest_dir = os.path.join(self.out_dir, "frames")
+            os.makedirs(src_dir)
+            vm = IOVideoManager(Path(src_dir), Path(dest_dir))
+            watcher = FolderWatcher(vm, 0.1)
+            with open(os.path.join(self.src_dir, "blank_2s_30fps.mp4"), "rb") as f:
+                data = f.read()
+            with open(os.path.join(src_dir, "blank.mp4"), "wb") as f:
+                f.write(data[: len(data) // 2])
+                f.flush()
+                self.assertEqual(watcher.poll(), [])
+                # The size changed since the last poll
+                f.write(data[len(data) // 2 :])
+                f.flush()
+                self.assertEqual(watcher.poll(), [])
+            self.assertEqual(len(watcher.poll()), 1)
+            self.assertEqual(watcher.poll(), [])
+            os.remove(os.path.join(src_dir, "blank.mp4"))
+
+            cmd = self.default_cmd.replace(f"-d '{self.out_dir}'", f"-d '{dest_dir}'")
+            cmd = cmd.replace(f"-s '{self.src_dir}'", f"-s '{src_dir}'")
+            run = subprocess.Popen(
+                "exec " + cmd + " -f 1 --watch --watch-interval 0.1 --executor process",
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+            time.sleep(1)
+            for i in range(2):
+                shutil.copy(
+                    os.path.join(self.src_dir, "blank_2s_30fps.mp4"),
+                    os.path.join(src_dir, f"blank_{i}.mp4"),
+                )
+            deadline = time.monotonic() + 30
+            while time.monotonic() < deadline and not os.path.isdir(
+                os.path.join(dest_dir, "blank_1_mp4")
+            ):
+                time.sleep(0.1)
+            # Ctrl+C reaches the workers too, which leave it to the main process
+            os.killpg(run.pid, signal.SIGINT)
+            logs = run.communicate(timeout=30)[0].decode()
+            self.assertEqual(run.returncode, 0)
+            self.assertEqual(logs.count("[SUCCESS] Finished processing video"), 2)
+            self.assertEqual(logs.count("[WARNING] Stopping"), 1)
+            self.assertIn("Processed 2/2 video(s) (4 frame(s)", logs)
+            for i in range(2):
+                frames = os.listdir(os.path.join(dest_dir, f"blank_{i}_mp4"))
+                self.assertEqual(len(frames), 2)
+
+    def test_server(self):
+        """
+        Test that the jobs submitted to the server are processed in its folders,
+        and that the jobs outside of them are refused
+        """
+        if not self.ON_GITHUB_CI and not IS_DOCKER:
+            src_dir = os.path.join(self.out_dir, "src")
+            dest_dir = os.path.join(self.out_dir, "frames")
+            os.makedirs(os.path.join(src_dir, "job"))
+            for i in range(2):
+                shutil.copy(
+                    os.path.join(self.src_dir, "blank_2s_30fps.mp4"),
+                    os.path.join(src_dir, "job", f"blank_{i}.mp4"),
+                )
+            server = subprocess.Popen(
+                f"exec python3 main.py -s '{src_dir}' -d '{dest_dir}' --serve "
+                "--server-port 8799",
+                shell=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                time.sleep(2)
+                job = f"python3 run.py --submit --server-port 8799 -f 1 -s '{src_dir}/job'"
+                self.assertEqual(run_cmd(f"{job} -d '{dest_dir}/job'"), 0)
+                for i in range(2):
+                    frames = os.listdir(os.path.join(dest_dir, "job", f"blank_{i}_mp4"))
+                    self.assertEqual(len(frames), 2)
+                self.assertNotEqual(run_cmd(f"{job} -d '{self.out_dir}'"), 0)
+                listed = os.path.join(self.out_dir, "videos.txt")
+                with open(listed, "w") as f:
+                    f.write("blank_0.mp4\n../../secret/s.mp4\n")
+                self.assertNotEqual(
+                    run_cmd(f"{job} -d '{dest_dir}/job' --files-from '{listed}'"), 0
+                )
+            finally:
+                server.send_signal(signal.SIGINT)
+                server.wait(timeout=30)
+
+    def test_output_profiles(self):
+        """
+        Test that the frames of each output profile are saved in its subfolder with
+        its own size, color and format
+        """
+        if not self.ON_GITHUB_CI:
+            run_cmd(
+                self.default_cmd
+                + " -f 1 --output-profile small:width=224,height=224"
+                + " --output-profile thumb:width=64,height=32,gray,format=jpg"
+            )
+            for profile, ext, shape in [
+                ("small", "png", (224, 224, 3)),
+                ("thumb", "jpg", (32, 64)),
+            ]:
+                folder = os.path.join(self.out_dir, profile, "blank_2s_30fps_mp4")
+                frames = os.listdir(folder)
+                self.assertEqual(sorted(frames), [f"frame_0.{ext}", f"frame_1.{ext}"])
+                for p in frames:
+                    frame = cv2.imread(os.path.join(folder, p), cv2.IMREAD_UNCHANGED)
+                    self.assertEqual(frame.shape, shape)
+
+    def test_frame_iterator(self):
+        """
+        Test that the python API yields the preprocessed frames with their metadata
+        and regroups them into fixed size batches, without saving them
+        """
+        if not self.ON_GITHUB_CI and not IS_DOCKER:
+            path = os.path.join(self.src_dir, "blank_2s_30fps.mp4")
+            opts = VPOptions(fps=1, gray=True, width=100)
+            frames = list(iter_frames(path, opts))
+            self.assertEqual(len(frames), 2)
+            self.assertEqual(frames[0][0].shape, (self.blank_2s_h, 100))
+            self.assertEqual([m["source_frame"] for _, m in frames], [0, 30])
+            self.assertEqual(frames[1][1]["video"], "blank_2s_30fps.mp4")
+
+            batches = list(iter_batches([path] * 3, VPOptions(fps=10), batch_size=8))
+            self.assertEqual(
+                [len(b.numbers) for b in batches], [8, 8, 8, 8, 8, 8, 8, 4]
+            )
+            self.assertEqual(batches[0].frames.shape[0], 8)
+            self.assertFalse(os.path.exists(self.out_dir))
+
+    def test_stream_close(self):
+        """
+        Test that closing a stream that is not fully read stops its decoding thread
+        """
+        if not self.ON_GITHUB_CI:
+            path = os.path.join(self.src_dir, "blank_2s_30fps.mp4")
+            vfs = VideoFileStream(path, 30, prefetch=1)
+            vfs.start()
+            idxs, _, frames = next(iter(vfs))
+            self.assertEqual(idxs, [0])
+            self.assertEqual(frames.shape, (1, self.blank_2s_h, self.blank_2s_w, 3))
+            vfs.close()
+            self.assertFalse(vfs.is_alive())
+
     def test_no_grayscale(self):
         """
         Test that when no grayscale in args, the frames are not converted
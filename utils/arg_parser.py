@@ -1,7 +1,30 @@
 import argparse
+import re
 from typing import List, Tuple, Union
 
 from utils.logger import logger
+from variables import (
+    DECODERS,
+    IMAGE_FORMATS,
+    SAMPLING_MODES,
+    SCHEDULING_POLICIES,
+    SERVER_PORT,
+)
+
+# Options that an output profile can override, by their name in '--output-profile',
+# with their 'VPProfile' field and type
+PROFILE_OPTIONS = {
+    "width": ("width", int),
+    "height": ("height", int),
+    "cxmin": ("cxmin", int),
+    "cxmax": ("cxmax", int),
+    "cymin": ("cymin", int),
+    "cymax": ("cymax", int),
+    "gray": ("gray", bool),
+    "format": ("img_format", str),
+    "png-compression": ("png_compression", int),
+    "quality": ("quality", int),
+}
 
 
 class ArgParser(object):
@@ -32,6 +55,71 @@ class ArgParser(object):
             ),
             type=str,
         )
+        self._parser.add_argument(
+            "--recursive",
+            default=False,
+            action="store_true",
+            dest="recursive",
+            help=(
+                "Also preprocess the videos of the subfolders of the source folder, "
+                "the outputs mirror its tree"
+            ),
+        )
+        self._parser.add_argument(
+            "--include",
+            default=None,
+            action="append",
+            dest="include",
+            help=(
+                "Provide a glob of the files to preprocess, relative to the source "
+                "folder (e.g. 'cam1/*.mkv'). Can be repeated. Defaults to the files "
+                "with a video extension"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--exclude",
+            default=None,
+            action="append",
+            dest="exclude",
+            help=(
+                "Provide a glob of the files or folders to skip, relative to the "
+                "source folder (e.g. 'tmp/*'). Can be repeated"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--files-from",
+            default=None,
+            dest="files_from",
+            help=(
+                "Provide a file listing the videos to preprocess (one path relative "
+                "to the source folder per line) instead of scanning the source "
+                "folder, '-' reads the list from stdin"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--watch",
+            default=False,
+            action="store_true",
+            dest="watch",
+            help=(
+                "Keep running and preprocess the videos as they are added to (or "
+                "modified in) the source folder, until the run is stopped"
+            ),
+        )
+        self._parser.add_argument(
+            "--watch-interval",
+            default=2.0,
+            dest="watch_interval",
+            help=(
+                "Provide the time in seconds between 2 scans of the source folder "
+                "with '--watch'. A video is preprocessed once its size did not "
+                "change between 2 scans. Defaults to 2"
+            ),
+            type=float,
+        )
         self._parser.add_argument(
             "-f",
             "--fps",
@@ -100,6 +188,63 @@ class ArgParser(object):
             ),
             type=int,
         )
+        self._parser.add_argument(
+            "--sampling",
+            default="auto",
+            choices=SAMPLING_MODES,
+            dest="sampling",
+            help=(
+                "Provide how the skipped frames are reached: 'grab' skips them "
+                "sequentially without decoding them to images, 'seek' jumps to the "
+                "next kept frame. Defaults to 'auto' (seeks for large gaps only)"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--decoder",
+            default="opencv",
+            choices=DECODERS,
+            dest="decoder",
+            help=(
+                "Provide the decoder of the videos: 'ffmpeg' runs an ffmpeg process "
+                "that samples, resizes, crops and converts the frames to grayscale "
+                "before they reach python (the frames can differ slightly from "
+                "'opencv'). Defaults to 'opencv'"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--decoder-threads",
+            default=0,
+            dest="decoder_threads",
+            help=(
+                "Provide the number of threads decoding each video. Defaults to 0 "
+                "(chosen by the decoder)"
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--segment-duration",
+            default=None,
+            dest="segment_duration",
+            help=(
+                "Provide the duration in seconds of the segments long videos are "
+                "split into, each segment being processed by its own worker. It does "
+                "not split the videos by default."
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "-b",
+            "--batch-size",
+            default=1,
+            dest="batch_size",
+            help=(
+                "Provide the number of frames decoded into a single (N, H, W, C) "
+                "array and sent through the decoding queue as one item. Defaults to 1"
+            ),
+            type=int,
+        )
         self._parser.add_argument(
             "-g",
             "--gray",
@@ -108,6 +253,94 @@ class ArgParser(object):
             dest="gray",
             help="Extract to grayscale",
         )
+        self._parser.add_argument(
+            "--output",
+            default="files",
+            choices=["files", "mmap", "tar"],
+            dest="output",
+            help=(
+                "Provide how the frames are saved: 'files' saves one image per frame, "
+                "'mmap' packs the frames of each video into a single .npy array with "
+                "a .index.csv sidecar, 'tar' streams the frames into rolling tar "
+                "shards. Defaults to 'files'"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--shard-size",
+            default=1024,
+            dest="shard_size",
+            help="Provide the maximum size of a tar shard in MB. Defaults to 1024",
+            type=int,
+        )
+        self._parser.add_argument(
+            "--shard-frames",
+            default=10000,
+            dest="shard_frames",
+            help=(
+                "Provide the maximum number of frames of a tar shard. Defaults to 10000"
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--format",
+            default="png",
+            choices=IMAGE_FORMATS,
+            dest="format",
+            help=(
+                "Provide the format of the saved frames ('npy' saves the raw arrays). "
+                "Defaults to 'png'"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--png-compression",
+            default=None,
+            dest="png_compression",
+            help=(
+                "Provide the png compression level from 0 (fastest, largest) to 9 "
+                "(slowest, smallest). Uses the OpenCV default by default."
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--quality",
+            default=None,
+            dest="quality",
+            help=(
+                "Provide the jpg/webp quality from 0 (fastest, smallest) to 100 "
+                "(slowest, best). Uses the OpenCV default by default."
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--output-profile",
+            default=None,
+            action="append",
+            dest="output_profiles",
+            help=(
+                "Provide an output profile 'name:option=value,...' whose frames are "
+                "saved in the 'name' subfolder of the dest folder, e.g. "
+                "'small:width=224,height=224' or 'thumb:width=64,height=64,gray'. "
+                "Its options (width, height, cxmin, cxmax, cymin, cymax, gray, "
+                "format, png-compression and quality) override the command line "
+                "ones. Can be repeated, the videos are decoded once for all the "
+                "profiles"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--dedup",
+            default=None,
+            dest="dedup",
+            help=(
+                "Provide the threshold from 0 to 255 under which a frame is dropped "
+                "as a duplicate of the last kept frame (mean absolute difference of "
+                "their downscaled pixels). The dropped frames are listed in a "
+                "'name.dropped.csv' file. It does not drop frames by default."
+            ),
+            type=float,
+        )
         self._parser.add_argument(
             "--silent",
             default=False,
@@ -120,9 +353,199 @@ class ArgParser(object):
             "--threads",
             default=4,
             dest="threads",
-            help="Provide the number of threads for thread pool. Defaults to 4",
+            help=(
+                "Provide the number of workers for the pool (1 file == 1 worker). "
+                "Defaults to 4"
+            ),
             type=int,
         )
+        self._parser.add_argument(
+            "--executor",
+            default="thread",
+            choices=["thread", "process"],
+            dest="executor",
+            help=(
+                "Provide the kind of pool that runs the workers. 'process' scales "
+                "with the number of cores. Defaults to 'thread'"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--schedule",
+            default="longest",
+            choices=SCHEDULING_POLICIES,
+            dest="schedule",
+            help=(
+                "Provide the order in which the videos are given to the workers. "
+                "'longest' starts with the most costly of the next videos found "
+                "(as many as the workers queue) so that a long video does not run "
+                "alone at the end, 'order' keeps the order of the scan and does not "
+                "probe the videos (unless they are split into segments). Defaults to "
+                "'longest'"
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "-w",
+            "--writers",
+            default=2,
+            dest="writers",
+            help=(
+                "Provide the number of threads encoding and saving the frames of each "
+                "video while it is decoded (0 saves them inline). Defaults to 2"
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--prefetch",
+            default=128,
+            dest="prefetch",
+            help=(
+                "Provide the number of decoded frames buffered ahead of the "
+                "preprocessing for each video. Defaults to 128"
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--max-memory",
+            default=None,
+            dest="max_memory",
+            help=(
+                "Provide the maximum memory in MB of the frames buffered by all the "
+                "videos (decoded frames and frames waiting to be saved), the "
+                "decoders wait when it is reached. It is not bounded by default."
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--cache-dir",
+            default=None,
+            dest="cache_dir",
+            help=(
+                "Provide a folder where the decoded frames are cached, so that runs "
+                "with the same videos and fps but other preprocessing options do not "
+                "decode the videos again. It does not cache the frames by default."
+            ),
+            type=str,
+        )
+        self._parser.add_argument(
+            "--cache-size",
+            default=10240,
+            dest="cache_size",
+            help=(
+                "Provide the maximum size of the frame cache in MB, the least "
+                "recently used videos are evicted first. Defaults to 10240"
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--report",
+            default=False,
+            action="store_true",
+            dest="report",
+            help=(
+                "Time each stage of the processing (decoding, preprocessing, "
+                "encoding, writing and the waits in between) and save the timings "
+                "and the decoding queue stats of every video to 'report.json' in the "
+                "dest folder"
+            ),
+        )
+        self._parser.add_argument(
+            "--profile",
+            default=False,
+            action="store_true",
+            dest="profile",
+            help=(
+                "Profile the worker of each video with cProfile and save the "
+                "profiles to the '.profile' folder of the dest folder"
+            ),
+        )
+        self._parser.add_argument(
+            "--metrics",
+            default=False,
+            action="store_true",
+            dest="metrics",
+            help=(
+                "Export live metrics of the run (frames per second, progress and "
+                "queues of each worker, errors) in the Prometheus text format to "
+                "'metrics.prom' in the dest folder"
+            ),
+        )
+        self._parser.add_argument(
+            "--metrics-port",
+            default=None,
+            dest="metrics_port",
+            help=(
+                "Provide a port to also serve the metrics on (at '/metrics'). It "
+                "does not serve them by default."
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--distributed",
+            default=False,
+            action="store_true",
+            dest="distributed",
+            help=(
+                "Share the videos with the other runs (on any node) that write to "
+                "the same dest folder: each video is claimed with a lease file in "
+                "its '.leases' folder, and the videos of the runs that stopped "
+                "renewing their leases are processed again"
+            ),
+        )
+        self._parser.add_argument(
+            "--lease-ttl",
+            default=60.0,
+            dest="lease_ttl",
+            help=(
+                "Provide the time in seconds after which the lease of a video that "
+                "is not renewed can be claimed by another run, it must be longer "
+                "than the clock skew between the nodes. Defaults to 60"
+            ),
+            type=float,
+        )
+        self._parser.add_argument(
+            "--serve",
+            default=False,
+            action="store_true",
+            dest="serve",
+            help=(
+                "Start a server that keeps the workers up and runs the jobs submitted "
+                "with '--submit', in any sub folder of the source and dest folders. "
+                "The worker options ('--threads', '--executor', '--max-memory', "
+                "'--cache-dir', '--cache-size' and the metrics) are the server's"
+            ),
+        )
+        self._parser.add_argument(
+            "--submit",
+            default=False,
+            action="store_true",
+            dest="submit",
+            help=(
+                "Submit the run as a job to the server started with '--serve' and "
+                "show its progress, instead of starting the workers"
+            ),
+        )
+        self._parser.add_argument(
+            "--server-port",
+            default=SERVER_PORT,
+            dest="server_port",
+            help=(
+                "Provide the port (on localhost) of the server of '--serve' and "
+                f"'--submit'. Defaults to {SERVER_PORT}"
+            ),
+            type=int,
+        )
+        self._parser.add_argument(
+            "--force",
+            default=False,
+            action="store_true",
+            dest="force",
+            help=(
+                "Reprocess all the videos, even those the manifest of the dest folder "
+                "records as already processed"
+            ),
+        )
         self._parser.add_argument(
             "-ni",
             "--noinput",
@@ -150,6 +573,79 @@ class ArgParser(object):
             return False, f"'--{str_repr}' argument must be greater or equal to 0"
         return True, ""
 
+    def _validate_range(
+        self, arg: Union[int, None], low: int, high: int, str_repr: str
+    ) -> Tuple[bool, str]:
+        """Helper function that validates if a given arg is between low and high"""
+
+        if arg is not None and not low <= arg <= high:
+            return False, f"'--{str_repr}' argument must be between {low} and {high}"
+        return True, ""
+
+    @staticmethod
+    def parse_output_profile(spec: str, args: argparse.Namespace) -> dict:
+        """
+        Parses an output profile 'name:option=value,...' into the fields of a
+        'VPProfile', the options it does not set are the command line ones. Raises
+        a 'ValueError' if it is not valid.
+        """
+        name, _, options = spec.partition(":")
+        if not re.fullmatch(r"[\w-]+", name):
+            raise ValueError(
+                f"'--output-profile' name '{name}' must only contain letters, digits, "
+                "'_' and '-'"
+            )
+        profile = {"name": name}
+        for key, (field, _) in PROFILE_OPTIONS.items():
+            profile[field] = getattr(args, key.replace("-", "_"))
+        for option in filter(None, options.split(",")):
+            key, sep, value = option.partition("=")
+            if key not in PROFILE_OPTIONS:
+                raise ValueError(
+                    f"'--output-profile' '{name}' has an unknown option '{key}'"
+                )
+            field, type_ = PROFILE_OPTIONS[key]
+            if type_ is bool:
+                # 'gray' alone sets it
+                profile[field] = not sep or value.lower() not in ["0", "false", "no"]
+                continue
+            try:
+                profile[field] = type_(value)
+            except ValueError:
+                raise ValueError(
+                    f"'--output-profile' '{name}' has an invalid {key} '{value}'"
+                )
+        return profile
+
+    def _validate_output_profiles(self, args: argparse.Namespace) -> List[str]:
+        """Helper function that validates the output profiles, returns the errors"""
+
+        msgs = []
+        names = set()
+        for spec in args.output_profiles or []:
+            try:
+                p = self.parse_output_profile(spec, args)
+            except ValueError as e:
+                msgs.append(str(e))
+                continue
+            if p["name"] in names:
+                msgs.append(f"'--output-profile' '{p['name']}' is given twice")
+            names.add(p["name"])
+            checks = [
+                self._validate_gt_zero(p["width"], "width"),
+                self._validate_gt_zero(p["height"], "height"),
+                self._validate_range(p["png_compression"], 0, 9, "png-compression"),
+                self._validate_range(p["quality"], 0, 100, "quality"),
+                self.validate_crop_axis(p["cxmin"], p["cxmax"], p["width"], "x"),
+                self.validate_crop_axis(p["cymin"], p["cymax"], p["height"], "y"),
+            ]
+            if p["img_format"] not in IMAGE_FORMATS:
+                checks.append((False, f"'--format' must be one of {IMAGE_FORMATS}"))
+            for v, m in checks:
+                if not v:
+                    msgs.append(f"'--output-profile' '{p['name']}': {m}")
+        return msgs
+
     @staticmethod
     def validate_crop_axis(
         cmin: Union[int, None],
@@ -161,7 +657,7 @@ class ArgParser(object):
         Helper function that determines if a given cmin, cmax and axis is valid for
         cropping
         """
-        w_or_h = "width" if axis == "x" else "height"
+        w_or_h = "width" if axis_repr == "x" else "height"
         if axis and cmin is None:
             cmin = 0
         if axis and cmax is None:
@@ -209,12 +705,23 @@ class ArgParser(object):
             "width": args.width,
             "height": args.height,
             "threads": args.threads,
+            "segment-duration": args.segment_duration,
+            "shard-size": args.shard_size,
+            "shard-frames": args.shard_frames,
+            "batch-size": args.batch_size,
+            "cache-size": args.cache_size,
+            "prefetch": args.prefetch,
+            "max-memory": args.max_memory,
+            "lease-ttl": args.lease_ttl,
+            "watch-interval": args.watch_interval,
         }
         to_validate_positive = {
             "cxmin": args.cxmin,
             "cxmax": args.cxmax,
             "cymin": args.cymin,
             "cymax": args.cymax,
+            "writers": args.writers,
+            "decoder-threads": args.decoder_threads,
         }
 
         # Is greater than 0 validation
@@ -229,6 +736,73 @@ class ArgParser(object):
             valids.append(v)
             msgs.append(m)
 
+        # Range validation
+        v, m = self._validate_range(args.png_compression, 0, 9, "png-compression")
+        valids.append(v)
+        msgs.append(m)
+
+        v, m = self._validate_range(args.quality, 0, 100, "quality")
+        valids.append(v)
+        msgs.append(m)
+
+        v, m = self._validate_range(args.dedup, 0, 255, "dedup")
+        valids.append(v)
+        msgs.append(m)
+
+        v, m = self._validate_range(args.metrics_port, 1, 65535, "metrics-port")
+        valids.append(v)
+        msgs.append(m)
+
+        v, m = self._validate_range(args.server_port, 1, 65535, "server-port")
+        valids.append(v)
+        msgs.append(m)
+
+        # Output validation
+        if args.output == "mmap" and args.segment_duration:
+            valids.append(False)
+            msgs.append("'--segment-duration' cannot be used with '--output mmap'")
+
+        # Distributed validation
+        if args.distributed and args.force:
+            valids.append(False)
+            msgs.append(
+                "'--force' cannot be used with '--distributed', the runs would "
+                "process again the videos finished by the others"
+            )
+        if args.distributed and args.output == "tar":
+            valids.append(False)
+            msgs.append(
+                "'--output tar' cannot be used with '--distributed', a video is only "
+                "done once its shard is finished, after its lease is released"
+            )
+
+        # Watch validation
+        if args.watch and args.files_from is not None:
+            valids.append(False)
+            msgs.append("'--files-from' cannot be used with '--watch'")
+
+        # Server validation
+        if args.serve and args.submit:
+            valids.append(False)
+            msgs.append("'--serve' cannot be used with '--submit'")
+        if (args.serve or args.submit) and args.watch:
+            valids.append(False)
+            msgs.append("'--watch' cannot be used with '--serve' or '--submit'")
+        if args.serve and args.files_from is not None:
+            valids.append(False)
+            msgs.append("'--files-from' cannot be used with '--serve'")
+        if args.submit and args.output == "tar":
+            valids.append(False)
+            msgs.append(
+                "'--output tar' cannot be used with '--submit', the shards are only "
+                "finished when the workers exit"
+            )
+
+        # Output profiles validation
+        profile_msgs = self._validate_output_profiles(args)
+        valids.append(not profile_msgs)
+        msgs += profile_msgs
+
         # Crop validation
         v, m = self.validate_crop_axis(args.cxmin, args.cxmax, args.width, "x")
         valids.append(v)
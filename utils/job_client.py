@@ -0,0 +1,83 @@
+from argparse import Namespace
+import json
+from pathlib import Path
+import sys
+from typing import List, Union
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from utils.logger import logger
+
+
+def _read_file_list(files_from: Union[str, None]) -> Union[List[str], None]:
+    """Helper function that reads the list of videos of '--files-from'"""
+
+    if files_from is None:
+        return None
+    if files_from == "-":
+        return sys.stdin.read().splitlines()
+    with open(files_from) as f:
+        return f.read().splitlines()
+
+
+def _log_event(event: dict) -> None:
+    """Helper function that logs the progress of a job sent by the server"""
+
+    if event["event"] == "video":
+        name = event["name"]
+        if event["segment"] is not None:
+            name += f" (frames {event['segment'][0]}-{event['segment'][1]})"
+        if event["error"] is not None:
+            logger.error(f"Failed processing video '{name}': {event['error']}")
+        elif event["skipped"]:
+            logger.info(f"Video '{name}' was already processed")
+        else:
+            logger.success(
+                f"Finished processing video '{name}' ({event['frames']} frame(s))"
+            )
+    elif event["event"] == "done":
+        logger.info(
+            f"Processed {event['videos'] - event['failed']}/{event['videos']} "
+            f"video(s) ({event['frames']} frame(s), {event['skipped']} video(s) "
+            "already processed)."
+        )
+        if event["dropped"]:
+            logger.info(f"Dropped {event['dropped']} duplicate frame(s).")
+    elif event["event"] == "error":
+        logger.error(f"The job failed: {event['error']}")
+
+
+def submit_job(argv: List[str], args: Namespace) -> int:
+    """
+    Submits a run to the server of '--serve' and logs its progress as the server
+    sends it. Returns the exit code of the run.
+    """
+    job = {
+        "args": argv,
+        # The server does not run in the current folder
+        "src": Path(args.src).absolute().as_posix(),
+        "dest": Path(args.dest).absolute().as_posix(),
+        "files": _read_file_list(args.files_from),
+    }
+    request = Request(
+        f"http://127.0.0.1:{args.server_port}/jobs",
+        data=json.dumps(job).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    code = 1
+    try:
+        with urlopen(request) as response:
+            # The server sends an event per line
+            for line in response:
+                event = json.loads(line)
+                _log_event(event)
+                if event["event"] == "done":
+                    code = 1 if event["failed"] else 0
+    except HTTPError as e:
+        logger.error(f"The server refused the job: {json.load(e)['error']}")
+    except URLError as e:
+        logger.error(
+            f"Could not reach the server on port {args.server_port} ({e.reason}), "
+            "start it with '--serve'"
+        )
+    return code
@@ -3,6 +3,59 @@ IS_DOCKER = True
 IMAGE_NAME = "waldo/preprocess"
 MOUNT_IMAGE_SRC = "/in"
 MOUNT_IMAGE_DEST = "/out"
+MOUNT_IMAGE_CACHE = "/cache"
+MOUNT_IMAGE_FILES_FROM = "/files_from.txt"
 
 # Misc variables
 VIDEO_FILE_EXTENSIONS = [".mp4", ".mov", ".avi"]
+IMAGE_FORMATS = ["png", "jpg", "webp", "bmp", "npy"]
+
+# Sampling variables
+SAMPLING_MODES = ["auto", "grab", "seek"]
+DECODERS = ["opencv", "ffmpeg"]
+# ffmpeg executable of the 'ffmpeg' decoder
+FFMPEG_BIN = "ffmpeg"
+# A seek lands on the previous keyframe and decodes forward from there, so it is
+# only cheaper than grabbing when the gap between two kept frames is larger than a
+# typical keyframe interval (e.g. x264 uses 250 by default)
+SEEK_MIN_GAP = 250
+
+# Manifest variables
+# Interval in seconds between two records of the progress of a video, each record
+# waits for the queued frames to be saved
+MANIFEST_CHECKPOINT_INTERVAL = 10.0
+
+# Metrics variables
+# Interval in seconds between two exports of the metrics
+METRICS_EXPORT_INTERVAL = 5.0
+# Interval in seconds between two updates of the progress of a video
+METRICS_UPDATE_INTERVAL = 1.0
+
+# Scheduling variables
+SCHEDULING_POLICIES = ["longest", "shortest", "order"]
+# Tasks queued per worker while the src folder is scanned
+MAX_PENDING_TASKS_PER_WORKER = 4
+# Frames decoded on average by a seek, from the previous keyframe
+SEEK_COST_FRAMES = SEEK_MIN_GAP // 2
+# Cost of encoding and saving a frame relative to decoding one (png at 1080p)
+WRITE_COST_FRAMES = 3
+
+# Distributed variables
+# Times a lease is renewed during its ttl, so that a slow renewal does not lose it
+LEASE_RENEWALS_PER_TTL = 3
+# Interval in seconds between two claims of the videos held by other workers
+LEASE_POLL_INTERVAL = 5.0
+
+# Server variables
+SERVER_PORT = 8765
+SERVER_CONTAINER_NAME = "waldo-preprocess-server"
+# Options of a job that are set by the server, as they configure its workers
+SERVER_OPTIONS = [
+    "threads",
+    "executor",
+    "max_memory",
+    "cache_dir",
+    "cache_size",
+    "metrics",
+    "metrics_port",
+]